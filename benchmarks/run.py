@@ -0,0 +1,180 @@
+import argparse
+import gc
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Run from anywhere, the portfolio modules live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+import valuation
+from events import event_log
+from report import build_report
+from valuation import Valuation
+
+from synthetic import build_portfolio, generate_transactions
+
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000, "1m": 1000000, "10m": 10000000}
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_TOLERANCE = 0.25  # Fraction a measurement may be worse than its baseline before it counts as a regression
+MIN_CALLS = 3  # Calls per stage at least, a single slow call then can't decide the result
+MIN_STAGE_SECONDS = 0.5  # Fast stages keep calling for this long, small ledgers are otherwise all noise
+
+
+def timed(function, min_seconds=0.0, setup=None, min_calls=MIN_CALLS):
+    # Median seconds per call. Stages repeat until min_seconds have passed and min_calls were made, so
+    # timer noise and one-off stalls don't decide the result. setup runs untimed before every call.
+    gc.collect()
+    times = []
+    while len(times) < min_calls or sum(times) < min_seconds:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+def backend():
+    # Valuation and the performance statistics use NumPy when it is installed and plain Python otherwise.
+    # Revaluation is several times slower without it, so each backend is compared to its own baseline.
+    return "numpy" if valuation.np is not None else "python"
+
+def calibrate():
+    # Speed of a fixed pure Python workload (dicts, strings, floats) in loops per second. Throughputs
+    # are compared relative to it, so a slower machine or a busy one doesn't read as a regression.
+    def workload():
+        totals = {}
+        for i in range(20000):
+            key = f"k{i % 97}"
+            totals[key] = totals.get(key, 0.0) + i * 1.5
+        return sorted(totals.items())
+
+    _, seconds = timed(workload, min_seconds=0.2)
+    return 1 / seconds
+
+def run_scale(count, seed, measure_memory):
+    # Throughput of each stage in transactions per second, plus retained bytes per transaction
+    results = {}
+    state = {}
+
+    def fresh_portfolio():
+        # Every insert pass starts from an empty ledger
+        state["portfolio"] = build_portfolio(seed=seed)
+        state["transactions"] = list(generate_transactions(state["portfolio"], count, seed))
+
+    # Per transaction logging would dominate every timing
+    with event_log.bulk(keep_rejections=False):
+        _, seconds = timed(lambda: [state["portfolio"].ledger.add_transaction(t) for t in state["transactions"]],
+                           setup=fresh_portfolio, min_seconds=MIN_STAGE_SECONDS)
+        results["insert"] = count / seconds
+        portfolio = state.pop("portfolio")
+        del state["transactions"]
+        _, seconds = timed(portfolio.update_wallet_positions, min_seconds=MIN_STAGE_SECONDS)
+        results["replay"] = count / seconds
+
+    _, seconds = timed(lambda: Valuation(portfolio).revalue(), min_seconds=MIN_STAGE_SECONDS)
+    results["revalue"] = count / seconds
+    _, seconds = timed(lambda: build_report(portfolio, ("month", "wallet", "asset")), min_seconds=MIN_STAGE_SECONDS)
+    results["report"] = count / seconds
+
+    directory = tempfile.mkdtemp(prefix="venture-bench-")
+    try:
+        path = os.path.join(directory, "bench.vpf")
+        # A save to the file the portfolio came from only appends, each timed save writes it whole
+        _, seconds = timed(lambda: storage.save_portfolio(portfolio, path),
+                           setup=lambda: setattr(portfolio, "saved_path", None),
+                           min_seconds=MIN_STAGE_SECONDS)
+        results["save"] = count / seconds
+        _, seconds = timed(lambda: storage.load_portfolio(path), min_seconds=MIN_STAGE_SECONDS)
+        results["load"] = count / seconds
+    finally:
+        shutil.rmtree(directory)
+
+    if measure_memory:
+        # Separate pass, tracing slows every allocation down and would skew the timings above
+        del portfolio
+        gc.collect()
+        tracemalloc.start()
+        portfolio = build_portfolio(seed=seed)
+        before = tracemalloc.get_traced_memory()[0]
+        with event_log.bulk(keep_rejections=False):
+            portfolio.ledger.add_transactions(generate_transactions(portfolio, count, seed))
+        results["memory_per_transaction"] = (tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+    return results
+
+def compare(results, baseline, tolerance):
+    # Lower throughput or higher memory than the baseline allows, as printable messages
+    regressions = []
+    for scale, measurements in results.items():
+        for name, value in measurements.items():
+            expected = baseline.get(scale, {}).get(name)
+            if expected is None:
+                continue
+            if name.startswith("memory"):
+                if value > expected * (1 + tolerance):
+                    regressions.append(f"{scale} {name}: {value:.0f} bytes, baseline {expected:.0f}")
+            elif value < expected * (1 - tolerance):
+                regressions.append(f"{scale} {name}: {value:.2f}, baseline {expected:.2f}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay, valuation, report and storage benchmarks.")
+    parser.add_argument("--scale", action="append", choices=SCALES,
+                        help="ledger size to run, repeatable (default 1k and 10k)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scale, the median of each stage counts")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced memory pass")
+    args = parser.parse_args(argv)
+
+    measured = backend()
+    print(f"Backend: {measured}")
+    results = {}
+    for scale in args.scale or ["1k", "10k"]:
+        # Median of several runs, each throughput relative to the calibration loop measured just before it
+        runs = []
+        for i in range(max(1, args.repeat)):
+            speed = calibrate()
+            run = run_scale(SCALES[scale], args.seed, not args.no_memory and i == 0)
+            runs.append({name: value if name.startswith("memory") else value / speed for name, value in run.items()})
+        results[scale] = {
+            name: statistics.median(run[name] for run in runs) for name in runs[0] if not name.startswith("memory")
+        }
+        if "memory_per_transaction" in runs[0]:
+            results[scale]["memory_per_transaction"] = runs[0]["memory_per_transaction"]
+        print(f"{scale}: " + ", ".join(
+            f"{name} {value:.0f} B" if name.startswith("memory") else f"{name} {value:.2f}"
+            for name, value in results[scale].items()
+        ))
+
+    baselines = {}  # Backend -> scale -> stage -> value
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines.setdefault(measured, {}).update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baseline for the {measured} backend written to {args.baseline}.")
+        return 0
+
+    if measured not in baselines:
+        print(f"No baseline for the {measured} backend in {args.baseline}, nothing to compare.")
+        return 0
+    regressions = compare(results, baselines[measured], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION ({measured}) {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
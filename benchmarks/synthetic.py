@@ -0,0 +1,77 @@
+import random
+from datetime import date, timedelta
+
+from portfolio import Asset, Portfolio, Transaction, Wallet
+
+START_DATE = date(2015, 1, 1)
+
+def build_portfolio(name="Benchmark", asset_count=20, wallet_count=8, seed=0):
+    # Portfolio with USD plus `asset_count` coins and `wallet_count` empty wallets
+    rng = random.Random(seed)
+    portfolio = Portfolio(name)
+    for i in range(asset_count):
+        portfolio.add_asset(Asset(f"COIN{i:03d}", round(rng.uniform(0.1, 1000), 4)))
+    for i in range(wallet_count):
+        portfolio.add_wallet(Wallet(f"wallet{i:02d}"))
+    return portfolio
+
+def generate_transactions(portfolio, count, seed=0, per_day=200):
+    # Deterministic stream of `count` transactions in date order: USD deposits, orders between USD and
+    # the coins (and coin to coin), and withdrawals. Holdings are tracked so nearly every order and
+    # withdrawal is covered, prices follow a random walk per coin.
+    rng = random.Random(seed)
+    usd = portfolio.get_asset("USD")
+    coins = [asset for asset in portfolio.assets if asset.name != "USD"]
+    wallets = portfolio.wallets
+    prices = {asset.name: asset.market_value for asset in coins}
+    prices["USD"] = 1.0
+    holdings = {(wallet.name, asset.name): 0.0 for wallet in wallets for asset in portfolio.assets}
+
+    day = START_DATE.isoformat()
+    for i in range(count):
+        if i % per_day == 0:
+            day = (START_DATE + timedelta(days=i // per_day)).isoformat()
+            for coin in coins:
+                prices[coin.name] = max(0.0001, prices[coin.name] * (1 + rng.gauss(0, 0.03)))
+        minute = (i % per_day) * 1440 // per_day
+        time = f"{minute // 60:02d}:{minute % 60:02d}"
+        wallet = rng.choice(wallets)
+        roll = rng.random()
+
+        if roll < 0.15 or holdings[(wallet.name, "USD")] < 100:
+            quantity = round(rng.uniform(100, 10000), 2)
+            holdings[(wallet.name, "USD")] += quantity
+            yield Transaction(day, time, "Deposit", 0, None, "Deposit",
+                              received_quantity=quantity, received_asset=usd, received_spot_price=1.0,
+                              destination_wallet=wallet)
+            continue
+
+        held = [coin for coin in coins if holdings[(wallet.name, coin.name)] > 0]
+        if roll < 0.22 and held:
+            coin = rng.choice(held)
+            quantity = holdings[(wallet.name, coin.name)] * rng.uniform(0.1, 0.5)
+            holdings[(wallet.name, coin.name)] -= quantity
+            yield Transaction(day, time, "Withdraw", 0, None, "Withdraw",
+                              sent_quantity=quantity, sent_asset=coin, sent_spot_price=prices[coin.name],
+                              origin_wallet=wallet)
+            continue
+
+        # Orders: buy with USD, sell back to USD, or swap one coin for another
+        if roll < 0.6 or not held:
+            sent = usd
+            received = rng.choice(coins)
+            sent_quantity = round(holdings[(wallet.name, "USD")] * rng.uniform(0.05, 0.3), 2)
+        else:
+            sent = rng.choice(held)
+            received = usd if roll < 0.85 else rng.choice(coins)
+            sent_quantity = holdings[(wallet.name, sent.name)] * rng.uniform(0.2, 1.0)
+        value = sent_quantity * prices[sent.name]
+        received_quantity = value / prices[received.name]
+        fee = round(value * 0.001, 6)
+        holdings[(wallet.name, sent.name)] -= sent_quantity
+        holdings[(wallet.name, received.name)] += received_quantity
+        yield Transaction(day, time, "Order", fee, usd, "Trade", fee_spot_price=1.0,
+                          received_quantity=received_quantity, received_asset=received,
+                          received_spot_price=prices[received.name],
+                          sent_quantity=sent_quantity, sent_asset=sent, sent_spot_price=prices[sent.name],
+                          origin_wallet=wallet, destination_wallet=wallet)
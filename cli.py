@@ -0,0 +1,310 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+# Exit statuses
+EXIT_OK = 0
+EXIT_ERROR = 1  # Bad input data or a failed operation
+EXIT_USAGE = 2  # Raised by argparse for bad arguments
+EXIT_NOT_FOUND = 3  # Portfolio or input file doesn't exist
+EXIT_MISMATCH = 4  # replay --verify found positions that differ from the saved ones
+
+# Heavy modules are imported inside the commands, so --help and argument errors stay fast
+
+class CommandError(Exception):
+    def __init__(self, message, status=EXIT_ERROR):
+        super().__init__(message)
+        self.status = status
+
+@contextlib.contextmanager
+def quiet_output(args):
+    # Transaction processing logs per transaction, --quiet silences it. Rejections are still collected.
+    from events import event_log
+
+    if not args.quiet:
+        yield
+        return
+    with event_log.bulk():
+        yield
+
+def load(path, create=None):
+    from portfolio import Portfolio, load_portfolio_from_file
+
+    if not os.path.exists(path):
+        if create:
+            return Portfolio(create)
+        raise CommandError(f"portfolio file '{path}' not found", EXIT_NOT_FOUND)
+    try:
+        return load_portfolio_from_file(path)
+    except (KeyError, ValueError) as e:
+        raise CommandError(f"could not load '{path}': {e}")
+
+def save(portfolio, path):
+    from portfolio import save_portfolio_to_file
+
+    save_portfolio_to_file(portfolio, path)
+
+def set_prices(path):
+    from portfolio import set_price_provider
+    from prices import HistoricalPriceStore
+
+    if not os.path.exists(path):
+        raise CommandError(f"price history '{path}' not found", EXIT_NOT_FOUND)
+    set_price_provider(HistoricalPriceStore(path))
+
+def snapshot_positions(portfolio):
+    return {
+        wallet.name: sorted((p.asset.name, round(p.quantity, 10), round(p.cost_basis, 6)) for p in wallet.positions)
+        for wallet in portfolio.wallets
+    }
+
+def command_import(args):
+    from importer import import_transactions
+
+    if not os.path.exists(args.file):
+        raise CommandError(f"input file '{args.file}' not found", EXIT_NOT_FOUND)
+    mapping = None
+    if args.mapping:
+        with open(args.mapping, encoding="utf-8") as f:
+            mapping = json.load(f)
+    if args.prices:
+        set_prices(args.prices)
+
+    portfolio = load(args.portfolio, create=args.create)
+    with quiet_output(args):
+        count = import_transactions(portfolio, args.file, mapping, create_missing=not args.no_create)
+    save(portfolio, args.portfolio)
+    print(f"Imported {count} transactions into '{portfolio.name}'.")
+
+def command_replay(args):
+    portfolio = load(args.portfolio)
+    before = snapshot_positions(portfolio)
+    with quiet_output(args):
+        if args.method:
+            try:
+                portfolio.set_cost_basis_method(args.method)
+            except ValueError as e:
+                raise CommandError(str(e))
+        elif args.workers != 1:
+            from parallel import replay_in_parallel
+            replay_in_parallel(portfolio, args.workers)
+        else:
+            portfolio.update_wallet_positions()
+
+    if args.verify:
+        if snapshot_positions(portfolio) != before:
+            raise CommandError("replayed positions differ from the saved positions", EXIT_MISMATCH)
+        print(f"Replayed {len(portfolio.ledger.transactions)} transactions, positions match.")
+        return
+
+    save(portfolio, args.portfolio)
+    print(f"Replayed {len(portfolio.ledger.transactions)} transactions.")
+
+def command_revalue(args):
+    from valuation import Valuation
+
+    portfolio = load(args.portfolio)
+    if args.prices:
+        set_prices(args.prices)
+        updated = portfolio.refresh_market_prices(timestamp=args.at)
+        print(f"Updated market values for {len(updated)} assets.")
+    if args.feed:
+        from price_feed import HttpPriceProvider, refresh_market_prices
+
+        provider = HttpPriceProvider(args.feed, batch_size=args.batch_size, rate_limit=args.rate_limit,
+                                     timeout=args.timeout)
+        updated, missing = refresh_market_prices(portfolio, provider, args.at)
+        print(f"Updated market values for {len(updated)} assets from {args.feed}.")
+        if missing:
+            print(f"No price for: {', '.join(missing)}")
+    valuation = Valuation(portfolio)
+    save(portfolio, args.portfolio)
+    print(f"Total Market Value: {valuation.total_market_value}, Total Cost Basis: {valuation.total_cost_basis}, "
+          f"Unrealized Gain/Loss: {valuation.total_unrealized}")
+
+def command_report(args):
+    from report import build_report, parse_group_by, print_report
+
+    group_by = parse_group_by(args.group_by)
+    portfolio = load(args.portfolio)
+    if group_by:
+        rows = build_report(portfolio, group_by, args.start, args.end, args.asset, args.wallet, args.classification)
+        if args.json:
+            print(json.dumps(rows))
+        else:
+            print_report(rows, group_by)
+        return
+
+    filters = (args.start, args.end, args.asset, args.wallet, args.classification)
+    fees = portfolio.fee_ledger.total_fees(*filters)
+    gains = portfolio.gain_loss_ledger.total_gain_loss(*filters)
+    if args.json:
+        print(json.dumps({"fees": fees, "gain_loss": gains, "net": gains - fees}))
+    else:
+        print(f"Realized Gain/Loss: {gains}, Fees: {fees}, Net: {gains - fees}")
+
+def command_history(args):
+    portfolio = load(args.portfolio)
+    if args.prices:
+        set_prices(args.prices)
+    with quiet_output(args):
+        positions = portfolio.positions_at(args.at)
+        value = portfolio.value_at(args.at)
+    rows = [
+        {"wallet": wallet_name, "asset": position.asset.name, "quantity": position.quantity,
+         "cost_basis": position.cost_basis}
+        for wallet_name, wallet_positions in positions.items() for position in wallet_positions
+    ]
+    if args.json:
+        print(json.dumps({"at": args.at, "value": value, "positions": rows}))
+        return
+    for row in rows:
+        print(f"Wallet: {row['wallet']}, Asset: {row['asset']}, Quantity: {row['quantity']}, "
+              f"Cost Basis: {row['cost_basis']}")
+    print(f"Total Value at {args.at}: {value}")
+
+def command_performance(args):
+    from performance import PerformanceTracker
+
+    portfolio = load(args.portfolio)
+    if args.prices:
+        set_prices(args.prices)
+    tracker = PerformanceTracker(portfolio)
+    with quiet_output(args):
+        tracker.update(args.end)
+    stats = tracker.statistics()
+    if args.json:
+        print(json.dumps(stats))
+        return
+    mwr = stats["money_weighted_return"]
+    print(f"Performance from {stats['start']} to {stats['end']} ({stats['days']} days)")
+    print(f"Final Value: {stats['final_value']}, Time-Weighted Return: {stats['time_weighted_return']:.2%}, "
+          f"Money-Weighted Return: {f'{mwr:.2%}' if mwr is not None else 'N/A'}, "
+          f"Volatility: {stats['volatility']:.2%}, Max Drawdown: {stats['max_drawdown']:.2%}")
+
+def command_export(args):
+    portfolio = load(args.portfolio)
+    save(portfolio, args.output)
+    print(f"Exported '{portfolio.name}' to {args.output}.")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="venture", description="Non-interactive portfolio operations.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="suppress per transaction output")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text",
+                        help="json writes one JSON object per processing event")
+    parser.add_argument("--rejections", metavar="FILE",
+                        help="write every rejected transaction or row here as JSON lines")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="record processing metrics and write them here (.prom for Prometheus text, else JSON)")
+    parser.add_argument("--profile", metavar="FILE", help="sample the call stack and write collapsed stacks here")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="import an exchange CSV/JSONL export")
+    command.add_argument("portfolio", help="portfolio file (.json or binary)")
+    command.add_argument("file", help="CSV or JSONL export")
+    command.add_argument("--mapping", help="JSON file with column name overrides")
+    command.add_argument("--prices", help="price history used to backfill missing spot prices")
+    command.add_argument("--create", metavar="NAME", help="create the portfolio under this name if the file is missing")
+    command.add_argument("--no-create", action="store_true", help="reject rows with unknown assets or wallets")
+    command.set_defaults(handler=command_import)
+
+    command = commands.add_parser("replay", help="rebuild positions from the ledger")
+    command.add_argument("portfolio")
+    command.add_argument("--method", help="switch cost basis method (FIFO, LIFO, HIFO, SPECIFIC)")
+    command.add_argument("--verify", action="store_true", help="only compare with the saved positions, don't save")
+    command.add_argument("--workers", type=int, default=1,
+                         help="replay independent wallets on this many processes, 0 for one per core")
+    command.set_defaults(handler=command_replay)
+
+    command = commands.add_parser("revalue", help="refresh market values and print the valuation")
+    command.add_argument("portfolio")
+    command.add_argument("--prices", help="price history to refresh market values from")
+    command.add_argument("--feed", metavar="URL", help="HTTP price feed to refresh every asset from concurrently")
+    command.add_argument("--batch-size", type=int, default=50, help="assets per feed request")
+    command.add_argument("--rate-limit", type=float, default=20.0, help="feed requests per second")
+    command.add_argument("--timeout", type=float, default=5.0, help="seconds per feed request")
+    command.add_argument("--at", help="timestamp to price at, latest when omitted")
+    command.set_defaults(handler=command_revalue)
+
+    command = commands.add_parser("report", help="realized gain/loss and fees")
+    command.add_argument("portfolio")
+    command.add_argument("--start", help="YYYY-MM-DD[ HH:MM], inclusive")
+    command.add_argument("--end", help="YYYY-MM-DD[ HH:MM], inclusive")
+    command.add_argument("--asset")
+    command.add_argument("--wallet")
+    command.add_argument("--classification")
+    command.add_argument("--group-by", help="comma separated: date, month, year, wallet, asset, classification")
+    command.add_argument("--json", action="store_true", help="print the report as JSON")
+    command.set_defaults(handler=command_report)
+
+    command = commands.add_parser("history", help="positions and value at a past date")
+    command.add_argument("portfolio")
+    command.add_argument("--at", required=True, help="YYYY-MM-DD[ HH:MM]")
+    command.add_argument("--prices", help="price history to value the positions at that date")
+    command.add_argument("--json", action="store_true", help="print the positions as JSON")
+    command.set_defaults(handler=command_history)
+
+    command = commands.add_parser("performance", help="returns, volatility and drawdown of the daily equity curve")
+    command.add_argument("portfolio")
+    command.add_argument("--end", help="YYYY-MM-DD, last transaction's date when omitted")
+    command.add_argument("--prices", help="price history to value each day's positions")
+    command.add_argument("--json", action="store_true", help="print the statistics as JSON")
+    command.set_defaults(handler=command_performance)
+
+    command = commands.add_parser("export", help="write the portfolio to another file or format")
+    command.add_argument("portfolio")
+    command.add_argument("output", help=".json for JSON, anything else for the binary format")
+    command.set_defaults(handler=command_export)
+    return parser
+
+def run(args):
+    # Runs the command with the requested metrics and profiling around it
+    if not args.metrics and not args.profile:
+        args.handler(args)
+        return
+
+    import instrumentation
+
+    profiler = instrumentation.SamplingProfiler().start() if args.profile else None
+    if args.metrics:
+        instrumentation.enable()
+    try:
+        args.handler(args)
+    finally:
+        if args.metrics:
+            instrumentation.disable()
+            instrumentation.write_metrics(args.metrics)
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_collapsed(args.profile)
+
+def write_rejections(path):
+    from events import event_log
+
+    with open(path, "w", encoding="utf-8") as f:
+        for rejection in event_log.take_rejections():
+            f.write(json.dumps(rejection, default=str) + "\n")
+
+def main(argv=None):
+    from events import event_log
+
+    args = build_parser().parse_args(argv)
+    event_log.json_lines = args.log_format == "json"
+    try:
+        run(args)
+    except CommandError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return e.status
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    finally:
+        event_log.flush()
+        if args.rejections:
+            write_rejections(args.rejections)
+    return EXIT_OK
+
+if __name__ == "__main__":
+    sys.exit(main())
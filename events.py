@@ -0,0 +1,105 @@
+import atexit
+import json
+import sys
+from contextlib import contextmanager
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+class EventLog:
+    # Processing messages go through here instead of print(). Each event has a level, a code and
+    # fields; the message template is only formatted when the event is actually written. Output is
+    # buffered unless it goes to a terminal, and rejected transactions are also kept as records.
+    def __init__(self, level=INFO, stream=None, json_lines=False, buffer_size=None):
+        self.level = level
+        self.stream = stream  # None writes to whatever sys.stdout is at flush time
+        self.json_lines = json_lines  # One JSON object per event instead of the plain message
+        self.buffer_size = buffer_size  # Events held before a write, None for 1 on a terminal and 256 otherwise
+        self.buffer = []
+        self.silent = 0  # > 0 inside bulk(), nothing is written
+        self.keep_rejections = True
+        # Transaction key -> rejection records not yet taken, None holds those not about a ledger transaction.
+        # A replay replaces the records of the transactions it goes over instead of adding to them.
+        self.rejections = {}
+        self.rejected = 0  # Rejections seen so far, kept or not
+
+    def output(self):
+        return self.stream if self.stream is not None else sys.stdout
+
+    def log(self, level, code, message, **fields):
+        if self.silent or level < self.level:
+            return
+        if self.json_lines:
+            self.buffer.append(json.dumps({"level": LEVEL_NAMES[level], "code": code, **fields}, default=str))
+        else:
+            self.buffer.append(message.format(**fields))
+
+        size = self.buffer_size
+        if size is None:
+            isatty = getattr(self.output(), "isatty", None)
+            size = 1 if isatty is not None and isatty() else 256
+        if len(self.buffer) >= size or level >= ERROR:
+            self.flush()
+
+    def debug(self, code, message, **fields):
+        self.log(DEBUG, code, message, **fields)
+
+    def info(self, code, message, **fields):
+        self.log(INFO, code, message, **fields)
+
+    def warning(self, code, message, **fields):
+        self.log(WARNING, code, message, **fields)
+
+    def error(self, code, message, **fields):
+        self.log(ERROR, code, message, **fields)
+
+    def reject(self, code, message, key=None, **fields):
+        # Something that could not be applied: logged as a warning and kept as {"code": ..., **fields}
+        self.rejected += 1
+        if self.keep_rejections:
+            self.rejections.setdefault(key, []).append({"code": code, **fields})
+        self.log(WARNING, code, message, **fields)
+
+    def add_rejections(self, rejections):
+        # (key, record) pairs recorded somewhere else, like a worker process
+        for key, rejection in rejections:
+            self.rejected += 1
+            if self.keep_rejections:
+                self.rejections.setdefault(key, []).append(rejection)
+
+    def discard_rejections(self, after=None):
+        # Drops the records of transactions ordered after the key, or of every transaction when it is None
+        for key in [key for key in self.rejections if key is not None and (after is None or key > after)]:
+            del self.rejections[key]
+
+    def take_rejections(self):
+        rejections, self.rejections = self.rejections, {}
+        return [rejection for records in rejections.values() for rejection in records]
+
+    def flush(self):
+        if not self.buffer:
+            return
+        stream = self.output()
+        stream.write("\n".join(self.buffer) + "\n")
+        stream.flush()
+        self.buffer.clear()
+
+    @contextmanager
+    def bulk(self, keep_rejections=True):
+        # Silent mode for replays and imports. Rejections are still recorded unless keep_rejections is
+        # False, which scratch replays use so the same rejection isn't reported twice.
+        self.flush()
+        self.silent += 1
+        outer = self.keep_rejections
+        self.keep_rejections = outer and keep_rejections
+        try:
+            yield self
+        finally:
+            self.silent -= 1
+            self.keep_rejections = outer
+
+event_log = EventLog()
+atexit.register(event_log.flush)
@@ -0,0 +1,191 @@
+import csv
+import json
+
+from events import event_log
+from portfolio import Asset, Transaction, Wallet
+
+# Transaction field -> column name in the export. Override per exchange with a mapping dict.
+DEFAULT_COLUMNS = {
+    "date": "date",
+    "time": "time",
+    "datetime": "datetime",  # Combined "YYYY-MM-DD HH:MM[:SS]" column, used when date is missing
+    "type": "type",
+    "classification": "classification",
+    "wallet": "wallet",
+    "destination_wallet": "destination_wallet",  # Receiving wallet of internal transfers
+    "fee_quantity": "fee_quantity",
+    "fee_asset": "fee_asset",
+    "fee_spot_price": "fee_spot_price",
+    "received_quantity": "received_quantity",
+    "received_asset": "received_asset",
+    "received_spot_price": "received_spot_price",
+    "sent_quantity": "sent_quantity",
+    "sent_asset": "sent_asset",
+    "sent_spot_price": "sent_spot_price",
+}
+
+# Exchange type labels -> transaction types understood by Transaction.process_transaction
+DEFAULT_TYPES = {
+    "deposit": "Deposit",
+    "withdraw": "Withdraw",
+    "withdrawal": "Withdraw",
+    "order": "Order",
+    "trade": "Order",
+    "buy": "Order",
+    "sell": "Order",
+    "transfer": "Internal",
+    "internal": "Internal",
+}
+
+class ColumnMapping:
+    def __init__(self, columns=None, types=None):
+        self.columns = dict(DEFAULT_COLUMNS)
+        if columns:
+            self.columns.update(columns)
+        self.types = dict(DEFAULT_TYPES)
+        if types:
+            self.types.update({label.lower(): transaction_type for label, transaction_type in types.items()})
+
+    def get(self, row, field):
+        value = row.get(self.columns[field])
+        if value is None:
+            return None
+        value = str(value).strip()
+        return value if value else None
+
+    def get_float(self, row, field):
+        value = self.get(row, field)
+        return float(value) if value is not None else None
+
+    def get_type(self, row):
+        label = self.get(row, "type")
+        if label is None:
+            raise ValueError("missing transaction type")
+        transaction_type = self.types.get(label.lower())
+        if transaction_type is None:
+            raise ValueError(f"unknown transaction type '{label}'")
+        return transaction_type
+
+class PortfolioIndex:
+    # Resolves assets and wallets through the portfolio's name indexes, optionally creating the ones that are missing
+    def __init__(self, portfolio, create_missing=True):
+        self.portfolio = portfolio
+        self.create_missing = create_missing
+
+    def asset(self, name, market_value=None):
+        asset = self.portfolio.get_asset(name)
+        if asset is None:
+            if not self.create_missing:
+                raise ValueError(f"unknown asset '{name}'")
+            asset = Asset(name, market_value if market_value is not None else 0.0)
+            self.portfolio.add_asset(asset)
+        return asset
+
+    def wallet(self, name):
+        wallet = self.portfolio.get_wallet(name)
+        if wallet is None:
+            if not self.create_missing:
+                raise ValueError(f"unknown wallet '{name}'")
+            wallet = Wallet(name)
+            self.portfolio.add_wallet(wallet)
+        return wallet
+
+def read_csv_rows(path, delimiter=","):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f, delimiter=delimiter):
+            yield row
+
+def read_jsonl_rows(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def read_rows(path):
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        return read_jsonl_rows(path)
+    return read_csv_rows(path)
+
+def build_transaction(row, mapping, index):
+    transaction_type = mapping.get_type(row)
+
+    date = mapping.get(row, "date")
+    time = mapping.get(row, "time")
+    if date is None:
+        stamp = mapping.get(row, "datetime")
+        if stamp is None:
+            raise ValueError("missing date")
+        # Seconds and a UTC offset are kept, they are part of the transaction's timestamp
+        date, _, time = stamp.strip().replace("T", " ", 1).partition(" ")
+    time = time if time else "00:00"
+
+    fee_quantity = mapping.get_float(row, "fee_quantity") or 0
+    fee_asset = None
+    fee_spot_price = mapping.get_float(row, "fee_spot_price")
+    if fee_quantity > 0:
+        fee_asset_name = mapping.get(row, "fee_asset")
+        if fee_asset_name is None:
+            raise ValueError("fee without a fee asset")
+        fee_asset = index.asset(fee_asset_name, fee_spot_price)
+
+    fields = {}
+    for side in ("received", "sent"):
+        asset_name = mapping.get(row, f"{side}_asset")
+        if asset_name is None:
+            continue
+        quantity = mapping.get_float(row, f"{side}_quantity")
+        if quantity is None:
+            raise ValueError(f"missing {side} quantity")
+        spot_price = mapping.get_float(row, f"{side}_spot_price")
+        asset = index.asset(asset_name, spot_price)
+        if asset.name == "USD":
+            spot_price = 1.0
+        fields[f"{side}_asset"] = asset
+        fields[f"{side}_quantity"] = quantity
+        fields[f"{side}_spot_price"] = spot_price
+
+    if transaction_type in ("Deposit", "Order") and "received_asset" not in fields:
+        raise ValueError(f"{transaction_type} without a received asset")
+    if transaction_type in ("Withdraw", "Order", "Internal") and "sent_asset" not in fields:
+        raise ValueError(f"{transaction_type} without a sent asset")
+
+    wallet_name = mapping.get(row, "wallet")
+    if wallet_name is None:
+        raise ValueError("missing wallet")
+    wallet = index.wallet(wallet_name)
+    if transaction_type != "Deposit":
+        fields["origin_wallet"] = wallet
+    if transaction_type == "Internal":
+        destination_name = mapping.get(row, "destination_wallet")
+        if destination_name is None:
+            raise ValueError("internal transfer without a destination wallet")
+        fields["destination_wallet"] = index.wallet(destination_name)
+    elif transaction_type != "Withdraw":
+        fields["destination_wallet"] = wallet
+
+    return Transaction(
+        date=date, time=time, transaction_type=transaction_type,
+        fee_quantity=fee_quantity, fee_asset=fee_asset, fee_spot_price=fee_spot_price,
+        classification=mapping.get(row, "classification") or "",
+        **fields
+    )
+
+def iter_transactions(portfolio, rows, mapping=None, create_missing=True):
+    # Streams rows into Transaction objects one at a time, rows that can't be parsed are reported and skipped
+    mapping = mapping if isinstance(mapping, ColumnMapping) else ColumnMapping(mapping)
+    index = PortfolioIndex(portfolio, create_missing)
+    for row_number, row in enumerate(rows, 1):
+        try:
+            yield build_transaction(row, mapping, index)
+        except ValueError as e:
+            event_log.reject("invalid_row", "Skipping row {row}: {error}", row=row_number, error=str(e))
+
+def import_transactions(portfolio, path, mapping=None, create_missing=True):
+    # Every row goes through the deferred ledger path so the whole file costs a single replay
+    count = 0
+    with portfolio.ledger.deferred_replay():
+        for transaction in iter_transactions(portfolio, read_rows(path), mapping, create_missing):
+            portfolio.ledger.add_transaction(transaction)
+            count += 1
+    return count
@@ -0,0 +1,243 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounts
+from functools import wraps
+
+from portfolio import FeeLedger, GainLossLedger, Portfolio, Position, Transaction, Wallet
+
+# Counters, timers and histograms for transaction processing. Nothing is measured until enable(),
+# which wraps the hot path methods with timed versions; disable() puts the originals back, so a
+# disabled build runs exactly the uninstrumented code.
+
+enabled = False
+
+# Upper bounds in seconds, 1us to ~4s in powers of 4
+DURATION_BUCKETS = tuple(1e-6 * 4 ** i for i in range(12))
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}  # Label values tuple -> count
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def to_dict(self):
+        return [{"labels": dict(zip(self.label_names, labels)), "value": value} for labels, value in self.values.items()]
+
+    def prometheus_lines(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.label_names, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}  # Label values tuple -> [per bucket counts (last one is +Inf), sum, count]
+
+    def observe(self, labels, value):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def to_dict(self):
+        return [
+            {"labels": dict(zip(self.label_names, labels)), "buckets": dict(zip(map(str, self.buckets), counts)),
+             "overflow": counts[-1], "sum": total, "count": count}
+            for labels, (counts, total, count) in self.values.items()
+        ]
+
+    def prometheus_lines(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = bound if isinstance(bound, str) else f"{bound:g}"
+                yield f"{self.name}_bucket{format_labels(self.label_names + ('le',), labels + (le,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.label_names, labels)} {count}"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help_text, label_names=()):
+        return self.metrics.setdefault(name, Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DURATION_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help_text, label_names, buckets))
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.values.clear()
+
+    def to_dict(self):
+        return {name: metric.to_dict() for name, metric in self.metrics.items()}
+
+    def prometheus_text(self):
+        return "\n".join(line for metric in self.metrics.values() for line in metric.prometheus_lines()) + "\n"
+
+registry = Registry()
+transactions = registry.counter("venture_transactions_total", "Transactions processed", ("type",))
+transaction_seconds = registry.histogram("venture_transaction_seconds", "Time to process one transaction", ("type",))
+phase_seconds = registry.histogram("venture_phase_seconds", "Time spent per processing phase", ("phase", "type"))
+replays = registry.counter("venture_replays_total", "Replays from a checkpoint or from the start")
+replayed_transactions = registry.counter("venture_replayed_transactions_total", "Transactions re-processed by replays")
+replay_seconds = registry.histogram("venture_replay_seconds", "Time per replay")
+
+# Processing phase -> methods whose time counts towards it
+PHASES = {
+    "lookup": ((Portfolio, "get_wallet"), (Wallet, "get_position")),
+    "position_update": ((Position, "dispose"), (Wallet, "add_position"), (Wallet, "remove_position")),
+    "fee_entry": ((FeeLedger, "add_fee_entry"), (FeeLedger, "remove_fee_entry")),
+    "gain_loss_entry": ((GainLossLedger, "add_entry"),),
+}
+
+current_type = ""  # Type of the transaction being processed, phases outside processing get ""
+originals = []  # (class, attribute, original function) of every wrapped method
+
+def timed_phase(phase, function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            phase_seconds.observe((phase, current_type), time.perf_counter() - start)
+    return wrapper
+
+def timed_process(function):
+    @wraps(function)
+    def wrapper(self, portfolio):
+        global current_type
+        outer, current_type = current_type, self.transaction_type
+        start = time.perf_counter()
+        try:
+            return function(self, portfolio)
+        finally:
+            transaction_seconds.observe((self.transaction_type,), time.perf_counter() - start)
+            transactions.inc((self.transaction_type,))
+            current_type = outer
+    return wrapper
+
+def timed_replay(function):
+    @wraps(function)
+    def wrapper(self, index):
+        count = len(self.ledger.transactions)
+        start = time.perf_counter()
+        # The replay restarts at the checkpoint before index, everything from there is processed again
+        replayed_from = index
+        try:
+            replayed_from = function(self, index)
+            return replayed_from
+        finally:
+            replay_seconds.observe((), time.perf_counter() - start)
+            replays.inc()
+            replayed_transactions.inc((), max(0, count - replayed_from))
+    return wrapper
+
+def wrap(cls, name, wrapper):
+    original = cls.__dict__[name]
+    originals.append((cls, name, original))
+    setattr(cls, name, wrapper(original))
+
+def enable():
+    global enabled
+    if enabled:
+        return
+    for phase, methods in PHASES.items():
+        for cls, name in methods:
+            wrap(cls, name, lambda function, phase=phase: timed_phase(phase, function))
+    wrap(Transaction, "process_transaction", timed_process)
+    wrap(Portfolio, "replay_from", timed_replay)
+    enabled = True
+
+def disable():
+    global enabled
+    while originals:
+        cls, name, original = originals.pop()
+        setattr(cls, name, original)
+    enabled = False
+
+def write_metrics(path):
+    # .prom/.txt files get the Prometheus text format, anything else JSON
+    if path.endswith((".prom", ".txt")):
+        text = registry.prometheus_text()
+    else:
+        text = json.dumps(registry.to_dict(), indent=2)
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp, path)
+
+class SamplingProfiler:
+    # Background thread that snapshots another thread's stack every `interval` seconds through
+    # sys._current_frames(). Costs nothing to the profiled thread beyond the GIL hand-offs, and
+    # nothing at all unless started. Stacks are kept in collapsed form for flame graph tools.
+    def __init__(self, interval=0.005, thread_id=None, max_depth=64):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.max_depth = max_depth
+        self.stacks = StackCounts()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="venture-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < self.max_depth:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def top(self, limit=10):
+        # Functions most often on top of the stack: (name, samples)
+        leaves = StackCounts()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+    def write_collapsed(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
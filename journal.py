@@ -0,0 +1,190 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+import storage
+from portfolio import SEQUENCE_LIMIT, Asset, Wallet, to_timestamp, transaction_key
+
+# Write-ahead log of every change to a portfolio: one JSON object per line, appended before or as the
+# change is applied. Recovery loads the last snapshot (a saved portfolio file, which remembers the
+# sequence number of the last change it contains) and replays the records after it. Saving to the
+# snapshot file truncates the log, so it only ever holds the changes since the last save.
+
+def journal_path(snapshot_path):
+    return snapshot_path + ".wal"
+
+def asset_to_dict(asset):
+    return {"name": asset.name, "market_value": asset.market_value}
+
+# Event -> encoder of the objects passed to Portfolio.record
+ENCODERS = {
+    "add_asset": asset_to_dict,
+    "remove_asset": lambda asset: {"name": asset.name},
+    "update_asset": lambda asset, market_value: {"name": asset.name, "market_value": market_value},
+    "add_pool": storage.pool_to_dict,
+    "update_pool": lambda pool, reserves, total_supply: {
+        "name": pool.name, "reserves": list(reserves), "total_supply": total_supply,
+    },
+    "add_wallet": lambda wallet: {"name": wallet.name},
+    "remove_wallet": lambda wallet: {"name": wallet.name},
+    "add_transaction": lambda transaction: {"transaction": storage.transaction_to_dict(transaction)},
+    "remove_transaction": lambda transaction: {"transaction": storage.transaction_to_dict(transaction)},
+    "edit_transaction": lambda transaction, replacement: {
+        "transaction": storage.transaction_to_dict(transaction),
+        "replacement": storage.transaction_to_dict(replacement),
+    },
+    "set_cost_basis_method": lambda method: {"method": method},
+}
+
+def read_journal(path):
+    # Returns the complete records and the size of the file up to the last one. A crash can leave a
+    # partly written last line behind, it and anything after it is ignored.
+    records = []
+    valid_size = 0
+    if not os.path.exists(path):
+        return records, valid_size
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            records.append(record)
+            valid_size += len(line)
+    return records, valid_size
+
+class Journal:
+    # Every record is handed to the OS as soon as it is written, so it survives the process dying.
+    # fsyncs, which make it survive the machine going down too, are batched: every `sync_every` records,
+    # and at the latest `sync_interval` seconds after the first unsynced one, whether or not anything
+    # else gets written. sync() forces one.
+    def __init__(self, snapshot_path, portfolio, sync_every=100, sync_interval=1.0):
+        self.snapshot_path = snapshot_path  # Saving the portfolio here truncates the journal
+        self.path = journal_path(snapshot_path)
+        self.portfolio = portfolio
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()  # The sync timer runs on its own thread
+        self.timer = None
+
+        _, valid_size = read_journal(self.path)
+        self.file = open(self.path, "ab")
+        if self.file.tell() != valid_size:
+            self.file.truncate(valid_size)
+            self.file.seek(valid_size)
+
+    def record(self, event, *subjects):
+        self.portfolio.journal_sequence += 1
+        record = {"seq": self.portfolio.journal_sequence, "event": event, "data": ENCODERS[event](*subjects)}
+        with self.lock:
+            self.file.write(json.dumps(record).encode("utf-8") + b"\n")
+            self.file.flush()
+            self.unsynced += 1
+            due = self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval
+        if due:
+            self.sync()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.sync_interval, self.sync)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def sync(self):
+        with self.lock:
+            if self.timer is not None and self.timer is not threading.current_thread():
+                self.timer.cancel()
+            self.timer = None
+            if self.file.closed:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+    def truncate(self):
+        # Called once a snapshot holding every journaled change is on disk
+        with self.lock:
+            self.file.truncate(0)
+            self.file.seek(0)
+        self.sync()
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            self.file.close()
+        if self.portfolio.journal is self:
+            self.portfolio.journal = None
+
+def find_transaction(ledger, data):
+    # The ledger transaction (or one waiting in a deferred batch) matching a journaled transaction
+    transactions = ledger.transactions
+    timestamp = to_timestamp(data["date"], data["time"])
+    low = bisect.bisect_left(transactions, timestamp * SEQUENCE_LIMIT, key=transaction_key)
+    high = bisect.bisect_left(transactions, (timestamp + 1) * SEQUENCE_LIMIT, key=transaction_key)
+    for transaction in transactions[low:high] + ledger.pending:
+        if storage.transaction_to_dict(transaction) == data:
+            return transaction
+    raise ValueError(f"journaled transaction on {data['date']} {data['time']} is not in the ledger")
+
+def apply_record(portfolio, record):
+    event = record["event"]
+    data = record["data"]
+    ledger = portfolio.ledger
+
+    def transaction(key):
+        return storage.transaction_from_dict(data[key], portfolio.asset_index, portfolio.wallet_index)
+
+    if event == "add_asset":
+        asset = portfolio.get_asset(data["name"])
+        if asset is None:
+            portfolio.add_asset(Asset(data["name"], data["market_value"]))
+        else:
+            asset.market_value = data["market_value"]
+    elif event == "remove_asset":
+        portfolio.remove_asset(portfolio.get_asset(data["name"]))
+    elif event == "update_asset":
+        portfolio.set_market_value(portfolio.get_asset(data["name"]), data["market_value"])
+    elif event == "add_pool":
+        portfolio.add_pool(storage.pool_from_dict(data, portfolio.asset_index))
+    elif event == "update_pool":
+        portfolio.set_pool_state(portfolio.get_pool(data["name"]), data["reserves"], data["total_supply"])
+    elif event == "add_wallet":
+        portfolio.add_wallet(Wallet(data["name"]))
+    elif event == "remove_wallet":
+        portfolio.remove_wallet(portfolio.get_wallet(data["name"]))
+    elif event == "add_transaction":
+        ledger.add_transaction(transaction("transaction"))
+    elif event == "remove_transaction":
+        ledger.remove_transaction(find_transaction(ledger, data["transaction"]))
+    elif event == "edit_transaction":
+        ledger.edit_transaction(find_transaction(ledger, data["transaction"]), transaction("replacement"))
+    elif event == "set_cost_basis_method":
+        portfolio.set_cost_basis_method(data["method"])
+    else:
+        raise ValueError(f"unknown journal event '{event}'")
+
+def recover(snapshot_path):
+    # Latest snapshot plus every journaled change after it. Transactions are merged and replayed once.
+    portfolio = storage.load_portfolio(snapshot_path)
+    records, _ = read_journal(journal_path(snapshot_path))
+    with portfolio.ledger.deferred_replay():
+        for record in records:
+            if record["seq"] <= portfolio.journal_sequence:
+                continue  # Already in the snapshot
+            apply_record(portfolio, record)
+            portfolio.journal_sequence = record["seq"]
+    # Journaled price changes don't revalue the pools one by one
+    portfolio.revalue_pools()
+    return portfolio
+
+def attach_journal(portfolio, snapshot_path, **options):
+    # Starts journaling changes next to the snapshot file, replacing any journal already attached
+    if portfolio.journal is not None:
+        portfolio.journal.close()
+    portfolio.journal = Journal(snapshot_path, portfolio, **options)
+    return portfolio.journal
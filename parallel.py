@@ -0,0 +1,154 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import storage
+from events import event_log
+from portfolio import Asset, Portfolio, Wallet
+
+# Below this many transactions the process start-up costs more than the replay itself
+MIN_PARALLEL_TRANSACTIONS = 10000
+
+def partition_by_wallet(transactions):
+    # Groups wallets that share a transaction (internal transfers) with a union-find, then splits the
+    # ledger so every group holds every transaction touching its wallets. Returns lists of ledger indexes.
+    parent = {}
+
+    def find(name):
+        root = name
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+        while parent[name] != root:
+            parent[name], name = root, parent[name]
+        return root
+
+    for transaction in transactions:
+        names = [w.name for w in (transaction.origin_wallet, transaction.destination_wallet) if w is not None]
+        for name in names:
+            find(name)
+        if len(names) == 2:
+            a, b = find(names[0]), find(names[1])
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+    groups = {}
+    for index, transaction in enumerate(transactions):
+        wallet = transaction.origin_wallet or transaction.destination_wallet
+        root = find(wallet.name) if wallet is not None else None
+        groups.setdefault(root, []).append(index)
+    # Deterministic order, largest groups first so the pool stays busy
+    return sorted(groups.values(), key=lambda indexes: (-len(indexes), indexes[0]))
+
+class EntryCollector:
+    # Stands in for the gain/loss or fee ledger inside a worker, remembers which transaction emitted each entry
+    def __init__(self, encode):
+        self.encode = encode
+        self.index = None
+        self.entries = []
+
+    def add_entry(self, entry):
+        self.entries.append((self.index, self.encode(entry)))
+
+    add_fee_entry = add_entry
+
+def replay_group(job):
+    # Runs in a worker process on plain data, so no live objects have to be pickled
+    assets_data, wallet_names, method, items = job
+    portfolio = Portfolio("replay")
+    portfolio.cost_basis_method = method
+    for name, market_value in assets_data:
+        if portfolio.get_asset(name) is None:
+            portfolio.add_asset(Asset(name, market_value))
+    collector = portfolio.gain_loss_ledger = EntryCollector(storage.gain_loss_entry_to_dict)
+    fee_collector = portfolio.fee_ledger = EntryCollector(storage.fee_entry_to_dict)
+
+    wallets = {}
+    for name in wallet_names:
+        wallet = Wallet(name)
+        portfolio.add_wallet(wallet)
+        wallets[name] = wallet
+
+    rejections = []  # (ledger index, rejection record), sent back since the worker's event log is its own
+    event_log.take_rejections()  # A forked worker starts with a copy of the parent's untaken records
+    with event_log.bulk():
+        for index, data in items:
+            # Wallets the parent portfolio no longer has resolve to detached objects, so the lookup
+            # during processing fails the same way it does in a serial replay
+            for key in ("origin_wallet", "destination_wallet"):
+                name = data.get(key)
+                if name is not None and name not in wallets:
+                    wallets[name] = Wallet(name)
+            transaction = storage.transaction_from_dict(data, portfolio.asset_index, wallets)
+            collector.index = fee_collector.index = index
+            transaction.process_transaction(portfolio)
+            if event_log.rejections:
+                rejections.extend((index, rejection) for rejection in event_log.take_rejections())
+
+    positions = {
+        wallet.name: [storage.position_to_dict(position) for position in wallet.positions]
+        for wallet in portfolio.wallets
+    }
+    return positions, collector.entries, fee_collector.entries, rejections
+
+def replay_in_parallel(portfolio, max_workers=None):
+    # Same result as Portfolio.update_wallet_positions, with independent wallet groups replayed on a process pool
+    transactions = portfolio.ledger.transactions
+    groups = partition_by_wallet(transactions)
+    max_workers = max_workers or os.cpu_count() or 1
+    if len(groups) < 2 or max_workers < 2 or len(transactions) < MIN_PARALLEL_TRANSACTIONS:
+        portfolio.update_wallet_positions()
+        return
+
+    # Transactions can still reference assets that were removed from the portfolio
+    assets = dict(portfolio.asset_index)
+    for transaction in transactions:
+        for asset in (transaction.fee_asset, transaction.received_asset, transaction.sent_asset):
+            if asset is not None:
+                assets.setdefault(asset.name, asset)
+        for asset, _, _ in transaction.pool_amounts or ():
+            assets.setdefault(asset.name, asset)
+    # Pools go over as plain assets, processing only needs their names and positions come back as data
+    assets_data = [(asset.name, asset.market_value) for asset in assets.values()]
+
+    jobs = []
+    for indexes in groups:
+        items = [(index, storage.transaction_to_dict(transactions[index])) for index in indexes]
+        wallet_names = sorted({
+            name for _, data in items for name in (data["origin_wallet"], data["destination_wallet"])
+            if name is not None and portfolio.get_wallet(name) is not None
+        })
+        jobs.append((assets_data, wallet_names, portfolio.cost_basis_method, items))
+
+    event_log.flush()  # Forked workers would otherwise write the parent's buffered events again
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        results = list(pool.map(replay_group, jobs))
+
+    # Merge back in ledger order, independent of which worker finished first
+    positions = {}
+    gain_loss_entries = []
+    fee_entries = []
+    rejections = []
+    for group_positions, group_entries, group_fee_entries, group_rejections in results:
+        positions.update(group_positions)
+        gain_loss_entries.extend(group_entries)
+        fee_entries.extend(group_fee_entries)
+        rejections.extend(group_rejections)
+    gain_loss_entries.sort(key=lambda item: item[0])
+    fee_entries.sort(key=lambda item: item[0])
+    rejections.sort(key=lambda item: item[0])
+
+    portfolio.checkpoints.clear()
+    portfolio.saved_checkpoints = 0
+    for wallet in portfolio.wallets:
+        wallet.clear_positions()
+        for data in positions.get(wallet.name, []):
+            wallet.add_position(storage.position_from_dict(data, assets, portfolio.cost_basis_method))
+    portfolio.gain_loss_ledger.set_entries(
+        storage.gain_loss_entry_from_dict(data, portfolio) for _, data in gain_loss_entries
+    )
+    portfolio.fee_ledger.set_entries(storage.fee_entry_from_dict(data, portfolio) for _, data in fee_entries)
+    # Same records and summary as a serial replay
+    event_log.discard_rejections()
+    event_log.add_rejections((transactions[index].key, rejection) for index, rejection in rejections)
+    if rejections:
+        event_log.warning("replay_rejections", "{count} transactions were rejected during the replay.",
+                          count=len(rejections))
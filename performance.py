@@ -0,0 +1,197 @@
+import math
+from datetime import date, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, the pure Python path below gives the same numbers
+    np = None
+
+import portfolio as portfolio_module
+from events import event_log
+from portfolio import Portfolio, Wallet
+
+DAYS_PER_YEAR = 365  # Crypto markets trade every day
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def external_flow(transaction):
+    # Value moved into (+) or out of (-) the portfolio by a transaction, orders and transfers move nothing
+    if transaction.transaction_type == "Deposit":
+        return transaction.received_total_value
+    if transaction.transaction_type == "Withdraw":
+        return -transaction.sent_total_value
+    return 0
+
+def utc_date(timestamp):
+    return date.fromordinal(EPOCH_ORDINAL + timestamp // portfolio_module.DAY_SECONDS)
+
+class PerformanceTracker:
+    # Builds a daily equity curve by streaming the ledger once through a private replay, valuing the
+    # positions at the end of every day. The curve is extended incrementally, appending new days only
+    # replays the transactions since the last update. An edit before the last processed transaction
+    # starts the curve over.
+    def __init__(self, portfolio, provider=None):
+        self.portfolio = portfolio
+        self.provider = provider  # Defaults to the module wide price provider
+        self.reset()
+        portfolio.ledger.observers.append(self)
+
+    def close(self):
+        self.portfolio.ledger.observers.remove(self)
+
+    def reset(self):
+        self.state = Portfolio(self.portfolio.name)
+        self.state.cost_basis_method = self.portfolio.cost_basis_method
+        for asset in self.portfolio.assets:
+            if self.state.get_asset(asset.name) is None:
+                self.state.add_asset(asset)
+        self.processed = 0  # Ledger transactions already applied to self.state
+        self.days = []
+        self.equity = []  # Portfolio value at the end of each day
+        self.flows = []  # Net external flow during each day
+        self.dirty = False
+        self.cached_statistics = None
+
+    def ledger_changed(self, index):
+        if index < self.processed:
+            self.dirty = True
+
+    def price(self, asset, day):
+        provider = self.provider or portfolio_module.price_provider
+        if provider is not None:
+            price = provider.get_price(asset.name, f"{day.isoformat()} 23:59")
+            if price is not None:
+                return price
+        return asset.market_value
+
+    def day_end_value(self, day):
+        prices = {}
+        total = 0
+        for wallet in self.state.wallets:
+            for position in wallet.positions:
+                name = position.asset.name
+                if name not in prices:
+                    prices[name] = self.price(position.asset, day)
+                total += position.quantity * prices[name]
+        return total
+
+    def update(self, end=None):
+        # Extends the curve through `end` (a date or "YYYY-MM-DD"), by default the last transaction's date
+        if self.dirty or self.state.cost_basis_method != self.portfolio.cost_basis_method:
+            self.reset()
+
+        transactions = self.portfolio.ledger.transactions
+        if not transactions:
+            return
+        # Wallets that no longer exist in the portfolio stay missing, so their transactions fail like in a replay
+        for wallet in self.portfolio.wallets:
+            if self.state.get_wallet(wallet.name) is None:
+                self.state.add_wallet(Wallet(wallet.name))
+        if end is None:
+            end = utc_date(transactions[-1].timestamp)
+        elif isinstance(end, str):
+            end = date.fromisoformat(end)
+
+        day = self.days[-1] + timedelta(days=1) if self.days else utc_date(transactions[0].timestamp)
+        while day <= end:
+            flow = 0
+            day_end = portfolio_module.day_start(day.isoformat()) + portfolio_module.DAY_SECONDS
+            # The live replay already reported these transactions' rejections
+            with event_log.bulk(keep_rejections=False):
+                while self.processed < len(transactions) and transactions[self.processed].timestamp < day_end:
+                    transaction = transactions[self.processed]
+                    transaction.process_transaction(self.state)
+                    flow += external_flow(transaction)
+                    self.processed += 1
+            self.days.append(day)
+            self.equity.append(self.day_end_value(day))
+            self.flows.append(flow)
+            self.cached_statistics = None
+            day += timedelta(days=1)
+
+    def daily_returns(self):
+        # Return of each day with that day's flows taken out, days that start from zero value are skipped
+        if np is not None:
+            equity = np.array(self.equity, dtype=np.float64)
+            flows = np.array(self.flows, dtype=np.float64)
+            previous = equity[:-1]
+            mask = previous > 0
+            return ((equity[1:] - flows[1:])[mask] / previous[mask]) - 1.0
+        return [
+            (self.equity[i] - self.flows[i]) / self.equity[i - 1] - 1.0
+            for i in range(1, len(self.equity)) if self.equity[i - 1] > 0
+        ]
+
+    def money_weighted_return(self):
+        # Annualized internal rate of return of the external flows plus the final value, by bisection
+        if not self.days:
+            return None
+        start = self.days[0]
+        times = [(day - start).days / DAYS_PER_YEAR for day in self.days]
+        # Investor's view: deposits are paid in (negative), withdrawals and the final value are received
+        cash_flows = [-flow for flow in self.flows]
+        cash_flows[-1] += self.equity[-1]
+        if not any(cf < 0 for cf in cash_flows) or not any(cf > 0 for cf in cash_flows):
+            return None
+
+        if np is not None:
+            times_array = np.array(times)
+            flows_array = np.array(cash_flows)
+
+            def npv(rate):
+                return float((flows_array / (1.0 + rate) ** times_array).sum())
+        else:
+            def npv(rate):
+                return sum(cf / (1.0 + rate) ** t for cf, t in zip(cash_flows, times))
+
+        low, high = -0.9999, 1.0
+        while npv(high) > 0 and high < 1e6:
+            high *= 2
+        if npv(low) * npv(high) > 0:
+            return None
+        for _ in range(200):
+            middle = (low + high) / 2
+            if npv(low) * npv(middle) <= 0:
+                high = middle
+            else:
+                low = middle
+            if high - low < 1e-10:
+                break
+        return (low + high) / 2
+
+    def statistics(self):
+        if self.cached_statistics is not None:
+            return self.cached_statistics
+
+        returns = self.daily_returns()
+        n = len(returns)
+        if np is not None and n:
+            growth = np.cumprod(1.0 + returns)
+            twr = float(growth[-1] - 1.0)
+            volatility = float(returns.std(ddof=1) * math.sqrt(DAYS_PER_YEAR)) if n > 1 else 0.0
+            index = np.concatenate(([1.0], growth))
+            max_drawdown = float((1.0 - index / np.maximum.accumulate(index)).max())
+        elif n:
+            twr = 1.0
+            peak = 1.0
+            max_drawdown = 0.0
+            for r in returns:
+                twr *= 1.0 + r
+                peak = max(peak, twr)
+                max_drawdown = max(max_drawdown, 1.0 - twr / peak)
+            twr -= 1.0
+            mean = sum(returns) / n
+            volatility = math.sqrt(sum((r - mean) ** 2 for r in returns) / (n - 1) * DAYS_PER_YEAR) if n > 1 else 0.0
+        else:
+            twr, volatility, max_drawdown = 0.0, 0.0, 0.0
+
+        self.cached_statistics = {
+            "start": self.days[0].isoformat() if self.days else None,
+            "end": self.days[-1].isoformat() if self.days else None,
+            "days": len(self.days),
+            "final_value": self.equity[-1] if self.equity else 0,
+            "time_weighted_return": twr,
+            "money_weighted_return": self.money_weighted_return(),
+            "volatility": volatility,
+            "max_drawdown": max_drawdown,
+        }
+        return self.cached_statistics
@@ -1,7 +1,26 @@
 import json
-from datetime import datetime
+import sys
+import bisect
+import heapq
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from operator import attrgetter
+
+from events import event_log
 #version = 0.0.2
 
+# Source of historical and current prices, see prices.PriceProvider. None means asset market values only.
+price_provider = None
+
+def set_price_provider(provider):
+    global price_provider
+    price_provider = provider
+
+def intern(string):
+    return sys.intern(string) if isinstance(string, str) else string
+
 class Asset:
     def __init__(self, name, market_value):
         self.name = name
@@ -10,18 +29,292 @@ class Asset:
     def __str__(self):
         return f"Asset(name={self.name}, market_value={self.market_value})"
 
+class Pool(Asset):
+    # A liquidity pool, and the asset its LP shares are held in. Reserves and supply are market data like
+    # a price, set from outside and never changed by transactions. market_value is the value of one share,
+    # recomputed from the underlying prices by valuation.PoolValuation (Portfolio.revalue_pools).
+    def __init__(self, name, assets, reserves, total_supply, market_value=0.0):
+        super().__init__(name, market_value)
+        self.assets = []  # Underlying assets
+        self.reserves = []  # Quantity of each underlying asset the pool holds
+        self.total_supply = 0  # LP shares outstanding
+        self.set_state(reserves, total_supply, assets)
+
+    def set_state(self, reserves, total_supply, assets=None):
+        assets = self.assets if assets is None else list(assets)
+        if len(reserves) != len(assets):
+            raise ValueError(f"pool '{self.name}' has {len(assets)} assets but {len(reserves)} reserves")
+        if total_supply < 0:
+            raise ValueError(f"pool '{self.name}' can't have a negative supply")
+        self.assets = assets
+        self.reserves = [float(reserve) for reserve in reserves]
+        self.total_supply = total_supply
+
+    def share_of_supply(self, shares):
+        return shares / self.total_supply if self.total_supply > 0 else 0
+
+    def underlying(self, shares):
+        # Asset name -> quantity the shares stand for
+        share = self.share_of_supply(shares)
+        return {asset.name: share * reserve for asset, reserve in zip(self.assets, self.reserves)}
+
+    def __str__(self):
+        composition = ", ".join(f"{reserve} {asset.name}" for asset, reserve in zip(self.assets, self.reserves))
+        return f"Pool(name={self.name}, reserves=[{composition}], total_supply={self.total_supply}, " + \
+               f"share_value={self.market_value})"
+
+QUANTITY_EPSILON = 1e-12  # Lot remainders smaller than this are treated as fully consumed
+
+# Dates and times are kept as entered for display, ordering uses epoch seconds parsed from them.
+# Times may carry a UTC offset ("14:30+02:00", "14:30Z"), times without one are UTC.
+DAY_SECONDS = 86400
+SEQUENCE_LIMIT = 1 << 32  # Ordering keys are timestamp * SEQUENCE_LIMIT + sequence
+
+@lru_cache(maxsize=65536)
+def day_start(day):
+    # "YYYY-MM-DD" -> epoch seconds at 00:00 UTC
+    try:
+        return int(datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid date '{day}', expected YYYY-MM-DD") from None
+
+@lru_cache(maxsize=65536)
+def time_of_day(time):
+    # "HH:MM[:SS][offset]" -> seconds from 00:00 UTC, outside 0..86399 when an offset crosses midnight
+    if not time:
+        return 0
+    try:
+        moment = datetime.fromisoformat(f"1970-01-01T{time}")
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid time '{time}', expected HH:MM[:SS] with an optional UTC offset") from None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+def to_timestamp(day, time=""):
+    return day_start(day) + time_of_day(time)
+
+def parse_moment(value, upper=False):
+    # "YYYY-MM-DD" or "YYYY-MM-DD HH:MM[:SS]" -> epoch seconds. A bare date is its first second, or its
+    # last one when upper, so it covers the whole day as a range bound.
+    day, _, time = value.strip().partition(" ")
+    if time:
+        return to_timestamp(day, time)
+    return day_start(day) + (DAY_SECONDS - 1 if upper else 0)
+
+@lru_cache(maxsize=65536)
+def day_label(day_number):
+    # Days since the epoch -> "YYYY-MM-DD"
+    return datetime.fromtimestamp(day_number * DAY_SECONDS, timezone.utc).strftime("%Y-%m-%d")
+
+transaction_key = attrgetter("key")
+
+def holding_period_days(date_acquired, date_disposed):
+    try:
+        return (parse_moment(date_disposed) - parse_moment(date_acquired)) // DAY_SECONDS
+    except (AttributeError, ValueError):
+        return None
+
+class Lot:
+    # A single acquisition of an asset, disposals consume lots in the order of the cost basis method
+    __slots__ = ("lot_id", "quantity", "cost_basis", "date_acquired", "unit_cost")
+
+    def __init__(self, lot_id, quantity, cost_basis, date_acquired, unit_cost=None):
+        self.lot_id = lot_id
+        self.quantity = quantity
+        self.cost_basis = cost_basis
+        self.date_acquired = date_acquired
+        # Unit cost at acquisition, fixed for the life of the lot. Partial disposals move
+        # cost_basis / quantity by a few ulps, HIFO orders by this so copies, loads and transfers agree.
+        self.unit_cost = unit_cost if unit_cost is not None else self.cost_basis_per_unit()
+
+    def copy(self):
+        return Lot(self.lot_id, self.quantity, self.cost_basis, self.date_acquired, self.unit_cost)
+
+    def cost_basis_per_unit(self):
+        return self.cost_basis / self.quantity if self.quantity > 0 else 0
+
+    def __str__(self):
+        return (f"Lot(id={self.lot_id}, quantity={self.quantity}, cost_basis={self.cost_basis}, " +
+                f"date_acquired={self.date_acquired})")
+
+class FifoLotQueue:
+    # Oldest lot first. Subclasses only change which lot is consumed next.
+    method = "FIFO"
+
+    def __init__(self):
+        self.lots = deque()
+
+    def __iter__(self):
+        return iter(self.lots)
+
+    def __len__(self):
+        return len(self.lots)
+
+    def add(self, lot):
+        self.lots.append(lot)
+
+    def peek(self):
+        return self.lots[0]
+
+    def pop(self):
+        self.lots.popleft()
+
+    def take(self, lot_ids):
+        # Specific lots only exist for SpecificIdLotQueue
+        return None
+
+    def copy(self):
+        queue = type(self)()
+        for lot in self:
+            queue.add(lot.copy())
+        return queue
+
+class LifoLotQueue(FifoLotQueue):
+    method = "LIFO"
+
+    def peek(self):
+        return self.lots[-1]
+
+    def pop(self):
+        self.lots.pop()
+
+class HifoLotQueue(FifoLotQueue):
+    # Highest unit cost at acquisition first, ties go to the lower lot id
+    method = "HIFO"
+
+    def __init__(self):
+        self.heap = []
+
+    def __iter__(self):
+        return (lot for _, _, lot in sorted(self.heap))
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, lot):
+        heapq.heappush(self.heap, (-lot.unit_cost, lot.lot_id, lot))
+
+    def peek(self):
+        return self.heap[0][2]
+
+    def pop(self):
+        heapq.heappop(self.heap)
+
+class SpecificIdLotQueue(FifoLotQueue):
+    # Lots named by the transaction are consumed first, anything left over falls back to FIFO
+    method = "SPECIFIC"
+
+    def __init__(self):
+        self.lots = {}  # Lot id -> Lot, in acquisition order
+        # Lot ids in acquisition order, ids of lots taken by remove() stay until they reach the front.
+        # Finding the first key of a dict is O(n) once many keys before it were deleted.
+        self.order = deque()
+
+    def __iter__(self):
+        return iter(self.lots.values())
+
+    def add(self, lot):
+        self.lots[lot.lot_id] = lot
+        self.order.append(lot.lot_id)
+
+    def peek(self):
+        while self.order[0] not in self.lots:
+            self.order.popleft()
+        return self.lots[self.order[0]]
+
+    def pop(self):
+        del self.lots[self.peek().lot_id]
+        self.order.popleft()
+
+    def take(self, lot_ids):
+        for lot_id in lot_ids:
+            lot = self.lots.get(lot_id)
+            if lot is not None:
+                return lot
+        return None
+
+    def remove(self, lot):
+        del self.lots[lot.lot_id]
+        if len(self.order) > 2 * len(self.lots) + 32:
+            # Mostly dead ids, start over from the dict, which keeps acquisition order
+            self.order = deque(self.lots)
+
+COST_BASIS_METHODS = {queue.method: queue for queue in (FifoLotQueue, LifoLotQueue, HifoLotQueue, SpecificIdLotQueue)}
+
 class Position:
-    def __init__(self, asset: Asset, quantity, date_acquired, cost_basis):
+    __slots__ = ("asset", "quantity", "date_acquired", "cost_basis", "lots", "next_lot_id")
+
+    def __init__(self, asset: Asset, quantity, date_acquired, cost_basis, method="FIFO"):
         self.asset = asset
-        self.quantity = quantity
+        self.quantity = 0
         self.date_acquired = date_acquired
-        self.cost_basis = cost_basis
-        self.spot_price = asset.market_value
+        self.cost_basis = 0
+        self.lots = COST_BASIS_METHODS[method]()
+        self.next_lot_id = 1
+        if quantity:
+            self.add_lot(quantity, cost_basis, date_acquired)
+
+    @property
+    def spot_price(self):
+        # Read through to the asset, so a price refresh reaches every position without a replay
+        return self.asset.market_value
 
     @property
     def total_market_value(self):
         return self.quantity * self.spot_price
 
+    @property
+    def method(self):
+        return self.lots.method
+
+    def copy(self):
+        position = type(self)(self.asset, 0, self.date_acquired, 0, self.method)
+        position.quantity = self.quantity
+        position.cost_basis = self.cost_basis
+        position.lots = self.lots.copy()
+        position.next_lot_id = self.next_lot_id
+        return position
+
+    def add_lot(self, quantity, cost_basis, date_acquired, unit_cost=None):
+        lot = Lot(self.next_lot_id, quantity, cost_basis, date_acquired, unit_cost)
+        self.next_lot_id += 1
+        self.lots.add(lot)
+        self.quantity += quantity
+        self.cost_basis += cost_basis
+        return lot
+
+    def dispose(self, quantity, lot_ids=None):
+        # Consumes lots for the given quantity, returns (lot_id, quantity, cost_basis, date_acquired, unit_cost)
+        # per lot touched
+        disposals = []
+        remaining = quantity
+        while remaining > QUANTITY_EPSILON and len(self.lots):
+            selected = self.lots.take(lot_ids) if lot_ids else None
+            lot = selected or self.lots.peek()
+            taken = min(remaining, lot.quantity)
+            if lot.quantity - taken <= QUANTITY_EPSILON:
+                # Whole lot consumed
+                taken_cost = lot.cost_basis
+                if selected:
+                    self.lots.remove(lot)
+                else:
+                    self.lots.pop()
+            else:
+                taken_cost = taken * lot.cost_basis_per_unit()
+                lot.quantity -= taken
+                lot.cost_basis -= taken_cost
+            remaining -= taken
+            disposals.append((lot.lot_id, taken, taken_cost, lot.date_acquired, lot.unit_cost))
+
+        if len(self.lots):
+            self.quantity -= quantity - remaining
+            self.cost_basis -= sum(cost for _, _, cost, _, _ in disposals)
+        else:
+            self.quantity = 0
+            self.cost_basis = 0
+        return disposals
+
     def cost_basis_per_unit(self):
         if self.quantity > 0:
             return self.cost_basis / self.quantity
@@ -31,28 +324,85 @@ class Position:
     def __str__(self):
         return (f"Position(asset={self.asset.name}, quantity={self.quantity}, date_acquired={self.date_acquired}, " +
                 f"cost_basis={self.cost_basis}, cost_basis_per_unit={self.cost_basis_per_unit()}, " +
-                f"total_market_value={self.total_market_value})")
+                f"total_market_value={self.total_market_value}, lots={len(self.lots)})")
 
+class LiquidityPosition(Position):
+    # LP shares of a pool, the asset is the Pool. Lots, disposals and valuation work as for any other
+    # asset, the pool tells what the shares are a claim on.
+    __slots__ = ()
+
+    @property
+    def pool(self):
+        return self.asset
+
+    @property
+    def share_of_supply(self):
+        return self.asset.share_of_supply(self.quantity)
+
+    def underlying(self):
+        return self.asset.underlying(self.quantity)
+
+def make_position(asset, quantity, date_acquired, cost_basis, method="FIFO"):
+    # Shares of a pool get a LiquidityPosition, every other asset a Position
+    position_class = LiquidityPosition if isinstance(asset, Pool) else Position
+    return position_class(asset, quantity, date_acquired, cost_basis, method)
 
 class Wallet:
     def __init__(self, name):
         self.name = name
-        self.positions = []
+        self.position_index = {}  # Asset name -> Position, one position per asset
+
+    @property
+    def positions(self):
+        return list(self.position_index.values())
+
+    def get_position(self, asset_name):
+        return self.position_index.get(asset_name)
 
     def add_position(self, position):
-        self.positions.append(position)
+        existing = self.position_index.get(position.asset.name)
+        if existing is None:
+            self.position_index[position.asset.name] = position
+            return
+
+        # Merge into the position already held for this asset, the incoming lots keep their own cost basis
+        for lot in position.lots:
+            existing.add_lot(lot.quantity, lot.cost_basis, lot.date_acquired, lot.unit_cost)
 
     def remove_position(self, position):
-        self.positions.remove(position)
+        del self.position_index[position.asset.name]
+
+    def clear_positions(self):
+        self.position_index.clear()
+
+def remove_empty_positions(wallet, *positions):
+    # Drops the positions whose lots were all disposed of, each one once
+    removed = []
+    for position in positions:
+        if position is not None and not len(position.lots) and all(position is not other for other in removed):
+            wallet.remove_position(position)
+            removed.append(position)
 
 class Transaction:
+    # Ledgers hold a lot of these, slots keep each one free of a per-instance __dict__
+    __slots__ = ("date", "time", "timestamp", "sequence", "key", "transaction_type", "fee_quantity", "fee_asset",
+                 "fee_spot_price", "fee_total_value", "classification", "received_quantity", "received_asset",
+                 "received_spot_price", "received_total_value", "sent_quantity", "sent_asset",
+                 "sent_spot_price", "sent_total_value", "origin_wallet", "destination_wallet",
+                 "gainloss", "lot_ids", "pool_amounts")
+
     def __init__(self, date, time, transaction_type, fee_quantity, fee_asset: Asset, classification,
                  fee_spot_price=None, received_quantity=None, received_asset: Asset = None, received_spot_price=None,
                  sent_quantity=None, sent_asset: Asset = None, sent_spot_price=None,
-                 origin_wallet: Wallet = None, destination_wallet: Wallet = None):
-        self.date = date
-        self.time = time
-        self.transaction_type = transaction_type
+                 origin_wallet: Wallet = None, destination_wallet: Wallet = None, lot_ids=None, pool_amounts=None):
+        # Dates, times, types and classifications repeat across rows, interning shares one copy of each
+        self.date = intern(date)
+        self.time = intern(time)
+        self.timestamp = to_timestamp(date, time)
+        # Position among transactions with the same timestamp, set when the ledger takes the transaction
+        self.sequence = None
+        self.key = None  # Ledger ordering key, see Ledger.assign_key
+        self.transaction_type = intern(transaction_type)
         self.fee_quantity = fee_quantity
         self.fee_asset = fee_asset
         if fee_asset is not None:
@@ -61,7 +411,19 @@ class Transaction:
         else:
             self.fee_spot_price = 0
             self.fee_total_value = 0
-        self.classification = classification
+        self.classification = intern(classification)
+        # (asset, quantity, spot price) of each token put into a pool (AddLiquidity) or taken out of it
+        # (RemoveLiquidity), the LP shares are the received or sent asset
+        self.pool_amounts = [
+            (asset, quantity, spot_price if spot_price is not None else self.fetch_market_price(asset))
+            for asset, quantity, spot_price in pool_amounts
+        ] if pool_amounts else None
+        if self.pool_amounts:
+            # LP shares without a price are worth the tokens on the other side
+            if received_quantity and received_spot_price is None:
+                received_spot_price = self.pool_amounts_value() / received_quantity
+            if sent_quantity and sent_spot_price is None:
+                sent_spot_price = self.pool_amounts_value() / sent_quantity
         self.received_quantity = received_quantity
         self.received_asset = received_asset
         self.received_spot_price = received_spot_price if received_spot_price is not None else (self.fetch_market_price(received_asset) if received_asset else None)
@@ -72,113 +434,418 @@ class Transaction:
         self.sent_total_value = self.sent_quantity * self.sent_spot_price if self.sent_quantity and self.sent_spot_price else 0
         self.origin_wallet = origin_wallet
         self.destination_wallet = destination_wallet
-        if self.fee_quantity > 0:
-            fee_entry = FeeEntry(self.date, self.time, self.fee_asset, self.fee_quantity, self.fee_spot_price)
-            portfolio.fee_ledger.add_fee_entry(fee_entry)
         self.gainloss = 0  # Initialize gain/loss to zero
+        self.lot_ids = lot_ids  # Lots to dispose of first under the specific-ID cost basis method
 
     def fetch_market_price(self, asset: Asset):
-        # Placeholder for market price fetching logic
-        return asset.market_value  # Temporary return, replace with actual market price fetching logic
+        # Price at the time of the transaction from the configured provider, else the asset's current market value
+        if price_provider is not None:
+            price = price_provider.get_price(asset.name, self.timestamp)
+            if price is not None:
+                return price
+        return asset.market_value
+
+    def reject(self, code, message, **fields):
+        # Records why this transaction could not be applied, identified by its date, time and type
+        event_log.reject(code, message, key=self.key, date=self.date, time=self.time, type=self.transaction_type,
+                         **fields)
+
+    def pool_amounts_value(self):
+        return sum(quantity * spot_price for _, quantity, spot_price in self.pool_amounts or ())
+
+    def has_fee(self):
+        return self.fee_asset is not None and self.fee_quantity > 0
+
+    def fee_from_received(self):
+        # Fee taken out of the acquired asset, the wallet only receives the quantity net of it
+        return self.has_fee() and self.received_asset is not None and self.fee_asset.name == self.received_asset.name
+
+    def find_fee_position(self, wallet, sent_position=None):
+        # Position the fee is paid from. A fee in the sent asset comes out of sent_position on top of the
+        # sent quantity, the caller checks that total. Rejects and returns None when the wallet can't pay.
+        position = wallet.get_position(self.fee_asset.name)
+        if position is not None and position is sent_position:
+            return position
+        if position is None or position.quantity + QUANTITY_EPSILON < self.fee_quantity:
+            self.reject("insufficient_fee", "Not enough of the fee asset in the wallet to cover the fee.",
+                        wallet=wallet.name, asset=self.fee_asset.name, required=self.fee_quantity,
+                        available=position.quantity if position else 0)
+            return None
+        return position
+
+    def acquisition(self):
+        # (quantity, cost basis) of the lot acquired. Fees are capitalized into its cost basis, except for
+        # USD which has no basis beyond its face value, a USD fee is an expense and just doesn't arrive.
+        quantity = self.received_quantity
+        if not self.has_fee():
+            return quantity, self.received_total_value
+        if self.fee_from_received():
+            quantity -= self.fee_quantity
+        if self.received_asset.name == "USD":
+            return quantity, quantity * self.received_spot_price
+        cost_basis = self.received_total_value
+        if not self.fee_from_received():
+            cost_basis += self.fee_total_value
+        return quantity, cost_basis
+
+    def record_fee(self, portfolio, wallet, capitalized=False):
+        # Fee ledger entries come from processing, so a replay rebuilds them along with the positions
+        if self.has_fee():
+            portfolio.fee_ledger.add_fee_entry(FeeEntry(
+                self.date, self.time, self.fee_asset, self.fee_quantity, self.fee_spot_price, wallet,
+                self.classification, self.timestamp, capitalized
+            ))
 
     def process_transaction(self, portfolio):
+        realized = []
         if self.transaction_type == 'Deposit':
-            self.process_deposit(portfolio)
+            realized = self.process_deposit(portfolio) or []
         if self.transaction_type == 'Withdraw':
-            self.process_withdraw(portfolio)
+            realized = self.process_withdraw(portfolio) or []
         if self.transaction_type == 'Order':
-            self.process_order(portfolio)
+            realized = self.process_order(portfolio) or []
+        if self.transaction_type == 'Internal':
+            realized = self.process_internal(portfolio) or []
+        if self.transaction_type == 'AddLiquidity':
+            realized = self.process_add_liquidity(portfolio) or []
+        if self.transaction_type == 'RemoveLiquidity':
+            realized = self.process_remove_liquidity(portfolio) or []
 		# Calculate realized gain/loss
-        self.calculate_realized_gain_loss()
-		# If there is a realized gain, create a GainLossEntry and add it to the gain-loss ledger
-        if self.gainloss > 0:
-            gain_loss_entry = GainLossEntry(self.date, self.time, self.gainloss)
+        self.calculate_realized_gain_loss(realized)
+		# Record one GainLossEntry per disposed lot in the gain-loss ledger
+        for gain_loss_entry in realized:
             portfolio.gain_loss_ledger.add_entry(gain_loss_entry)
 	
     def process_order(self, portfolio):
-        wallet = next((w for w in portfolio.wallets if w.name == self.origin_wallet.name), None)
+        wallet = portfolio.get_wallet(self.origin_wallet.name)
         if not wallet:
-            print("Wallet not found.")
+            self.reject("wallet_not_found", "Wallet not found.", wallet=self.origin_wallet.name)
+            return
+
+        # Everything is checked before anything moves, a rejected order leaves the wallet untouched
+        sent_position = wallet.get_position(self.sent_asset.name)
+        fee_position = None
+        needed = self.sent_quantity
+        if self.fee_from_received():
+            if self.fee_quantity > self.received_quantity + QUANTITY_EPSILON:
+                self.reject("insufficient_fee", "The fee is larger than the quantity received.",
+                            wallet=wallet.name, asset=self.fee_asset.name, required=self.fee_quantity,
+                            available=self.received_quantity)
+                return
+        elif self.has_fee():
+            fee_position = self.find_fee_position(wallet, sent_position)
+            if fee_position is None:
+                return
+            if fee_position is sent_position:
+                needed += self.fee_quantity
+        if not sent_position or sent_position.quantity + QUANTITY_EPSILON < needed:
+            self.reject("insufficient_quantity", "Not enough asset in the position to cover the order.",
+                        wallet=wallet.name, asset=self.sent_asset.name, required=needed,
+                        available=sent_position.quantity if sent_position else 0)
             return
 
-        sent_position = next((pos for pos in wallet.positions if pos.asset.name == self.sent_asset.name), None)
-        if sent_position and sent_position.quantity >= self.sent_quantity:
-            cost_basis_reduction = self.sent_quantity * sent_position.cost_basis_per_unit()
-            sent_position.quantity -= self.sent_quantity
-            sent_position.cost_basis -= cost_basis_reduction
+        realized = self.dispose_realizing(wallet, sent_position, self.sent_quantity, self.sent_spot_price, self.lot_ids)
 
-            # Calculate gain or loss
-            market_value_of_sent_quantity = self.sent_quantity * self.sent_spot_price
-            gain_loss = market_value_of_sent_quantity - cost_basis_reduction
+        # Paying the fee disposes of its lots at the fee's value, after the sent lots
+        if fee_position is not None:
+            realized.extend(self.dispose_fee(wallet, fee_position))
+        remove_empty_positions(wallet, sent_position, fee_position)
 
+        # Handling the received asset, a new lot in the existing position or a new position
+        quantity, cost_basis = self.acquisition()
+        if quantity > QUANTITY_EPSILON:
+            wallet.add_position(make_position(
+                asset=self.received_asset,
+                quantity=quantity,
+                date_acquired=f"{self.date} {self.time}",
+                cost_basis=cost_basis,
+                method=portfolio.cost_basis_method
+            ))
+        self.record_fee(portfolio, wallet, capitalized=self.received_asset.name != "USD")
+
+        event_log.info("order_processed", "Order transaction processed in wallet '{wallet}'.", wallet=wallet.name)
+        return realized
+
+    def dispose_realizing(self, wallet, position, quantity, spot_price, lot_ids=None):
+        # Consume lots in cost basis method order, each lot touched is its own realized gain or loss
+        date_disposed = f"{self.date} {self.time}"
+        realized = []
+        for lot_id, taken, cost_basis, date_acquired, _ in position.dispose(quantity, lot_ids):
+            proceeds = taken * spot_price
+            gain_loss = proceeds - cost_basis
             # Create GainLossEntry if there's a gain or loss
             if gain_loss != 0:
-                gain_loss_entry = GainLossEntry(self.date, self.time, gain_loss)
-                portfolio.gain_loss_ledger.add_entry(gain_loss_entry)
-
-            if sent_position.quantity == 0:
-                wallet.remove_position(sent_position)
-        else:
-            print("Not enough asset in the position to cover the order.")
+                realized.append(GainLossEntry(
+                    self.date, self.time, gain_loss, position.asset, wallet,
+                    quantity=taken, proceeds=proceeds, cost_basis=cost_basis, date_acquired=date_acquired,
+                    holding_period_days=holding_period_days(date_acquired, date_disposed),
+                    classification=self.classification, timestamp=self.timestamp
+                ))
+        return realized
+
+    def dispose_fee(self, wallet, fee_position):
+        # Paying a fee in an asset disposes of its lots at the fee's value. That value is what gets
+        # capitalized or expensed, so the gain or loss against the lots' cost basis is realized here.
+        return self.dispose_realizing(wallet, fee_position, self.fee_quantity, self.fee_spot_price)
+
+    def process_add_liquidity(self, portfolio):
+        # Treated like an order with several sent assets: the tokens put into the pool are disposed of at
+        # their spot prices and the LP shares received are a new lot, fees capitalized into it
+        wallet = portfolio.get_wallet(self.origin_wallet.name)
+        if not wallet:
+            self.reject("wallet_not_found", "Wallet not found.", wallet=self.origin_wallet.name)
+            return
+        if self.received_asset is None or not self.pool_amounts:
+            self.reject("incomplete_liquidity", "The pool shares or the tokens put in are missing.", wallet=wallet.name)
             return
 
-        # Handling the received asset
-        received_position = next((pos for pos in wallet.positions if pos.asset.name == self.received_asset.name), None)
-        if received_position:
-            received_position.quantity += self.received_quantity
-            received_position.cost_basis += self.received_quantity * self.received_spot_price
-        else:
-            # Create a new position for the received asset
-            new_position = Position(
+        # Everything is checked before anything moves, a rejected deposit into a pool leaves the wallet untouched
+        needed = {}
+        for asset, quantity, _ in self.pool_amounts:
+            needed[asset.name] = needed.get(asset.name, 0) + quantity
+        fee_position = None
+        if self.fee_from_received():
+            if self.fee_quantity > self.received_quantity + QUANTITY_EPSILON:
+                self.reject("insufficient_fee", "The fee is larger than the quantity received.",
+                            wallet=wallet.name, asset=self.fee_asset.name, required=self.fee_quantity,
+                            available=self.received_quantity)
+                return
+        elif self.has_fee():
+            if self.fee_asset.name in needed:
+                needed[self.fee_asset.name] += self.fee_quantity
+            else:
+                fee_position = self.find_fee_position(wallet)
+                if fee_position is None:
+                    return
+        for name, quantity in needed.items():
+            position = wallet.get_position(name)
+            if not position or position.quantity + QUANTITY_EPSILON < quantity:
+                self.reject("insufficient_quantity", "Not enough asset in the position to add to the pool.",
+                            wallet=wallet.name, asset=name, required=quantity,
+                            available=position.quantity if position else 0)
+                return
+
+        # Lot ids name the lots of a single position, so they aren't used for the tokens put in
+        realized = []
+        positions = []
+        for asset, quantity, spot_price in self.pool_amounts:
+            position = wallet.get_position(asset.name)
+            realized.extend(self.dispose_realizing(wallet, position, quantity, spot_price))
+            positions.append(position)
+        if self.has_fee() and not self.fee_from_received():
+            fee_position = fee_position or wallet.get_position(self.fee_asset.name)
+            realized.extend(self.dispose_fee(wallet, fee_position))
+            positions.append(fee_position)
+        remove_empty_positions(wallet, *positions)
+
+        quantity, cost_basis = self.acquisition()
+        if quantity > QUANTITY_EPSILON:
+            wallet.add_position(make_position(
                 asset=self.received_asset,
-                quantity=self.received_quantity,
+                quantity=quantity,
                 date_acquired=f"{self.date} {self.time}",
-                cost_basis=self.received_quantity * self.received_spot_price
-            )
-            wallet.add_position(new_position)
+                cost_basis=cost_basis,
+                method=portfolio.cost_basis_method
+            ))
+        self.record_fee(portfolio, wallet, capitalized=self.received_asset.name != "USD")
+
+        event_log.info("liquidity_added", "Added liquidity to {pool} from wallet '{wallet}'.",
+                       pool=self.received_asset.name, wallet=wallet.name)
+        return realized
+
+    def process_remove_liquidity(self, portfolio):
+        # The reverse: the LP shares are disposed of at their spot price and every token taken out of the
+        # pool is a new lot at its own. A fee in one of those tokens leaves that much less of it.
+        wallet = portfolio.get_wallet(self.origin_wallet.name)
+        if not wallet:
+            self.reject("wallet_not_found", "Wallet not found.", wallet=self.origin_wallet.name)
+            return
+        if self.sent_asset is None or not self.pool_amounts:
+            self.reject("incomplete_liquidity", "The pool shares or the tokens taken out are missing.", wallet=wallet.name)
+            return
+
+        position = wallet.get_position(self.sent_asset.name)
+        fee_position = None
+        fee_taken = None  # Name of the returned token the fee comes out of
+        needed = self.sent_quantity
+        if self.has_fee():
+            returned = [quantity for asset, quantity, _ in self.pool_amounts if asset.name == self.fee_asset.name]
+            if returned:
+                if self.fee_quantity > returned[0] + QUANTITY_EPSILON:
+                    self.reject("insufficient_fee", "The fee is larger than the quantity received.",
+                                wallet=wallet.name, asset=self.fee_asset.name, required=self.fee_quantity,
+                                available=returned[0])
+                    return
+                fee_taken = self.fee_asset.name
+            else:
+                fee_position = self.find_fee_position(wallet, position)
+                if fee_position is None:
+                    return
+                if fee_position is position:
+                    needed += self.fee_quantity
+        if not position or position.quantity + QUANTITY_EPSILON < needed:
+            self.reject("insufficient_quantity", "Not enough LP shares in the position to remove.",
+                        wallet=wallet.name, asset=self.sent_asset.name, required=needed,
+                        available=position.quantity if position else 0)
+            return
 
-        print(f"Order transaction processed in wallet '{wallet.name}'.")
+        realized = self.dispose_realizing(wallet, position, self.sent_quantity, self.sent_spot_price, self.lot_ids)
+        if fee_position is not None:
+            realized.extend(self.dispose_fee(wallet, fee_position))
+        remove_empty_positions(wallet, position, fee_position)
+
+        fee_left = fee_taken
+        for asset, quantity, spot_price in self.pool_amounts:
+            cost_basis = quantity * spot_price
+            if asset.name == fee_left:
+                # Capitalized like a fee taken from an order's received asset, USD stays at face value
+                quantity -= self.fee_quantity
+                fee_left = None
+                if asset.name == "USD":
+                    cost_basis = quantity * spot_price
+            if quantity > QUANTITY_EPSILON:
+                wallet.add_position(make_position(
+                    asset=asset,
+                    quantity=quantity,
+                    date_acquired=f"{self.date} {self.time}",
+                    cost_basis=cost_basis,
+                    method=portfolio.cost_basis_method
+                ))
+        self.record_fee(portfolio, wallet, capitalized=fee_taken not in (None, "USD"))
+
+        event_log.info("liquidity_removed", "Removed liquidity from {pool} into wallet '{wallet}'.",
+                       pool=self.sent_asset.name, wallet=wallet.name)
+        return realized
 
     def process_withdraw(self, portfolio):
-        origin_wallet = next((wallet for wallet in portfolio.wallets if wallet.name == self.origin_wallet.name), None)
+        origin_wallet = portfolio.get_wallet(self.origin_wallet.name)
         if origin_wallet is None:
-            print("Origin wallet not found.")
+            self.reject("wallet_not_found", "Origin wallet not found.", wallet=self.origin_wallet.name)
+            return
+
+        # Find the position with the sent_asset, a fee in the same asset is paid on top of the withdrawal
+        position = origin_wallet.get_position(self.sent_asset.name)
+        fee_position = None
+        needed = self.sent_quantity
+        if self.has_fee():
+            fee_position = self.find_fee_position(origin_wallet, position)
+            if fee_position is None:
+                return
+            if fee_position is position:
+                needed += self.fee_quantity
+        if position is None or position.quantity + QUANTITY_EPSILON < needed:
+            self.reject("insufficient_quantity", "Not enough asset in the position to cover the withdrawal.",
+                        wallet=origin_wallet.name, asset=self.sent_asset.name, required=needed,
+                        available=position.quantity if position else 0)
+            return
+
+        # Withdrawn lots leave the portfolio with their cost basis, nothing is realized on them
+        position.dispose(self.sent_quantity, self.lot_ids)
+        realized = []
+        if fee_position is not None:
+            realized = self.dispose_fee(origin_wallet, fee_position)
+        remove_empty_positions(origin_wallet, position, fee_position)
+        self.record_fee(portfolio, origin_wallet)
+
+        event_log.info("withdraw_processed", "Withdrawal processed for {quantity} {asset} from {wallet}.",
+                       quantity=self.sent_quantity, asset=self.sent_asset.name, wallet=origin_wallet.name)
+        return realized
+
+    def process_internal(self, portfolio):
+        origin_wallet = portfolio.get_wallet(self.origin_wallet.name)
+        destination_wallet = portfolio.get_wallet(self.destination_wallet.name)
+        if origin_wallet is None or destination_wallet is None:
+            self.reject("wallet_not_found", "Origin or destination wallet not found.",
+                        wallet=self.origin_wallet.name if origin_wallet is None else self.destination_wallet.name)
             return
 
-        # Find the position with the sent_asset
-        position = next((pos for pos in origin_wallet.positions if pos.asset.name == self.sent_asset.name), None)
-        if position is None or position.quantity < self.sent_quantity:
-            print("Not enough asset in the position to cover the withdrawal.")
+        # Everything is checked before anything moves, a rejected transfer leaves both wallets untouched
+        position = origin_wallet.get_position(self.sent_asset.name)
+        fee_position = None
+        needed = self.sent_quantity
+        if self.has_fee():
+            fee_position = self.find_fee_position(origin_wallet, position)
+            if fee_position is None:
+                return
+            if fee_position is position:
+                needed += self.fee_quantity  # The fee is paid on top of the amount that arrives
+        if position is None or position.quantity + QUANTITY_EPSILON < needed:
+            self.reject("insufficient_quantity", "Not enough asset in the position to cover the transfer.",
+                        wallet=origin_wallet.name, asset=self.sent_asset.name, required=needed,
+                        available=position.quantity if position else 0)
             return
 
-        # Adjust the position
-        if position.quantity == self.sent_quantity:
-            origin_wallet.remove_position(position)
+        # The fee is paid from the origin wallet, like a withdrawal's
+        realized = []
+        if fee_position is not None:
+            realized = self.dispose_fee(origin_wallet, fee_position)
+            if fee_position is not position:
+                remove_empty_positions(origin_wallet, fee_position)
+        self.record_fee(portfolio, origin_wallet)
+
+        if origin_wallet is not destination_wallet and len(position.lots):
+            if self.sent_quantity + QUANTITY_EPSILON >= position.quantity \
+                    and destination_wallet.get_position(position.asset.name) is None:
+                # The whole position moves, lots and all
+                origin_wallet.remove_position(position)
+                destination_wallet.add_position(position)
+            else:
+                # Moved lots keep their cost basis and acquisition date, nothing is realized
+                moved = type(position)(self.sent_asset, 0, f"{self.date} {self.time}", 0, method=position.method)
+                disposals = position.dispose(self.sent_quantity, self.lot_ids)
+                for _, quantity, cost_basis, date_acquired, unit_cost in disposals:
+                    moved.add_lot(quantity, cost_basis, date_acquired, unit_cost)
+                if not len(position.lots):
+                    origin_wallet.remove_position(position)
+                destination_wallet.add_position(moved)
         else:
-            position.quantity -= self.sent_quantity
-            position.cost_basis -= self.sent_quantity * position.spot_price  # Adjust cost basis proportionally
+            remove_empty_positions(origin_wallet, position)
 
-        print(f"Withdrawal processed for {self.sent_quantity} {self.sent_asset.name} from {origin_wallet.name}.")
+        event_log.info("internal_processed", "Internal transfer processed for {quantity} {asset} from {origin} to {destination}.",
+                       quantity=self.sent_quantity, asset=self.sent_asset.name, origin=origin_wallet.name,
+                       destination=destination_wallet.name)
+        return realized
 
     def process_deposit(self, portfolio):
         # Find the destination wallet in the portfolio
-        destination_wallet = next((wallet for wallet in portfolio.wallets if wallet.name == self.destination_wallet.name), None)
+        destination_wallet = portfolio.get_wallet(self.destination_wallet.name)
         if destination_wallet is None:
-            return  # Wallet not found, or other error handling
-
-        # Add position to the wallet
-        position = Position(
-            asset=self.received_asset,
-            quantity=self.received_quantity,
-            date_acquired=f"{self.date} {self.time}",
-            cost_basis=self.received_total_value
-        )
-        destination_wallet.add_position(position)
+            self.reject("wallet_not_found", "Destination wallet not found.", wallet=self.destination_wallet.name)
+            return
 
-    def calculate_realized_gain_loss(self):
-        # Placeholder for gain/loss calculation logic
-        # This function should update self.gainloss with the calculated value
-        pass
+        realized = []
+        fee_position = None
+        if self.fee_from_received():
+            if self.fee_quantity > self.received_quantity + QUANTITY_EPSILON:
+                self.reject("insufficient_fee", "The fee is larger than the quantity received.",
+                            wallet=destination_wallet.name, asset=self.fee_asset.name, required=self.fee_quantity,
+                            available=self.received_quantity)
+                return
+        elif self.has_fee():
+            fee_position = self.find_fee_position(destination_wallet)
+            if fee_position is None:
+                return
+            realized = self.dispose_fee(destination_wallet, fee_position)
+            remove_empty_positions(destination_wallet, fee_position)
+
+        # Add position to the wallet, merged into the existing one for the same asset
+        quantity, cost_basis = self.acquisition()
+        if quantity > QUANTITY_EPSILON:
+            destination_wallet.add_position(make_position(
+                asset=self.received_asset,
+                quantity=quantity,
+                date_acquired=f"{self.date} {self.time}",
+                cost_basis=cost_basis,
+                method=portfolio.cost_basis_method
+            ))
+        self.record_fee(portfolio, destination_wallet, capitalized=self.received_asset.name != "USD")
+        event_log.info("deposit_processed", "Deposit processed for {quantity} {asset} into {wallet}.",
+                       quantity=quantity, asset=self.received_asset.name, wallet=destination_wallet.name)
+        return realized
+
+    def calculate_realized_gain_loss(self, realized=()):
+        # Net realized gain/loss of this transaction over the lots it disposed of
+        self.gainloss = sum(entry.gain_amount for entry in realized)
 		
     def __str__(self):
         origin_wallet_name = self.origin_wallet.name if self.origin_wallet else "N/A"
@@ -193,107 +860,718 @@ class Ledger:
     def __init__(self, portfolio):
         self.transactions = []
         self.portfolio = portfolio
+        self.deferred_depth = 0  # > 0 while recomputation is suspended
+        self.pending = []  # Transactions added while recomputation is suspended
+        self.replay_index = None  # Earliest index touched while recomputation is suspended
+        self.unsaved_from = 0  # Earliest index changed since the last save, everything before it is on disk
+        self.observers = []  # Objects with a ledger_changed(index) method, told about every change
+        self.next_sequence = 0
+
+    def assign_key(self, transaction):
+        # Transactions are ordered by timestamp, then by the order they entered the ledger in. Both are
+        # folded into one integer so every sort, merge and bisect compares a single int.
+        if transaction.sequence is None:
+            transaction.sequence = self.next_sequence
+            self.next_sequence += 1
+        transaction.key = transaction.timestamp * SEQUENCE_LIMIT + transaction.sequence
+
+    def find_index(self, transaction):
+        index = bisect.bisect_left(self.transactions, transaction.key, key=transaction_key)
+        if index == len(self.transactions) or self.transactions[index] is not transaction:
+            raise ValueError("transaction is not in the ledger")
+        return index
 
     def add_transaction(self, transaction):
-        self.transactions.append(transaction)
-        self.transactions.sort(key=lambda x: x.date)
-        self.portfolio.update_wallet_positions()
+        self.portfolio.record("add_transaction", transaction)
+        if self.deferred_depth:
+            self.pending.append(transaction)
+            return
+
+        self.assign_key(transaction)
+        index = bisect.bisect_left(self.transactions, transaction.key, key=transaction_key)
+        self.transactions.insert(index, transaction)
+        self.mark_changed(index)
+        if index == len(self.transactions) - 1:
+            # Lands at the end of the timeline, apply it on top of the current state
+            self.portfolio.apply_transaction(index)
+        else:
+            # Lands in the past, rewind to the nearest checkpoint and replay from there
+            self.portfolio.replay_from(index)
+
+    def wallet_changed(self, name):
+        # Transactions touching a wallet that was added or removed now process differently, replay from
+        # the first of them so the derived state is what a full replay would give
+        for index, transaction in enumerate(self.transactions):
+            if any(wallet is not None and wallet.name == name
+                   for wallet in (transaction.origin_wallet, transaction.destination_wallet)):
+                break
+        else:
+            return
+        for observer in self.observers:
+            observer.ledger_changed(index)
+        if self.deferred_depth:
+            self.replay_index = index if self.replay_index is None else min(self.replay_index, index)
+        else:
+            self.portfolio.replay_from(index)
+
+    def mark_changed(self, index):
+        self.unsaved_from = min(self.unsaved_from, index)
+        for observer in self.observers:
+            observer.ledger_changed(index)
+
+    def add_transactions(self, transactions):
+        # Batch path, merges everything into the timeline and replays once
+        transactions = list(transactions)
+        for transaction in transactions:
+            self.portfolio.record("add_transaction", transaction)
+        if self.deferred_depth:
+            self.pending.extend(transactions)
+            return
+
+        index = self.merge_transactions(transactions)
+        if index is not None:
+            self.portfolio.replay_from(index)
+
+    def merge_transactions(self, transactions):
+        # Sorting an already sorted batch is linear, after that a single merge pass with the
+        # existing tail. Returns the earliest index that changed, or None for an empty batch.
+        for transaction in transactions:
+            self.assign_key(transaction)
+        batch = sorted(transactions, key=transaction_key)
+        if not batch:
+            return None
+
+        index = bisect.bisect_left(self.transactions, batch[0].key, key=transaction_key)
+        tail = self.transactions[index:]
+        self.transactions[index:] = heapq.merge(tail, batch, key=transaction_key)
+        self.mark_changed(index)
+        return index
 
     def remove_transaction(self, transaction):
-        self.transactions.remove(transaction)
-        self.portfolio.update_wallet_positions()
+        self.portfolio.record("remove_transaction", transaction)
+        if self.deferred_depth and transaction in self.pending:
+            self.pending.remove(transaction)
+            return
+
+        index = self.find_index(transaction)
+        del self.transactions[index]
+        self.mark_changed(index)
+        if self.deferred_depth:
+            self.replay_index = index if self.replay_index is None else min(self.replay_index, index)
+        else:
+            self.portfolio.replay_from(index)
+
+    def edit_transaction(self, transaction, replacement):
+        # Swaps a transaction for its edited copy with a single replay, journaled as one edit. The copy
+        # keeps the original's sequence, so it stays in place among transactions at the same time.
+        self.portfolio.record("edit_transaction", transaction, replacement)
+        replacement.sequence = transaction.sequence
+        journal, self.portfolio.journal = self.portfolio.journal, None
+        try:
+            with self.deferred_replay():
+                self.remove_transaction(transaction)
+                self.add_transaction(replacement)
+        finally:
+            self.portfolio.journal = journal
+
+    @contextmanager
+    def deferred_replay(self):
+        # Suspend recomputation, everything added inside the block is merged and replayed once on exit
+        self.deferred_depth += 1
+        try:
+            yield self
+        finally:
+            self.deferred_depth -= 1
+            if self.deferred_depth == 0:
+                self.flush_pending()
+
+    def flush_pending(self):
+        pending, self.pending = self.pending, []
+        index = self.merge_transactions(pending)
+        if self.replay_index is not None:
+            index = self.replay_index if index is None else min(index, self.replay_index)
+            self.replay_index = None
+        if index is not None:
+            self.portfolio.replay_from(index)
 
 class Portfolio:
     def __init__(self, name):
         self.name = name
-        self.assets = [Asset("USD", 1.0)]
+        self.assets = []
+        self.asset_index = {}  # Asset name -> Asset
+        self.pools = []  # Liquidity pools, each one is also among the assets
+        self.pool_index = {}  # Pool name -> Pool
         self.ledger = Ledger(self)
         self.wallets = []
+        self.wallet_index = {}  # Wallet name -> Wallet
         self.fee_ledger = FeeLedger()  # Fee ledger for tracking fees
         self.gain_loss_ledger = GainLossLedger()  # Gain/Loss ledger for tracking gains and losses
+        self.checkpoint_interval = 1000  # Snapshot the replayed state every N transactions
+        self.checkpoints = []  # (transaction count, snapshot) pairs in ascending order
+        self.saved_checkpoints = 0  # Leading checkpoints unchanged since the last save
+        self.saved_path = None  # File the portfolio was last saved to or loaded from
+        self.cost_basis_method = "FIFO"  # One of COST_BASIS_METHODS, decides which lots a disposal consumes
+        self.journal = None  # journal.Journal the changes are written ahead to, None when not journaled
+        self.journal_sequence = 0  # Sequence number of the last journaled change reflected in this state
+        self.add_asset(Asset("USD", 1.0))
+
+    def record(self, event, *subjects):
+        # Appends a change to the write-ahead journal, when one is attached
+        if self.journal is not None:
+            self.journal.record(event, *subjects)
 
     def add_asset(self, asset):
+        self.record("add_asset", asset)
         self.assets.append(asset)
+        self.asset_index[asset.name] = asset
 
     def remove_asset(self, asset):
+        self.record("remove_asset", asset)
         self.assets.remove(asset)
+        del self.asset_index[asset.name]
+        if self.pool_index.pop(asset.name, None) is not None:
+            self.pools.remove(asset)
+
+    def add_pool(self, pool):
+        self.record("add_pool", pool)
+        self.assets.append(pool)
+        self.asset_index[pool.name] = pool
+        self.pools.append(pool)
+        self.pool_index[pool.name] = pool
+
+    def get_pool(self, name):
+        return self.pool_index.get(name)
+
+    def set_pool_state(self, pool, reserves, total_supply):
+        # New reserves and supply are a price change for the shares, positions pick it up without a replay
+        self.record("update_pool", pool, reserves, total_supply)
+        pool.set_state(reserves, total_supply)
+        self.revalue_pools()
+
+    def revalue_pools(self):
+        # Value per share of every pool from the current prices of the underlying assets, in one pass
+        from valuation import PoolValuation
+
+        if self.pools:
+            PoolValuation(self.pools).revalue()
+
+    def set_market_value(self, asset, market_value):
+        self.record("update_asset", asset, market_value)
+        asset.market_value = market_value
+
+    def get_asset(self, name):
+        return self.asset_index.get(name)
 
     def add_wallet(self, wallet):
+        self.record("add_wallet", wallet)
         self.wallets.append(wallet)
+        self.wallet_index[wallet.name] = wallet
+        self.ledger.wallet_changed(wallet.name)
+
+    def remove_wallet(self, wallet):
+        self.record("remove_wallet", wallet)
+        self.wallets.remove(wallet)
+        del self.wallet_index[wallet.name]
+        self.ledger.wallet_changed(wallet.name)
+
+    def get_wallet(self, name):
+        return self.wallet_index.get(name)
+
+    def refresh_market_prices(self, provider=None, timestamp=None):
+        # Pulls the price at timestamp (latest when None) for every asset, returns the names that were updated
+        provider = provider or price_provider
+        if provider is None:
+            return []
+        updated = []
+        for asset in self.assets:
+            if asset.name == "USD" or asset.name in self.pool_index:
+                continue
+            price = provider.get_price(asset.name, timestamp)
+            if price is not None:
+                self.set_market_value(asset, price)
+                updated.append(asset.name)
+        self.revalue_pools()
+        return updated
+
+    def set_cost_basis_method(self, method):
+        if method not in COST_BASIS_METHODS:
+            raise ValueError(f"unknown cost basis method '{method}'")
+        self.record("set_cost_basis_method", method)
+        self.cost_basis_method = method
+        # Every lot queue has to be rebuilt in the new order
+        self.update_wallet_positions()
 
     def update_wallet_positions(self):
-        # Clear current positions in each wallet
+        # Full rebuild, throw away every checkpoint and re-process each transaction in chronological order
+        self.checkpoints.clear()
+        self.saved_checkpoints = 0
+        self.replay_from(0)
+
+    def apply_transaction(self, index):
+        # Process a single transaction on top of the state reached by the ones before it
+        self.ledger.transactions[index].process_transaction(self)
+        self.maybe_take_checkpoint(index + 1)
+
+    def replay_from(self, index):
+        # Everything before index is unchanged, so restart from the nearest checkpoint at or before it.
+        # Replayed transactions are processed silently, only a count of rejections is reported. Returns the
+        # index the replay restarted from.
+        start = self.restore_checkpoint(index)
+        # Rejections of the transactions about to be replayed are recorded again by this pass
+        replayed_after = self.ledger.transactions[start - 1].key if start else None
+        event_log.discard_rejections(replayed_after)
+        rejected = event_log.rejected
+        try:
+            with event_log.bulk():
+                for i in range(start, len(self.ledger.transactions)):
+                    self.apply_transaction(i)
+        except BaseException:
+            # Never leave a half replayed pass behind: positions and ledgers go back to the checkpoint
+            # together, and the next change replays from there
+            self.restore_checkpoint(start)
+            event_log.discard_rejections(replayed_after)
+            raise
+        if event_log.rejected > rejected:
+            event_log.warning("replay_rejections", "{count} transactions were rejected during the replay.",
+                              count=event_log.rejected - rejected)
+        return start
+
+    def maybe_take_checkpoint(self, count):
+        if count % self.checkpoint_interval != 0:
+            return
+        if self.checkpoints and self.checkpoints[-1][0] >= count:
+            return
+        self.take_checkpoint(count)
+
+    def take_checkpoint(self, count):
+        # Snapshot of the state after the first `count` transactions have been processed
+        snapshot = {
+            "positions": {wallet.name: [position.copy() for position in wallet.positions] for wallet in self.wallets},
+            "gain_loss_mark": self.gain_loss_ledger.mark(),
+            "fee_mark": self.fee_ledger.mark(),
+        }
+        self.checkpoints.append((count, snapshot))
+
+    def restore_checkpoint(self, index):
+        # Checkpoints taken after the edited index are stale
+        while self.checkpoints and self.checkpoints[-1][0] > index:
+            self.checkpoints.pop()
+        # Checkpoints loaded from files saved before ledger marks were kept only have positions
+        while self.checkpoints and self.checkpoints[-1][1]["gain_loss_mark"] is None:
+            self.checkpoints.pop()
+        self.saved_checkpoints = min(self.saved_checkpoints, len(self.checkpoints))
+
+        if not self.checkpoints:
+            for wallet in self.wallets:
+                wallet.clear_positions()
+            self.gain_loss_ledger.clear()
+            self.fee_ledger.clear()
+            return 0
+
+        count, snapshot = self.checkpoints[-1]
         for wallet in self.wallets:
-            wallet.positions.clear()
-
-        # Re-process each transaction in chronological order
-        for transaction in self.ledger.transactions:
-            transaction.process_transaction(self)
+            wallet.clear_positions()
+            # Copy so the snapshot stays untouched for the next restore
+            for position in snapshot["positions"].get(wallet.name, []):
+                wallet.add_position(position.copy())
+        self.gain_loss_ledger.truncate(snapshot["gain_loss_mark"])
+        self.fee_ledger.truncate(snapshot["fee_mark"])
+        return count
+
+    def transaction_count_at(self, timestamp):
+        # Number of leading ledger transactions at or before timestamp ("YYYY-MM-DD" or "YYYY-MM-DD HH:MM")
+        last_key = parse_moment(timestamp, upper=True) * SEQUENCE_LIMIT + SEQUENCE_LIMIT - 1
+        return bisect.bisect_right(self.ledger.transactions, last_key, key=transaction_key)
+
+    def state_at(self, timestamp):
+        # Throwaway portfolio holding the wallet state at timestamp. Starts from the nearest checkpoint
+        # and replays only the transactions between it and timestamp, the live state is left alone.
+        count = self.transaction_count_at(timestamp)
+        index = bisect.bisect_right(self.checkpoints, count, key=lambda checkpoint: checkpoint[0]) - 1
+        start, positions = (self.checkpoints[index][0], self.checkpoints[index][1]["positions"]) if index >= 0 else (0, {})
+
+        state = Portfolio(self.name)
+        state.cost_basis_method = self.cost_basis_method
+        for asset in self.assets:
+            if state.get_asset(asset.name) is None:
+                state.add_asset(asset)
+        for wallet in self.wallets:
+            state_wallet = Wallet(wallet.name)
+            for position in positions.get(wallet.name, []):
+                state_wallet.add_position(position.copy())
+            state.add_wallet(state_wallet)
+        # The live replay already reported these transactions' rejections
+        with event_log.bulk(keep_rejections=False):
+            for i in range(start, count):
+                self.ledger.transactions[i].process_transaction(state)
+        return state
+
+    def positions_at(self, timestamp):
+        # Wallet name -> positions held at timestamp
+        return {wallet.name: wallet.positions for wallet in self.state_at(timestamp).wallets}
+
+    def value_at(self, timestamp, provider=None):
+        # Market value of the positions held at timestamp, priced at timestamp when a provider has the price
+        provider = provider or price_provider
+        # A bare date holds the positions at the end of that day, so they are priced at its end as well
+        moment = parse_moment(timestamp, upper=True)
+        prices = {}
+        total = 0
+        for wallet in self.state_at(timestamp).wallets:
+            for position in wallet.positions:
+                name = position.asset.name
+                if name not in prices:
+                    price = provider.get_price(name, moment) if provider is not None else None
+                    prices[name] = price if price is not None else position.asset.market_value
+                total += position.quantity * prices[name]
+        return total
 
 class FeeEntry:
-    def __init__(self, date, time, fee_asset, fee_quantity, fee_spot_price):
+    __slots__ = ("date", "time", "timestamp", "fee_asset", "fee_quantity", "fee_spot_price", "fee_total_value",
+                 "wallet", "classification", "capitalized")
+
+    def __init__(self, date, time, fee_asset, fee_quantity, fee_spot_price, wallet=None, classification=None,
+                 timestamp=None, capitalized=False):
         self.date = date
         self.time = time
+        self.timestamp = timestamp if timestamp is not None else to_timestamp(date, time)
         self.fee_asset = fee_asset
         self.fee_quantity = fee_quantity
         self.fee_spot_price = fee_spot_price
         self.fee_total_value = self.fee_quantity * self.fee_spot_price
+        self.wallet = wallet
+        self.classification = classification  # Classification of the transaction that paid the fee
+        self.capitalized = capitalized  # Added to the cost basis of the asset acquired instead of expensed
+
+    @property
+    def asset(self):
+        return self.fee_asset
 
     def __str__(self):
         return (f"FeeEntry(Date: {self.date}, Time: {self.time}, Asset: {self.fee_asset.name}, " +
                 f"Quantity: {self.fee_quantity}, Spot Price: {self.fee_spot_price}, " +
-                f"Total Value: {self.fee_total_value})")
+                f"Total Value: {self.fee_total_value}, Capitalized: {self.capitalized})")
+
+def time_bound(value, upper=False):
+    # Range bound as epoch seconds, None stays None. A bare date is a whole day, see parse_moment.
+    if value is None or isinstance(value, int):
+        return value
+    return parse_moment(value, upper) if value else None
 
-class FeeLedger:
+class SortedEntries:
+    # Entries in timestamp order with a parallel key list, so inserts, removals and
+    # range lookups are a bisect instead of a full sort or scan
     def __init__(self):
-        self.fees = []
+        self.keys = []
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def insert(self, key, entry):
+        # Equal keys keep insertion order. Returns where the entry went.
+        index = bisect.bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.entries.insert(index, entry)
+        return index
+
+    def remove(self, key, entry):
+        if self.entries and self.entries[-1] is entry:
+            # Replays undo their entries from the end
+            self.keys.pop()
+            self.entries.pop()
+            return True
+        index = bisect.bisect_left(self.keys, key)
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.entries[index] is entry:
+                del self.keys[index]
+                del self.entries[index]
+                return True
+            index += 1
+        return False
+
+    def range(self, start=None, end=None):
+        low = 0 if start is None else bisect.bisect_left(self.keys, start)
+        high = len(self.keys) if end is None else bisect.bisect_right(self.keys, end)
+        return self.entries[low:high]
+
+# Fields a ledger summary can be grouped by, each read from a day number and a rollup cell key
+GROUP_FIELDS = {
+    "date": lambda day, cell: day_label(day),
+    "month": lambda day, cell: day_label(day)[:7],
+    "year": lambda day, cell: day_label(day)[:4],
+    "wallet": lambda day, cell: cell[0],
+    "asset": lambda day, cell: cell[1],
+    "classification": lambda day, cell: cell[2],
+}
+
+class SortedLedger:
+    # Shared by the fee and gain/loss ledgers, entries are indexed by time, asset and wallet. Every
+    # insert and delete also updates per day rollups (total and count per wallet, asset and
+    # classification), so summaries over long ranges add up a few cells per day instead of every entry.
+    # Days are UTC days since the epoch.
+    #
+    # The replay fills both ledgers in timestamp order, so the entries of the first N transactions are
+    # always the first entries of the index. A checkpoint only has to remember mark() and going back to
+    # it is a truncate() of the tail, no copies and no rebuild. For the same reason a save only has to
+    # write the entries from unsaved_from on.
+    def __init__(self):
+        self.clear()
+
+    @staticmethod
+    def entry_key(entry):
+        return entry.timestamp
+
+    @staticmethod
+    def entry_value(entry):
+        raise NotImplementedError
+
+    @staticmethod
+    def rollup_key(entry):
+        return (entry.wallet.name if entry.wallet is not None else None,
+                entry.asset.name if entry.asset is not None else None,
+                entry.classification)
+
+    def clear(self):
+        self.index = SortedEntries()
+        self.by_asset = {}  # Asset name -> SortedEntries
+        self.by_wallet = {}  # Wallet name -> SortedEntries
+        self.rollup_days = []  # Sorted day numbers that have entries
+        self.rollups = {}  # Day number -> {(wallet name, asset name, classification): [total, count]}
+        self.unsaved_from = 0  # Entries before this index are unchanged since the last save
+
+    def set_entries(self, entries):
+        self.clear()
+        for entry in entries:
+            self.insert(entry)
+
+    def insert(self, entry):
+        key = self.entry_key(entry)
+        self.unsaved_from = min(self.unsaved_from, self.index.insert(key, entry))
+        if entry.asset is not None:
+            self.by_asset.setdefault(entry.asset.name, SortedEntries()).insert(key, entry)
+        if entry.wallet is not None:
+            self.by_wallet.setdefault(entry.wallet.name, SortedEntries()).insert(key, entry)
+
+        day = key // DAY_SECONDS
+        cells = self.rollups.get(day)
+        if cells is None:
+            cells = self.rollups[day] = {}
+            bisect.insort(self.rollup_days, day)
+        self.add_to_cells(cells, entry)
+
+    def add_to_cells(self, cells, entry):
+        cell_key = self.rollup_key(entry)
+        cell = cells.get(cell_key)
+        if cell is None:
+            cells[cell_key] = [self.entry_value(entry), 1]
+        else:
+            cell[0] += self.entry_value(entry)
+            cell[1] += 1
+
+    def rebuild_rollup(self, day):
+        # Recomputes a day's cells from its entries, in index order like a fresh build. Subtracting
+        # removed entries instead would leave rounding residue behind after many edits.
+        cells = {}
+        for entry in self.index.range(day * DAY_SECONDS, (day + 1) * DAY_SECONDS - 1):
+            self.add_to_cells(cells, entry)
+        if cells:
+            self.rollups[day] = cells
+        elif self.rollups.pop(day, None) is not None:
+            del self.rollup_days[bisect.bisect_left(self.rollup_days, day)]
+
+    def mark(self):
+        return len(self.index)
+
+    def truncate(self, mark):
+        # Removes every entry added after mark(), the last ones first
+        tail = self.index.entries[mark:]
+        if not tail:
+            return
+        self.unsaved_from = min(self.unsaved_from, mark)
+        del self.index.keys[mark:]
+        del self.index.entries[mark:]
+        days = set()
+        for entry in reversed(tail):
+            key = self.entry_key(entry)
+            if entry.asset is not None:
+                self.by_asset[entry.asset.name].remove(key, entry)
+            if entry.wallet is not None:
+                self.by_wallet[entry.wallet.name].remove(key, entry)
+            days.add(key // DAY_SECONDS)
+        for day in days:
+            self.rebuild_rollup(day)
+
+    def delete(self, entry):
+        key = self.entry_key(entry)
+        self.unsaved_from = min(self.unsaved_from, bisect.bisect_left(self.index.keys, key))
+        if not self.index.remove(key, entry):
+            return
+        if entry.asset is not None:
+            self.by_asset[entry.asset.name].remove(key, entry)
+        if entry.wallet is not None:
+            self.by_wallet[entry.wallet.name].remove(key, entry)
+
+        self.rebuild_rollup(key // DAY_SECONDS)
+
+    def query(self, start=None, end=None, asset=None, wallet=None):
+        # Entries between start and end (inclusive, "YYYY-MM-DD", "YYYY-MM-DD HH:MM" or epoch seconds),
+        # optionally for a single asset and/or wallet name
+        start_key = time_bound(start)
+        end_key = time_bound(end, upper=True)
+        if asset is not None:
+            entries = self.by_asset.get(asset)
+        elif wallet is not None:
+            entries = self.by_wallet.get(wallet)
+        else:
+            entries = self.index
+        if entries is None:
+            return []
+
+        result = entries.range(start_key, end_key)
+        if asset is not None and wallet is not None:
+            result = [entry for entry in result if entry.wallet is not None and entry.wallet.name == wallet]
+        return result
+
+    def summarize(self, group_by=(), start=None, end=None, asset=None, wallet=None, classification=None):
+        # Group tuple (values of the group_by fields, in order) -> [total, count] for the entries matching
+        # the filters. Whole days come from the rollups, only days cut by a start or end time read entries.
+        for field in group_by:
+            if field not in GROUP_FIELDS:
+                raise ValueError(f"unknown group '{field}', choose from {', '.join(GROUP_FIELDS)}")
+        getters = [GROUP_FIELDS[field] for field in group_by]
+        totals = {}
+
+        def add(day, cell_key, value, count):
+            if (wallet is not None and cell_key[0] != wallet) or (asset is not None and cell_key[1] != asset) \
+                    or (classification is not None and cell_key[2] != classification):
+                return
+            group = tuple(getter(day, cell_key) for getter in getters)
+            total = totals.get(group)
+            if total is None:
+                totals[group] = [value, count]
+            else:
+                total[0] += value
+                total[1] += count
+
+        start = time_bound(start)
+        end = time_bound(end, upper=True)
+        if start is not None and end is not None and end < start:
+            return totals
+        # Days entirely inside the range come from the rollups, the cut days on either side from entries
+        first_day = None if start is None else -(-start // DAY_SECONDS)
+        last_day = None if end is None else (end + 1) // DAY_SECONDS - 1
+        if first_day is not None and last_day is not None and first_day > last_day:
+            partial = [self.query(start, end, asset, wallet)]
+        else:
+            partial = []
+            if first_day is not None and start < first_day * DAY_SECONDS:
+                partial.append(self.query(start, first_day * DAY_SECONDS - 1, asset, wallet))
+            if last_day is not None and end >= (last_day + 1) * DAY_SECONDS:
+                partial.append(self.query((last_day + 1) * DAY_SECONDS, end, asset, wallet))
+        for entries in partial:
+            for entry in entries:
+                add(entry.timestamp // DAY_SECONDS, self.rollup_key(entry), self.entry_value(entry), 1)
+
+        days = self.rollup_days
+        low = 0 if first_day is None else bisect.bisect_left(days, first_day)
+        high = len(days) if last_day is None else bisect.bisect_right(days, last_day)
+        for day in days[low:high]:
+            for cell_key, (value, count) in self.rollups[day].items():
+                add(day, cell_key, value, count)
+        return totals
+
+    def total(self, start=None, end=None, asset=None, wallet=None, classification=None):
+        return self.summarize((), start, end, asset, wallet, classification).get((), [0, 0])[0]
+
+class FeeLedger(SortedLedger):
+    @property
+    def fees(self):
+        return self.index.entries
 
     def add_fee_entry(self, fee_entry):
-        self.fees.append(fee_entry)
-        self.fees.sort(key=lambda x: (x.date, x.time))
+        self.insert(fee_entry)
 
     def remove_fee_entry(self, fee_entry):
-        if fee_entry in self.fees:
-            self.fees.remove(fee_entry)
-            self.fees.sort(key=lambda x: (x.date, x.time))
+        self.delete(fee_entry)
+
+    @staticmethod
+    def entry_value(entry):
+        # Capitalized fees are already part of a cost basis and reach the gain/loss when that asset is
+        # disposed of, counting them here as well would take them off twice. They still count as entries.
+        return 0 if entry.capitalized else entry.fee_total_value
+
+    def total_fees(self, start=None, end=None, asset=None, wallet=None, classification=None):
+        return self.total(start, end, asset, wallet, classification)
 
     def view_all_fees(self):
         for fee in self.fees:
             print(fee)
 			
 class GainLossEntry:
-    def __init__(self, date, time, gain_amount):
+    __slots__ = ("date", "time", "timestamp", "gain_amount", "asset", "wallet", "quantity", "proceeds",
+                 "cost_basis", "date_acquired", "holding_period_days", "classification")
+
+    def __init__(self, date, time, gain_amount, asset=None, wallet=None, quantity=None, proceeds=None,
+                 cost_basis=None, date_acquired=None, holding_period_days=None, classification=None, timestamp=None):
         self.date = date
         self.time = time
+        self.timestamp = timestamp if timestamp is not None else to_timestamp(date, time)
         self.gain_amount = gain_amount
+        self.asset = asset
+        self.wallet = wallet
+        # Details of the disposed lot
+        self.quantity = quantity
+        self.proceeds = proceeds
+        self.cost_basis = cost_basis
+        self.date_acquired = date_acquired
+        self.holding_period_days = holding_period_days
+        self.classification = classification  # Classification of the transaction that realized it
+
+    @property
+    def is_long_term(self):
+        return self.holding_period_days is not None and self.holding_period_days > 365
 
     def __str__(self):
-        return (f"GainLossEntry(Date: {self.date}, Time: {self.time}, Gain/Loss Amount: {self.gain_amount})")
+        return (f"GainLossEntry(Date: {self.date}, Time: {self.time}, Gain/Loss Amount: {self.gain_amount}, " +
+                f"Quantity: {self.quantity}, Acquired: {self.date_acquired}, " +
+                f"Holding Period: {self.holding_period_days} days)")
 		
-class GainLossLedger:
-    def __init__(self):
-        self.entries = []
+class GainLossLedger(SortedLedger):
+    @property
+    def entries(self):
+        return self.index.entries
 
     def add_entry(self, entry):
-        self.entries.append(entry)
-        self.entries.sort(key=lambda x: (x.date, x.time))
+        self.insert(entry)
 
     def remove_entry(self, entry):
-        if entry in self.entries:
-            self.entries.remove(entry)
-            self.entries.sort(key=lambda x: (x.date, x.time))
+        self.delete(entry)
+
+    @staticmethod
+    def entry_value(entry):
+        return entry.gain_amount
+
+    def total_gain_loss(self, start=None, end=None, asset=None, wallet=None, classification=None):
+        return self.total(start, end, asset, wallet, classification)
 
     def view_all_entries(self):
         for entry in self.entries:
             print(entry)
 
 def save_portfolio_to_file(portfolio, filename):
-    # Convert the portfolio object to a JSON string and save it to a file
-    pass
+    # .json files are written as a single JSON document, anything else uses the binary transaction table
+    import storage
+    storage.save_portfolio(portfolio, filename)
 
 def load_portfolio_from_file(filename):
-    # Load a JSON string from a file and convert it to a Portfolio object
-    pass
+    # Also replays the changes journaled since the file was last saved, if a session ended without saving
+    import journal
+    return journal.recover(filename)
+
+def close_journal(portfolio):
+    if portfolio is not None and portfolio.journal is not None:
+        portfolio.journal.close()
 
 def transactions_menu(portfolio):
     while True:
@@ -302,7 +1580,8 @@ def transactions_menu(portfolio):
         print("2. Remove a transaction")
         print("3. View transactions")
         print("4. Edit a transaction")
-        print("5. Return to main menu")
+        print("5. Import transactions from file")
+        print("6. Return to main menu")
 
         choice = input("Enter your choice: ")
 
@@ -315,6 +1594,8 @@ def transactions_menu(portfolio):
         elif choice == "4":
             edit_transaction_in_ledger(portfolio)
         elif choice == "5":
+            import_transactions_from_file(portfolio)
+        elif choice == "6":
             break
         else:
             print("Invalid choice, please try again.")
@@ -325,6 +1606,8 @@ def add_transaction_to_ledger(portfolio):
     print("2. Withdraw")
     print("3. Order")
     print("4. Internal")
+    print("5. Add liquidity")
+    print("6. Remove liquidity")
 
     transaction_type = input("Enter the type of transaction: ")
 
@@ -336,18 +1619,32 @@ def add_transaction_to_ledger(portfolio):
         add_order_transaction(portfolio)
     elif transaction_type == "4":
         add_internal_transaction(portfolio)
+    elif transaction_type == "5":
+        add_liquidity_transaction(portfolio)
+    elif transaction_type == "6":
+        add_liquidity_transaction(portfolio, remove=True)
     else:
         print("Invalid transaction type, please try again.")
 
+def input_date_time():
+    # Date and time with defaults, asked again until both parse
+    while True:
+        date = input("Enter the date (YYYY-MM-DD), leave blank for today: ").strip()
+        time = input("Enter the time (HH:MM), leave blank for now: ").strip()
+
+        date = date if date else datetime.now().strftime("%Y-%m-%d")
+        time = time if time else datetime.now().strftime("%H:%M")
+        try:
+            to_timestamp(date, time)
+        except ValueError as e:
+            print(f"{e}, please try again.")
+            continue
+        return date, time
+
 def add_deposit_transaction(portfolio):
     print("\nAdding a Deposit Transaction")
 
-    # Handling date and time with defaults
-    date = input("Enter the date (YYYY-MM-DD), leave blank for today: ").strip()
-    time = input("Enter the time (HH:MM), leave blank for now: ").strip()
-
-    date = date if date else datetime.now().strftime("%Y-%m-%d")
-    time = time if time else datetime.now().strftime("%H:%M")
+    date, time = input_date_time()
 
     fee_quantity = float(input("Enter the fee quantity, 0 for no fee: "))
 
@@ -386,12 +1683,7 @@ def add_deposit_transaction(portfolio):
 def add_withdraw_transaction(portfolio):
     print("\nAdding a Withdraw Transaction")
 
-    # Handling date and time with defaults
-    date = input("Enter the date (YYYY-MM-DD), leave blank for today: ").strip()
-    time = input("Enter the time (HH:MM), leave blank for now: ").strip()
-
-    date = date if date else datetime.now().strftime("%Y-%m-%d")
-    time = time if time else datetime.now().strftime("%H:%M")
+    date, time = input_date_time()
 
     fee_quantity = float(input("Enter the fee quantity, 0 for no fee: "))
 
@@ -416,12 +1708,13 @@ def add_withdraw_transaction(portfolio):
     origin_wallet = choose_wallet_from_portfolio(portfolio)
     if not origin_wallet:
         return
+    lot_ids = choose_lot_ids(portfolio)
 
     withdraw_transaction = Transaction(
         date=date, time=time, transaction_type='Withdraw',
         fee_quantity=fee_quantity, fee_asset=fee_asset, classification=classification,
         sent_quantity=sent_quantity, sent_asset=sent_asset, sent_spot_price=sent_spot_price,
-        origin_wallet=origin_wallet
+        origin_wallet=origin_wallet, lot_ids=lot_ids
     )
 
     portfolio.ledger.add_transaction(withdraw_transaction)
@@ -430,12 +1723,7 @@ def add_withdraw_transaction(portfolio):
 def add_order_transaction(portfolio):
     print("\nAdding an Order Transaction")
 
-    # Handling date and time with defaults
-    date = input("Enter the date (YYYY-MM-DD), leave blank for today: ").strip()
-    time = input("Enter the time (HH:MM), leave blank for now: ").strip()
-
-    date = date if date else datetime.now().strftime("%Y-%m-%d")
-    time = time if time else datetime.now().strftime("%H:%M")
+    date, time = input_date_time()
 
     fee_quantity = float(input("Enter the fee quantity, 0 for no fee: "))
 
@@ -475,28 +1763,35 @@ def add_order_transaction(portfolio):
     wallet = choose_wallet_from_portfolio(portfolio)
     if not wallet:
         return
+    lot_ids = choose_lot_ids(portfolio)
 
     order_transaction = Transaction(
         date=date, time=time, transaction_type='Order',
         fee_quantity=fee_quantity, fee_asset=fee_asset, classification=classification,
         sent_quantity=sent_quantity, sent_asset=sent_asset, sent_spot_price=sent_spot_price,
         received_quantity=received_quantity, received_asset=received_asset, received_spot_price=received_spot_price,
-        origin_wallet=wallet, destination_wallet=wallet
+        origin_wallet=wallet, destination_wallet=wallet, lot_ids=lot_ids
     )
 
     portfolio.ledger.add_transaction(order_transaction)
     print("Order transaction added successfully.")
 
 
+def choose_lot_ids(portfolio):
+    # Only asked for under the specific-ID method, the other methods pick lots themselves
+    if portfolio.cost_basis_method != "SPECIFIC":
+        return None
+    entered = input("Enter the lot ids to dispose of, comma separated, leave blank for oldest first: ").strip()
+    try:
+        return [int(lot_id) for lot_id in entered.split(",") if lot_id.strip()] or None
+    except ValueError:
+        print("Invalid lot ids, using oldest lots first.")
+        return None
+
 def add_internal_transaction(portfolio):
     print("\nAdding an Internal Transaction")
 
-    # Handling date and time with defaults
-    date = input("Enter the date (YYYY-MM-DD), leave blank for today: ").strip()
-    time = input("Enter the time (HH:MM), leave blank for now: ").strip()
-
-    date = date if date else datetime.now().strftime("%Y-%m-%d")
-    time = time if time else datetime.now().strftime("%H:%M")
+    date, time = input_date_time()
 
     # Choosing the origin wallet
     print("Choose the origin wallet:")
@@ -515,6 +1810,7 @@ def add_internal_transaction(portfolio):
     sent_asset = choose_asset_from_portfolio(portfolio)
     if not sent_asset:
         return
+    lot_ids = choose_lot_ids(portfolio)
 
     # Handling fee
     fee_quantity = float(input("Enter the fee quantity, 0 for no fee: "))
@@ -531,12 +1827,75 @@ def add_internal_transaction(portfolio):
         date=date, time=time, transaction_type='Internal',
         fee_quantity=fee_quantity, fee_asset=fee_asset, classification=classification,
         sent_quantity=sent_quantity, sent_asset=sent_asset,
-        origin_wallet=origin_wallet, destination_wallet=destination_wallet
+        origin_wallet=origin_wallet, destination_wallet=destination_wallet, lot_ids=lot_ids
     )
 
     portfolio.ledger.add_transaction(internal_transaction)
     print("Internal transaction added successfully.")
 
+def add_liquidity_transaction(portfolio, remove=False):
+    print("\nAdding a Remove Liquidity Transaction" if remove else "\nAdding an Add Liquidity Transaction")
+
+    date, time = input_date_time()
+
+    fee_quantity = float(input("Enter the fee quantity, 0 for no fee: "))
+
+    fee_asset = None
+    if fee_quantity > 0:
+        fee_asset = choose_asset_from_portfolio(portfolio)
+        if not fee_asset:
+            return
+
+    classification = input("Enter the classification: ")
+
+    pool = choose_pool_from_portfolio(portfolio)
+    if not pool:
+        return
+    shares = float(input("Enter the LP shares returned to the pool: " if remove else "Enter the LP shares received: "))
+
+    # One amount per token of the pool, the LP shares are priced from them
+    pool_amounts = []
+    for asset in pool.assets:
+        entered = input(f"Enter the {asset.name} quantity {'taken out' if remove else 'put in'}, "
+                        "leave blank for none: ").strip()
+        if not entered:
+            continue
+        spot_price = 1.0 if asset.name == "USD" else float(input(f"Enter the {asset.name} spot price: "))
+        pool_amounts.append((asset, float(entered), spot_price))
+
+    wallet = choose_wallet_from_portfolio(portfolio)
+    if not wallet:
+        return
+
+    if remove:
+        liquidity_transaction = Transaction(
+            date=date, time=time, transaction_type='RemoveLiquidity',
+            fee_quantity=fee_quantity, fee_asset=fee_asset, classification=classification,
+            sent_quantity=shares, sent_asset=pool, pool_amounts=pool_amounts,
+            origin_wallet=wallet, destination_wallet=wallet, lot_ids=choose_lot_ids(portfolio)
+        )
+    else:
+        liquidity_transaction = Transaction(
+            date=date, time=time, transaction_type='AddLiquidity',
+            fee_quantity=fee_quantity, fee_asset=fee_asset, classification=classification,
+            received_quantity=shares, received_asset=pool, pool_amounts=pool_amounts,
+            origin_wallet=wallet, destination_wallet=wallet
+        )
+
+    portfolio.ledger.add_transaction(liquidity_transaction)
+    print("Liquidity transaction added successfully.")
+
+def import_transactions_from_file(portfolio):
+    from importer import import_transactions
+
+    path = input("Enter the path of the CSV or JSONL export: ").strip()
+    try:
+        count = import_transactions(portfolio, path)
+    except (OSError, ValueError) as e:
+        print(f"Import failed: {e}")
+        return
+    print(f"Imported {count} transactions.")
+
 def remove_transaction_from_ledger(portfolio):
     # Logic to remove a transaction
     pass
@@ -558,7 +1917,9 @@ def main_menu():
         print("2. Assets")
         print("3. Wallets")
         print("4. Transactions")
-        print("5. Exit")
+        print("5. Performance")
+        print("6. Reports")
+        print("7. Exit")
 
         choice = input("Enter your choice: ")
 
@@ -582,6 +1943,17 @@ def main_menu():
             else:
                 print("Please load or create a portfolio first.")
         elif choice == "5":
+            if portfolio:
+                view_performance(portfolio)
+            else:
+                print("Please load or create a portfolio first.")
+        elif choice == "6":
+            if portfolio:
+                reports_menu(portfolio)
+            else:
+                print("Please load or create a portfolio first.")
+        elif choice == "7":
+            close_journal(portfolio)
             print("Exiting program.")
             break
         else:
@@ -593,25 +1965,79 @@ def portfolio_menu(portfolio):
         print("1. Create a new portfolio")
         print("2. Save portfolio to file")
         print("3. Load portfolio from file")
-        print("4. Return to main menu")
+        print("4. Set cost basis method")
+        print("5. Return to main menu")
 
         choice = input("Enter your choice: ")
 
         if choice == "1":
+            close_journal(portfolio)
             portfolio = create_new_portfolio()
         elif choice == "2":
-            # Save logic will go here
-            pass
+            save_portfolio_menu(portfolio)
         elif choice == "3":
-            # Load logic will go here
-            pass
+            portfolio = load_portfolio_menu(portfolio)
         elif choice == "4":
+            set_cost_basis_method_menu(portfolio)
+        elif choice == "5":
             break  # Exit the portfolio menu loop to return to the main menu
         else:
             print("Invalid choice, please try again.")
 
     return portfolio
 
+def set_cost_basis_method_menu(portfolio):
+    if not portfolio:
+        print("Please load or create a portfolio first.")
+        return
+
+    methods = list(COST_BASIS_METHODS)
+    print(f"\nCurrent cost basis method: {portfolio.cost_basis_method}")
+    for i, method in enumerate(methods, 1):
+        print(f"{i}. {method}")
+
+    choice = input("Select a method (number): ")
+    try:
+        method = methods[int(choice) - 1]
+    except (ValueError, IndexError):
+        print("Invalid selection.")
+        return
+    portfolio.set_cost_basis_method(method)
+    print(f"Cost basis method set to {method}, positions rebuilt.")
+
+def save_portfolio_menu(portfolio):
+    if not portfolio:
+        print("No portfolio to save.")
+        return
+
+    default = portfolio.saved_path or f"{portfolio.name}.vpf"
+    filename = input(f"Enter the file name (.json for JSON), leave blank for {default}: ").strip() or default
+    try:
+        save_portfolio_to_file(portfolio, filename)
+        # From here on every change is journaled next to the file, so a crash doesn't lose unsaved work
+        if portfolio.journal is None or portfolio.journal.snapshot_path != filename:
+            from journal import attach_journal
+            attach_journal(portfolio, filename)
+    except OSError as e:
+        print(f"Could not save portfolio: {e}")
+        return
+    print(f"Portfolio '{portfolio.name}' saved to {filename}.")
+
+def load_portfolio_menu(portfolio):
+    from journal import attach_journal
+
+    filename = input("Enter the file name to load: ").strip()
+    if portfolio is not None and portfolio.journal is not None:
+        portfolio.journal.sync()  # Reloading the same file has to see every change journaled so far
+    try:
+        loaded = load_portfolio_from_file(filename)
+        attach_journal(loaded, filename)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not load portfolio: {e}")
+        return portfolio
+    close_journal(portfolio)
+    return loaded
+
 def create_new_portfolio():
     name = input("Enter the name for the new portfolio: ")
     return Portfolio(name)
@@ -623,7 +2049,9 @@ def assets_menu(portfolio):
         print("2. Remove an asset")
         print("3. View assets")
         print("4. Update market prices")
-        print("5. Return to main menu")
+        print("5. Load price history from file")
+        print("6. Add or update a liquidity pool")
+        print("7. Return to main menu")
 
         choice = input("Enter your choice: ")
 
@@ -636,12 +2064,19 @@ def assets_menu(portfolio):
         elif choice == "4":
             update_market_prices(portfolio)
         elif choice == "5":
+            load_price_history()
+        elif choice == "6":
+            add_or_update_pool(portfolio)
+        elif choice == "7":
             break
         else:
             print("Invalid choice, please try again.")
 
 def add_asset_to_portfolio(portfolio):
     name = input("Enter the asset name: ")
+    if portfolio.get_asset(name):
+        print(f"An asset with the name '{name}' already exists.")
+        return
     try:
         market_value = float(input("Enter the market value: "))
         asset = Asset(name, market_value)
@@ -659,23 +2094,91 @@ def remove_asset_from_portfolio(portfolio):
     portfolio.remove_asset(asset)
     print(f"Asset '{asset.name}' removed.")
 
+def add_or_update_pool(portfolio):
+    name = input("Enter the pool name, its LP shares are held under it: ").strip()
+    pool = portfolio.get_pool(name)
+    if pool is None and portfolio.get_asset(name):
+        print(f"An asset with the name '{name}' already exists.")
+        return
+
+    try:
+        if pool is None:
+            assets = []
+            for i in range(int(input("Enter the number of assets in the pool: "))):
+                asset = choose_asset_from_portfolio(portfolio)
+                if not asset:
+                    return
+                assets.append(asset)
+        else:
+            assets = pool.assets
+        reserves = [float(input(f"Enter the pool's {asset.name} reserve: ")) for asset in assets]
+        total_supply = float(input("Enter the total supply of LP shares: "))
+        if pool is None:
+            portfolio.add_pool(Pool(name, assets, reserves, total_supply))
+            portfolio.revalue_pools()
+        else:
+            portfolio.set_pool_state(pool, reserves, total_supply)
+    except ValueError as e:
+        print(f"Invalid pool: {e}")
+        return
+    print(f"Pool '{name}' saved, one LP share is worth {portfolio.get_pool(name).market_value}.")
+
 def view_assets_in_portfolio(portfolio):
     if portfolio.assets:
         print("\nAssets in Portfolio:")
         for asset in portfolio.assets:
+            if asset.name in portfolio.pool_index:
+                print(f"Name: {asset.name}, Market Value: {asset.market_value} per LP share, "
+                      f"Reserves: {asset.underlying(asset.total_supply)}, Total Supply: {asset.total_supply}")
+                continue
             print(f"Name: {asset.name}, Market Value: {asset.market_value}")
     else:
         print("No assets in the portfolio.")
 
+def load_price_history():
+    from prices import HistoricalPriceStore
+
+    path = input("Enter the price history CSV file or directory: ").strip()
+    try:
+        set_price_provider(HistoricalPriceStore(path))
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Could not load price history: {e}")
+        return
+    print("Price history loaded, transactions without a spot price will use it.")
+
 def update_market_prices(portfolio):
+    if price_provider is not None:
+        if input("Refresh all assets from the price history? (y/n): ").strip().lower() == "y":
+            updated = portfolio.refresh_market_prices()
+            print(f"Updated market values for {len(updated)} assets.")
+            return
+
+    url = input("Enter a price feed URL to refresh all assets from, or leave blank to set one price: ").strip()
+    if url:
+        from price_feed import HttpPriceProvider, refresh_market_prices
+
+        try:
+            updated, missing = refresh_market_prices(portfolio, HttpPriceProvider(url))
+        except (OSError, ValueError) as e:
+            print(f"Could not refresh prices: {e}")
+            return
+        print(f"Updated market values for {len(updated)} assets.")
+        if missing:
+            print(f"No price for: {', '.join(missing)}")
+        return
+
     asset = choose_asset_from_portfolio(portfolio)
     if not asset or asset.name == "USD":
         print("Invalid selection or market value of USD cannot be changed.")
         return
+    if asset.name in portfolio.pool_index:
+        print("LP shares are valued from the pool's reserves, update the pool instead.")
+        return
 
     try:
         new_price = float(input(f"Enter the new market value for {asset.name}: "))
-        asset.market_value = new_price
+        portfolio.set_market_value(asset, new_price)
+        portfolio.revalue_pools()
         print(f"Market value for {asset.name} updated to {new_price}.")
     except ValueError:
         print("Invalid market value. Please enter a number.")
@@ -688,7 +2191,9 @@ def wallets_menu(portfolio):
         print("2. Remove a wallet")
         print("3. View wallets")
         print("4. View detailed positions of a wallet")
-        print("5. Return to main menu")
+        print("5. View portfolio valuation")
+        print("6. View positions at a past date")
+        print("7. Return to main menu")
 
         choice = input("Enter your choice: ")
 
@@ -701,6 +2206,10 @@ def wallets_menu(portfolio):
         elif choice == "4":
             view_wallet_positions(portfolio)
         elif choice == "5":
+            view_portfolio_valuation(portfolio)
+        elif choice == "6":
+            view_positions_at_date(portfolio)
+        elif choice == "7":
             break
         else:
             print("Invalid choice, please try again.")
@@ -721,13 +2230,131 @@ def view_wallet_positions(portfolio):
         print(f"Asset: {position.asset.name}, Quantity: {position.quantity}, "
               f"Date Acquired: {position.date_acquired}, Cost Basis: {position.cost_basis}, "
               f"Total Market Value: {position.total_market_value}")
+        if isinstance(position, LiquidityPosition):
+            print(f"    Share of Pool: {position.share_of_supply:.6%}, Underlying: {position.underlying()}")
+        for lot in position.lots:
+            print(f"    Lot {lot.lot_id}: Quantity: {lot.quantity}, Cost Basis: {lot.cost_basis}, "
+                  f"Date Acquired: {lot.date_acquired}")
+
+def view_portfolio_valuation(portfolio):
+    from valuation import Valuation
+
+    valuation = Valuation(portfolio)
+    if not len(valuation):
+        print("No positions in the portfolio.")
+        return
+
+    print("\nValue by asset:")
+    for name, (quantity, market_value, cost_basis, unrealized) in valuation.by_asset().items():
+        print(f"Asset: {name}, Quantity: {quantity}, Market Value: {market_value}, "
+              f"Cost Basis: {cost_basis}, Unrealized Gain/Loss: {unrealized}")
+
+    print("\nValue by wallet:")
+    for name, (market_value, cost_basis, unrealized) in valuation.by_wallet().items():
+        print(f"Wallet: {name}, Market Value: {market_value}, Cost Basis: {cost_basis}, "
+              f"Unrealized Gain/Loss: {unrealized}")
+
+    pools = valuation.by_pool()
+    if pools:
+        print("\nLiquidity pools:")
+        for name, (shares, share_of_supply, market_value) in pools.items():
+            print(f"Pool: {name}, LP Shares: {shares}, Share of Pool: {share_of_supply:.6%}, Market Value: {market_value}")
+        print("Held through pools: " + ", ".join(f"{quantity} {name}" for name, quantity in valuation.underlying().items()))
+
+    print(f"\nTotal Market Value: {valuation.total_market_value}, Total Cost Basis: {valuation.total_cost_basis}, "
+          f"Unrealized Gain/Loss: {valuation.total_unrealized}")
+
+def view_positions_at_date(portfolio):
+    timestamp = input("Enter the date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM): ").strip()
+    if not timestamp:
+        print("No date entered.")
+        return
+
+    try:
+        positions = portfolio.positions_at(timestamp)
+    except ValueError as e:
+        print(e)
+        return
+    print(f"\nPositions at {timestamp}:")
+    for wallet_name, wallet_positions in positions.items():
+        for position in wallet_positions:
+            print(f"Wallet: {wallet_name}, Asset: {position.asset.name}, Quantity: {position.quantity}, "
+                  f"Cost Basis: {position.cost_basis}")
+    print(f"Total Value: {portfolio.value_at(timestamp)}")
+
+def view_performance(portfolio):
+    from performance import PerformanceTracker
+
+    if not portfolio.ledger.transactions:
+        print("No transactions in the ledger.")
+        return
+    end = input("Enter the end date (YYYY-MM-DD) or leave blank for the last transaction: ").strip()
+    tracker = PerformanceTracker(portfolio)
+    try:
+        tracker.update(end or None)
+    except ValueError as e:
+        print(e)
+        return
+    finally:
+        tracker.close()
+    stats = tracker.statistics()
+    mwr = stats["money_weighted_return"]
+    print(f"\nPerformance from {stats['start']} to {stats['end']} ({stats['days']} days):")
+    print(f"Final Value: {stats['final_value']}")
+    print(f"Time-Weighted Return: {stats['time_weighted_return']:.2%}")
+    print(f"Money-Weighted Return (annualized): {f'{mwr:.2%}' if mwr is not None else 'N/A'}")
+    print(f"Volatility (annualized): {stats['volatility']:.2%}")
+    print(f"Max Drawdown: {stats['max_drawdown']:.2%}")
+
+def reports_menu(portfolio):
+    while True:
+        print("\nReports Menu:")
+        print("1. Gain/loss and fees report")
+        print("2. View all fees")
+        print("3. View all gain/loss entries")
+        print("4. Return to main menu")
+
+        choice = input("Enter your choice: ")
+
+        if choice == "1":
+            view_gain_loss_report(portfolio)
+        elif choice == "2":
+            portfolio.fee_ledger.view_all_fees()
+        elif choice == "3":
+            portfolio.gain_loss_ledger.view_all_entries()
+        elif choice == "4":
+            break
+        else:
+            print("Invalid choice, please try again.")
+
+def view_gain_loss_report(portfolio):
+    from report import build_report, parse_group_by, print_report
+
+    # Blank answers leave that filter off
+    start = input("Enter the start date (YYYY-MM-DD[ HH:MM]) or leave blank: ").strip() or None
+    end = input("Enter the end date (YYYY-MM-DD[ HH:MM]) or leave blank: ").strip() or None
+    wallet = input("Enter a wallet name or leave blank for all wallets: ").strip() or None
+    asset = input("Enter an asset name or leave blank for all assets: ").strip() or None
+    classification = input("Enter a classification or leave blank for all: ").strip() or None
+    try:
+        group_by = parse_group_by(input("Group by (comma separated: date, month, year, wallet, asset, "
+                                        "classification) or leave blank for totals: "))
+    except ValueError as e:
+        print(e)
+        return
+
+    try:
+        report = build_report(portfolio, group_by, start, end, asset, wallet, classification)
+    except ValueError as e:
+        print(e)
+        return
+    print_report(report, group_by)
 
 def add_wallet_to_portfolio(portfolio):
     name = input("Enter a name for the new wallet: ")
 
     # Check if a wallet with the same name already exists
-    existing_wallet = next((wallet for wallet in portfolio.wallets if wallet.name == name), None)
-    if existing_wallet:
+    if portfolio.get_wallet(name):
         print(f"A wallet with the name '{name}' already exists.")
         return
 
@@ -742,7 +2369,7 @@ def remove_wallet_from_portfolio(portfolio):
         return
 
     # Proceed with wallet removal
-    portfolio.wallets.remove(selected_wallet)
+    portfolio.remove_wallet(selected_wallet)
     print(f"Wallet '{selected_wallet.name}' has been removed from the portfolio.")
 
 def view_wallets_in_portfolio(portfolio):
@@ -774,6 +2401,27 @@ def choose_asset_from_portfolio(portfolio):
         print("Please enter a number.")
         return None
 
+def choose_pool_from_portfolio(portfolio):
+    if not portfolio.pools:
+        print("No liquidity pools available, add one in the assets menu.")
+        return None
+
+    print("\nAvailable Pools:")
+    for i, pool in enumerate(portfolio.pools, 1):
+        print(f"{i}. {pool.name}")
+
+    choice = input("Select a pool (number): ")
+    try:
+        choice = int(choice) - 1
+        if 0 <= choice < len(portfolio.pools):
+            return portfolio.pools[choice]
+        else:
+            print("Invalid selection.")
+            return None
+    except ValueError:
+        print("Please enter a number.")
+        return None
+
 def choose_wallet_from_portfolio(portfolio):
     if not portfolio.wallets:
         print("No wallets available.")
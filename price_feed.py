@@ -0,0 +1,311 @@
+import asyncio
+import json
+import sys
+import time
+from urllib.parse import parse_qs, quote, urlsplit
+
+from events import event_log
+
+# Asynchronous market price refresh. Quotes for every asset are fetched concurrently in batches over a
+# small pool of keep-alive HTTP connections, with a timeout per request and a rate limit across all of
+# them. LocalPriceServer is a stand-in quote service that answers from any prices.PriceProvider.
+#
+# Wire format: GET /prices?assets=BTC,ETH[&at=TIMESTAMP] -> {"prices": {"BTC": 64000.0, "ETH": null}}
+
+class FeedError(Exception):
+    pass
+
+class RateLimiter:
+    # Token bucket, `rate` requests per second on average with bursts of up to `burst`
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def read_message(reader):
+    # Start line, lower cased headers and body of one HTTP/1.1 message. None on a clean EOF.
+    start = await reader.readline()
+    if not start:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n"):
+            break
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    return start.decode("latin-1").rstrip("\r\n"), headers, body
+
+class ConnectionPool:
+    # Up to `size` connections to one host, kept open between requests and handed to whoever asks next
+    def __init__(self, host, port, size=4, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []  # (reader, writer) of open connections nobody is using
+        self.opened = 0  # Connections opened so far, requests / opened is the reuse rate
+
+    async def connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.opened += 1
+        return reader, writer
+
+    async def exchange(self, connection, path):
+        reader, writer = connection
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nConnection: keep-alive\r\n\r\n"
+                     .encode("latin-1"))
+        await writer.drain()
+        response = await read_message(reader)
+        if response is None:
+            raise ConnectionResetError("connection closed by the server")
+        return response
+
+    async def get(self, path):
+        # (status, body). A kept-alive connection the server has since closed is retried once on a new one.
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else None
+            reused = connection is not None
+            while True:
+                if connection is None:
+                    connection = await self.connect()
+                try:
+                    start, headers, body = await asyncio.wait_for(self.exchange(connection, path), self.timeout)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection[1].close()
+                    if not reused:
+                        raise
+                    connection, reused = None, False
+                except BaseException:
+                    connection[1].close()
+                    raise
+
+            if headers.get("connection", "").lower() == "close":
+                connection[1].close()
+            else:
+                self.idle.append(connection)
+            return int(start.split(" ", 2)[1]), body
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+class AsyncPriceProvider:
+    # Async counterpart of prices.PriceProvider that resolves many assets per call. Returns
+    # {asset name: price or None}, assets it couldn't price are None.
+    async def get_prices(self, asset_names, timestamp=None):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class HttpPriceProvider(AsyncPriceProvider):
+    def __init__(self, url, batch_size=50, max_connections=4, rate_limit=20.0, timeout=5.0, retries=2):
+        parts = urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError(f"price feed URL must look like http://host[:port][/path], got '{url}'")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip("/") + "/prices"
+        self.batch_size = batch_size
+        self.max_connections = max_connections
+        self.rate_limit = rate_limit  # Requests per second across all connections
+        self.timeout = timeout  # Seconds per request, connecting included
+        self.retries = retries  # Extra attempts for a batch that timed out or failed
+        self.pool = None
+        self.limiter = None
+
+    async def get_prices(self, asset_names, timestamp=None):
+        if self.pool is None:
+            # Created here, asyncio primitives belong to the loop that is running
+            self.pool = ConnectionPool(self.host, self.port, self.max_connections, self.timeout)
+            self.limiter = RateLimiter(self.rate_limit, burst=self.max_connections)
+        names = list(asset_names)
+        batches = [names[i:i + self.batch_size] for i in range(0, len(names), self.batch_size)]
+        results = await asyncio.gather(*(self.fetch_batch(batch, timestamp) for batch in batches),
+                                       return_exceptions=True)
+
+        prices = dict.fromkeys(names)
+        for batch, result in zip(batches, results):
+            if isinstance(result, BaseException):
+                event_log.warning("price_batch_failed", "Could not fetch prices for {assets}: {error}",
+                                  assets=", ".join(batch), error=str(result) or type(result).__name__)
+                continue
+            prices.update((name, result.get(name)) for name in batch)
+        return prices
+
+    async def fetch_batch(self, asset_names, timestamp):
+        query = "assets=" + ",".join(quote(name, safe="") for name in asset_names)
+        if timestamp is not None:
+            query += "&at=" + quote(str(timestamp), safe="")
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                status, body = await self.pool.get(f"{self.path}?{query}")
+                if status == 200:
+                    return json.loads(body)["prices"]
+                if status != 429 and status < 500:
+                    raise FeedError(f"price feed answered {status}")
+                error = FeedError(f"price feed answered {status}")
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                error = e
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+async def refresh_prices(portfolio, provider, timestamp=None):
+    # Fetches every non-USD asset at once and applies the prices that came back, pools are then valued
+    # from them. Positions read their asset's market value, so nothing has to be replayed. Returns
+    # (updated names, names left unpriced).
+    assets = [asset for asset in portfolio.assets if asset.name != "USD" and asset.name not in portfolio.pool_index]
+    prices = await provider.get_prices([asset.name for asset in assets], timestamp)
+    updated = []
+    missing = []
+    for asset in assets:
+        price = prices.get(asset.name)
+        if price is None:
+            missing.append(asset.name)
+            continue
+        portfolio.set_market_value(asset, float(price))
+        updated.append(asset.name)
+    portfolio.revalue_pools()
+    return updated, missing
+
+def refresh_market_prices(portfolio, provider, timestamp=None):
+    # Blocking entry point for the menus and the command line
+    async def run():
+        try:
+            return await refresh_prices(portfolio, provider, timestamp)
+        finally:
+            await provider.close()
+    return asyncio.run(run())
+
+class LocalPriceServer:
+    # Stand-in quote service on localhost answering from a prices.PriceProvider. Speaks just enough
+    # HTTP/1.1 for HttpPriceProvider: keep-alive, Content-Length bodies, optional per request latency.
+    def __init__(self, provider, host="127.0.0.1", port=0, latency=0.0):
+        self.provider = provider
+        self.host = host
+        self.port = port  # 0 picks a free port, the real one is set by start()
+        self.latency = latency
+        self.server = None
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def answer(self, target):
+        parts = urlsplit(target)
+        if not parts.path.endswith("/prices"):
+            return 404, {"error": "not found"}
+        query = parse_qs(parts.query)
+        names = [name for value in query.get("assets", []) for name in value.split(",") if name]
+        timestamp = query.get("at", [None])[0]
+        return 200, {"prices": {name: self.provider.get_price(name, timestamp) for name in names}}
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request = await read_message(reader)
+                if request is None:
+                    break
+                start, headers, _ = request
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                method, target, _ = start.split(" ", 2)
+                status, payload = self.answer(target) if method == "GET" else (405, {"error": "method not allowed"})
+                body = json.dumps(payload).encode("utf-8")
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                             f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("latin-1") + body)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+def main(argv=None):
+    # python price_feed.py PRICES [--port N] serves a price history (CSV file or directory, see
+    # prices.HistoricalPriceStore) or a JSON {"ASSET": price} file until interrupted
+    import argparse
+
+    from prices import HistoricalPriceStore, StaticPriceProvider
+
+    parser = argparse.ArgumentParser(description="Local stand-in price feed.")
+    parser.add_argument("prices", help="price history CSV/directory, or a .json file of fixed prices")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before each answer")
+    args = parser.parse_args(argv)
+
+    if args.prices.endswith(".json"):
+        with open(args.prices, encoding="utf-8") as f:
+            provider = StaticPriceProvider(json.load(f))
+    else:
+        provider = HistoricalPriceStore(args.prices)
+
+    async def serve():
+        async with LocalPriceServer(provider, args.host, args.port, args.latency) as server:
+            print(f"Serving prices on {server.url}/prices")
+            await server.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import bisect
+import csv
+import os
+from datetime import datetime, timezone
+from functools import lru_cache
+
+TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+def parse_timestamp(value):
+    # Epoch seconds, datetime or a "YYYY-MM-DD[ HH:MM[:SS]]" string -> epoch seconds. Naive values are UTC.
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        value = value.strip()
+        for fmt in TIMESTAMP_FORMATS:
+            try:
+                moment = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            if value.lstrip("-").isdigit():
+                return int(value)
+            raise ValueError(f"unrecognized timestamp '{value}'")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+class PriceProvider:
+    # Resolves the price of an asset at a point in time. timestamp=None asks for the latest known price.
+    # Returns None when the provider has no price, callers fall back to Asset.market_value.
+    def get_price(self, asset_name, timestamp=None):
+        raise NotImplementedError
+
+class StaticPriceProvider(PriceProvider):
+    # Local stand-in for a live feed, serves fixed prices regardless of the timestamp
+    def __init__(self, prices=None):
+        self.prices = dict(prices or {})
+
+    def set_price(self, asset_name, price):
+        self.prices[asset_name] = price
+
+    def get_price(self, asset_name, timestamp=None):
+        return self.prices.get(asset_name)
+
+class PriceSeries:
+    # Sorted timestamps with their prices for a single asset
+    def __init__(self):
+        self.timestamps = []
+        self.prices = []
+
+    def add(self, timestamp, price):
+        if not self.timestamps or timestamp >= self.timestamps[-1]:
+            self.timestamps.append(timestamp)
+            self.prices.append(price)
+            return
+        index = bisect.bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(index, timestamp)
+        self.prices.insert(index, price)
+
+    def price_at(self, timestamp):
+        # Last price at or before the timestamp
+        if timestamp is None:
+            return self.prices[-1] if self.prices else None
+        index = bisect.bisect_right(self.timestamps, timestamp) - 1
+        return self.prices[index] if index >= 0 else None
+
+class HistoricalPriceStore(PriceProvider):
+    # File-backed OHLC history. `path` is either a single CSV with an asset column, or a directory of
+    # <ASSET>.csv files that are loaded the first time that asset is asked for. Columns: asset (single
+    # file only), timestamp, open, high, low, close. Lookups are a binary search behind an LRU cache.
+    def __init__(self, path, field="close", cache_size=65536):
+        self.path = path
+        self.field = field
+        self.series = {}  # Asset name -> PriceSeries
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+        if not os.path.isdir(path):
+            self.load_file(path)
+
+    def load_file(self, path, asset_name=None):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                name = asset_name or row["asset"]
+                series = self.series.get(name)
+                if series is None:
+                    series = self.series[name] = PriceSeries()
+                series.add(parse_timestamp(row["timestamp"]), float(row[self.field]))
+        self.lookup.cache_clear()
+
+    def get_series(self, asset_name):
+        series = self.series.get(asset_name)
+        if series is None and os.path.isdir(self.path):
+            filename = os.path.join(self.path, f"{asset_name}.csv")
+            if os.path.exists(filename):
+                self.load_file(filename, asset_name)
+            series = self.series.setdefault(asset_name, PriceSeries())
+        return series
+
+    def get_price(self, asset_name, timestamp=None):
+        return self.lookup(asset_name, parse_timestamp(timestamp) if timestamp is not None else None)
+
+    def _lookup(self, asset_name, timestamp):
+        series = self.get_series(asset_name)
+        return series.price_at(timestamp) if series is not None else None
@@ -0,0 +1,50 @@
+from portfolio import GROUP_FIELDS
+
+def group_sort_key(group):
+    # Groups can hold None (entries without a wallet or classification), those sort last
+    return tuple((value is None, value or "") for value in group)
+
+def build_report(portfolio, group_by=(), start=None, end=None, asset=None, wallet=None, classification=None):
+    # One row per group with realized gain/loss, fees and net, read from the ledgers' rollups
+    filters = (start, end, asset, wallet, classification)
+    gains = portfolio.gain_loss_ledger.summarize(group_by, *filters)
+    fees = portfolio.fee_ledger.summarize(group_by, *filters)
+
+    rows = []
+    for group in sorted(set(gains) | set(fees), key=group_sort_key):
+        gain_loss, gain_count = gains.get(group, (0, 0))
+        fee_total, fee_count = fees.get(group, (0, 0))
+        row = dict(zip(group_by, group))
+        row.update({
+            "gain_loss": gain_loss,
+            "fees": fee_total,
+            "net": gain_loss - fee_total,
+            "gain_loss_entries": gain_count,
+            "fee_entries": fee_count,
+        })
+        rows.append(row)
+    return rows
+
+def parse_group_by(value):
+    # "wallet, asset" -> ("wallet", "asset"), unknown fields raise ValueError
+    fields = tuple(field.strip().lower() for field in value.split(",") if field.strip()) if value else ()
+    for field in fields:
+        if field not in GROUP_FIELDS:
+            raise ValueError(f"unknown group '{field}', choose from {', '.join(GROUP_FIELDS)}")
+    return fields
+
+def format_row(row, group_by):
+    labels = ", ".join(f"{field.capitalize()}: {row[field] if row[field] is not None else 'N/A'}" for field in group_by)
+    values = f"Realized Gain/Loss: {row['gain_loss']}, Fees: {row['fees']}, Net: {row['net']}"
+    return f"{labels}, {values}" if labels else values
+
+def print_report(rows, group_by):
+    if not rows:
+        print("No gains, losses or fees match the report filters.")
+        return
+    for row in rows:
+        print(format_row(row, group_by))
+    if group_by:
+        gain_loss = sum(row["gain_loss"] for row in rows)
+        fees = sum(row["fees"] for row in rows)
+        print(f"Total Realized Gain/Loss: {gain_loss}, Total Fees: {fees}, Net: {gain_loss - fees}")
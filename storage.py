@@ -0,0 +1,693 @@
+import json
+import math
+import mmap
+import os
+import struct
+from collections.abc import MutableSequence
+
+from portfolio import (Asset, FeeEntry, GainLossEntry, Lot, Pool, Portfolio, Transaction, Wallet, make_position,
+                       transaction_key)
+
+FORMAT_VERSION = 5
+# Version 1 predates lots, each position loads as a single lot. Versions before 3 saved positions without
+# fees taken off and no fee ledger, those portfolios are replayed on load. Version 4 added liquidity pools.
+# Version 5 moved the ledgers and checkpoints of binary files out of the metadata into side tables.
+SUPPORTED_VERSIONS = (1, 2, 3, 4, 5)
+
+# One fixed size record per transaction in the binary table. Strings (dates, times, types,
+# classifications, asset and wallet names) are stored once in the string table of the metadata
+# file and referenced by index, -1 means None. Missing quantities and prices are stored as NaN.
+#   date, time, type, classification,
+#   fee_quantity, fee_asset, fee_spot_price,
+#   received_quantity, received_asset, received_spot_price,
+#   sent_quantity, sent_asset, sent_spot_price,
+#   origin_wallet, destination_wallet
+RECORD = struct.Struct("<iiiididdiddidii")
+
+# The gain/loss and fee ledgers get tables of their own, in ledger order and sharing the string table:
+#   date, time, gain_amount, asset, wallet, quantity, proceeds, cost_basis,
+#   date_acquired, holding_period_days, classification
+GAIN_LOSS_RECORD = struct.Struct("<iidiidddidi")
+#   date, time, asset, quantity, spot_price, wallet, classification, capitalized
+FEE_RECORD = struct.Struct("<iiiddiii")
+COPY_BLOCK = 1 << 20  # Bytes copied at a time when a rewrite keeps the start of a side file
+
+# The transaction table and the ledger and checkpoint files ("tx", "gl", "fee", "ckpt") sit next to the
+# metadata file, which names the ones it was written with. Bytes a committed metadata file covers are never
+# changed: saves append after them, and a save that has to rewrite part of a file writes the other file of
+# a pair instead. A crash at any point leaves the last saved snapshot loadable.
+
+def side_path(filename, metadata, kind):
+    # Files written before the metadata named them are always filename.kind
+    name = metadata.get("files", {}).get(kind)
+    return os.path.join(os.path.dirname(filename), name) if name else f"{filename}.{kind}"
+
+def other_side_path(filename, path, kind):
+    first = f"{filename}.{kind}"
+    return first + ".1" if os.path.normpath(path) == os.path.normpath(first) else first
+
+def is_json(filename):
+    return filename.lower().endswith(".json")
+
+def to_float(value):
+    return math.nan if value is None else float(value)
+
+def from_float(value):
+    return None if math.isnan(value) else value
+
+def position_to_dict(position):
+    return {
+        "asset": position.asset.name,
+        "quantity": position.quantity,
+        "date_acquired": position.date_acquired,
+        "cost_basis": position.cost_basis,
+        "spot_price": position.spot_price,
+        "method": position.method,
+        "next_lot_id": position.next_lot_id,
+        "lots": [
+            [lot.lot_id, lot.quantity, lot.cost_basis, lot.date_acquired, lot.unit_cost] for lot in position.lots
+        ],
+    }
+
+def position_from_dict(data, assets, method):
+    if "lots" not in data:
+        position = make_position(assets[data["asset"]], data["quantity"], data["date_acquired"], data["cost_basis"], method)
+    else:
+        position = make_position(assets[data["asset"]], 0, data["date_acquired"], 0, data["method"])
+        # Lots saved before the acquisition unit cost was kept have four fields
+        for lot_id, quantity, cost_basis, date_acquired, *unit_cost in data["lots"]:
+            position.lots.add(Lot(lot_id, quantity, cost_basis, date_acquired, *unit_cost))
+        position.quantity = data["quantity"]
+        position.cost_basis = data["cost_basis"]
+        position.next_lot_id = data["next_lot_id"]
+    return position
+
+def pool_to_dict(pool):
+    return {
+        "name": pool.name,
+        "market_value": pool.market_value,
+        "assets": [asset.name for asset in pool.assets],
+        "reserves": pool.reserves,
+        "total_supply": pool.total_supply,
+    }
+
+def pool_from_dict(data, assets):
+    return Pool(data["name"], [assets[name] for name in data["assets"]], data["reserves"], data["total_supply"],
+                data.get("market_value", 0.0))
+
+def pool_amounts_to_list(pool_amounts):
+    return [[asset.name, quantity, spot_price] for asset, quantity, spot_price in pool_amounts] if pool_amounts else None
+
+def pool_amounts_from_list(data, assets):
+    return [(assets[name], quantity, spot_price) for name, quantity, spot_price in data] if data else None
+
+def gain_loss_entry_to_dict(entry):
+    return {
+        "date": entry.date,
+        "time": entry.time,
+        "gain_amount": entry.gain_amount,
+        "asset": entry.asset.name if entry.asset is not None else None,
+        "wallet": entry.wallet.name if entry.wallet is not None else None,
+        "quantity": entry.quantity,
+        "proceeds": entry.proceeds,
+        "cost_basis": entry.cost_basis,
+        "date_acquired": entry.date_acquired,
+        "holding_period_days": entry.holding_period_days,
+        "classification": entry.classification,
+    }
+
+def gain_loss_entry_from_dict(data, portfolio):
+    asset = portfolio.get_asset(data["asset"]) if data.get("asset") is not None else None
+    wallet = portfolio.get_wallet(data["wallet"]) if data.get("wallet") is not None else None
+    return GainLossEntry(
+        data["date"], data["time"], data["gain_amount"], asset, wallet,
+        quantity=data.get("quantity"), proceeds=data.get("proceeds"), cost_basis=data.get("cost_basis"),
+        date_acquired=data.get("date_acquired"), holding_period_days=data.get("holding_period_days"),
+        classification=data.get("classification"),
+    )
+
+def fee_entry_to_dict(entry):
+    return {
+        "date": entry.date,
+        "time": entry.time,
+        "asset": entry.fee_asset.name if entry.fee_asset is not None else None,
+        "quantity": entry.fee_quantity,
+        "spot_price": entry.fee_spot_price,
+        "wallet": entry.wallet.name if entry.wallet is not None else None,
+        "classification": entry.classification,
+        "capitalized": entry.capitalized,
+    }
+
+def fee_entry_from_dict(data, portfolio):
+    asset = portfolio.get_asset(data["asset"]) if data.get("asset") is not None else None
+    wallet = portfolio.get_wallet(data["wallet"]) if data.get("wallet") is not None else None
+    return FeeEntry(data["date"], data["time"], asset, data["quantity"], data["spot_price"], wallet,
+                    data.get("classification"), capitalized=data.get("capitalized", False))
+
+def transaction_to_dict(transaction):
+    def name(obj):
+        return obj.name if obj is not None else None
+
+    return {
+        "date": transaction.date,
+        "time": transaction.time,
+        "transaction_type": transaction.transaction_type,
+        "classification": transaction.classification,
+        "fee_quantity": transaction.fee_quantity,
+        "fee_asset": name(transaction.fee_asset),
+        "fee_spot_price": transaction.fee_spot_price,
+        "received_quantity": transaction.received_quantity,
+        "received_asset": name(transaction.received_asset),
+        "received_spot_price": transaction.received_spot_price,
+        "sent_quantity": transaction.sent_quantity,
+        "sent_asset": name(transaction.sent_asset),
+        "sent_spot_price": transaction.sent_spot_price,
+        "origin_wallet": name(transaction.origin_wallet),
+        "destination_wallet": name(transaction.destination_wallet),
+        "lot_ids": transaction.lot_ids,
+        "pool_amounts": pool_amounts_to_list(transaction.pool_amounts),
+    }
+
+def transaction_from_dict(data, assets, wallets):
+    def lookup(index, key):
+        return index[data[key]] if data.get(key) is not None else None
+
+    return Transaction(
+        date=data["date"], time=data["time"], transaction_type=data["transaction_type"],
+        classification=data["classification"],
+        fee_quantity=data["fee_quantity"], fee_asset=lookup(assets, "fee_asset"),
+        fee_spot_price=data["fee_spot_price"],
+        received_quantity=data["received_quantity"], received_asset=lookup(assets, "received_asset"),
+        received_spot_price=data["received_spot_price"],
+        sent_quantity=data["sent_quantity"], sent_asset=lookup(assets, "sent_asset"),
+        sent_spot_price=data["sent_spot_price"],
+        origin_wallet=lookup(wallets, "origin_wallet"), destination_wallet=lookup(wallets, "destination_wallet"),
+        lot_ids=data.get("lot_ids"), pool_amounts=pool_amounts_from_list(data.get("pool_amounts"), assets),
+    )
+
+def checkpoint_to_dict(count, snapshot):
+    return {
+        "count": count,
+        "gain_loss_mark": snapshot["gain_loss_mark"],
+        "fee_mark": snapshot["fee_mark"],
+        "positions": {
+            wallet_name: [position_to_dict(position) for position in positions]
+            for wallet_name, positions in snapshot["positions"].items()
+        },
+    }
+
+def checkpoint_from_dict(data, portfolio):
+    positions = {
+        wallet_name: [position_from_dict(position, portfolio.asset_index, portfolio.cost_basis_method)
+                      for position in wallet_positions]
+        for wallet_name, wallet_positions in data["positions"].items()
+    }
+    # Files from before ledger marks were saved give checkpoints restore_checkpoint skips, they
+    # still answer point-in-time queries
+    return data["count"], {
+        "positions": positions,
+        "gain_loss_mark": data.get("gain_loss_mark"),
+        "fee_mark": data.get("fee_mark"),
+    }
+
+def state_to_dict(portfolio):
+    # Everything except the transactions, the ledgers and the checkpoints. Positions are saved as they
+    # are so loading doesn't need a replay.
+    return {
+        "version": FORMAT_VERSION,
+        "name": portfolio.name,
+        "cost_basis_method": portfolio.cost_basis_method,
+        "checkpoint_interval": portfolio.checkpoint_interval,
+        "journal_sequence": portfolio.journal_sequence,  # Journal records up to this one are in the file
+        "assets": [
+            {"name": asset.name, "market_value": asset.market_value}
+            for asset in portfolio.assets if asset.name not in portfolio.pool_index
+        ],
+        "pools": [pool_to_dict(pool) for pool in portfolio.pools],
+        "wallets": [
+            {"name": wallet.name, "positions": [position_to_dict(position) for position in wallet.positions]}
+            for wallet in portfolio.wallets
+        ],
+    }
+
+def portfolio_from_dict(data):
+    if data.get("version") not in SUPPORTED_VERSIONS:
+        raise ValueError(f"unsupported portfolio file version {data.get('version')}")
+
+    portfolio = Portfolio(data["name"])
+    portfolio.cost_basis_method = data.get("cost_basis_method", "FIFO")
+    portfolio.checkpoint_interval = data.get("checkpoint_interval", portfolio.checkpoint_interval)
+    portfolio.journal_sequence = data.get("journal_sequence", 0)
+    for asset_data in data["assets"]:
+        asset = portfolio.get_asset(asset_data["name"])
+        if asset is None:
+            portfolio.add_asset(Asset(asset_data["name"], asset_data["market_value"]))
+        else:
+            asset.market_value = asset_data["market_value"]
+    for pool_data in data.get("pools", []):
+        portfolio.add_pool(pool_from_dict(pool_data, portfolio.asset_index))
+    for wallet_data in data["wallets"]:
+        wallet = Wallet(wallet_data["name"])
+        for position_data in wallet_data["positions"]:
+            wallet.add_position(position_from_dict(position_data, portfolio.asset_index, portfolio.cost_basis_method))
+        portfolio.add_wallet(wallet)
+    # JSON files and binary files before version 5 keep the ledgers and checkpoints in the document
+    portfolio.gain_loss_ledger.set_entries(
+        gain_loss_entry_from_dict(entry, portfolio) for entry in data.get("gain_loss_entries", [])
+    )
+    portfolio.fee_ledger.set_entries(fee_entry_from_dict(entry, portfolio) for entry in data.get("fee_entries", []))
+    for checkpoint in data.get("checkpoints", []):
+        portfolio.checkpoints.append(checkpoint_from_dict(checkpoint, portfolio))
+    return portfolio
+
+def attach_transactions(portfolio, transactions, replay=False):
+    # Restores the ledger without replaying, the saved positions already reflect these transactions
+    # unless the file is from an older version (replay=True)
+    ledger = portfolio.ledger
+    ledger.transactions = list(transactions)
+    in_order = True
+    previous = None
+    for transaction in ledger.transactions:
+        # Saved in ledger order, so numbering them in file order keeps same-time transactions in place
+        ledger.assign_key(transaction)
+        if previous is not None and transaction.key < previous:
+            in_order = False
+        previous = transaction.key
+    ledger.unsaved_from = len(ledger.transactions)
+    if not in_order:
+        # Files written before times were part of the order only sorted by date
+        ledger.transactions.sort(key=transaction_key)
+        replay = True
+    if replay:
+        ledger.unsaved_from = 0
+        portfolio.update_wallet_positions()
+
+def write_file_atomic(filename, data):
+    temp = filename + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, filename)
+
+# JSON format, the whole portfolio in a single document
+
+def save_json(portfolio, filename):
+    data = state_to_dict(portfolio)
+    data["gain_loss_entries"] = [gain_loss_entry_to_dict(entry) for entry in portfolio.gain_loss_ledger.entries]
+    data["fee_entries"] = [fee_entry_to_dict(entry) for entry in portfolio.fee_ledger.fees]
+    # Positions of every checkpoint, the snapshot index for point-in-time queries
+    data["checkpoints"] = [checkpoint_to_dict(count, snapshot) for count, snapshot in portfolio.checkpoints]
+    data["transactions"] = [transaction_to_dict(transaction) for transaction in portfolio.ledger.transactions]
+    write_file_atomic(filename, data)
+
+def load_json(filename):
+    with open(filename, encoding="utf-8") as f:
+        data = json.load(f)
+    portfolio = portfolio_from_dict(data)
+    mark_saved(portfolio)
+    attach_transactions(portfolio, (
+        transaction_from_dict(t, portfolio.asset_index, portfolio.wallet_index) for t in data["transactions"]
+    ), replay=data["version"] < 3)
+    return portfolio
+
+# Binary format, a small JSON metadata file plus a fixed width transaction table next to it
+
+class StringTable:
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self.ids = {string: i for i, string in enumerate(self.strings)}
+
+    def id(self, string):
+        if string is None:
+            return -1
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self.ids[string] = string_id
+        return string_id
+
+def encode_transaction(transaction, strings):
+    def name_id(obj):
+        return strings.id(obj.name) if obj is not None else -1
+
+    return RECORD.pack(
+        strings.id(transaction.date), strings.id(transaction.time),
+        strings.id(transaction.transaction_type), strings.id(transaction.classification),
+        to_float(transaction.fee_quantity), name_id(transaction.fee_asset), to_float(transaction.fee_spot_price),
+        to_float(transaction.received_quantity), name_id(transaction.received_asset),
+        to_float(transaction.received_spot_price),
+        to_float(transaction.sent_quantity), name_id(transaction.sent_asset), to_float(transaction.sent_spot_price),
+        name_id(transaction.origin_wallet), name_id(transaction.destination_wallet),
+    )
+
+def encode_gain_loss_entry(entry, strings):
+    return GAIN_LOSS_RECORD.pack(
+        strings.id(entry.date), strings.id(entry.time), entry.gain_amount,
+        strings.id(entry.asset.name) if entry.asset is not None else -1,
+        strings.id(entry.wallet.name) if entry.wallet is not None else -1,
+        to_float(entry.quantity), to_float(entry.proceeds), to_float(entry.cost_basis),
+        strings.id(entry.date_acquired), to_float(entry.holding_period_days), strings.id(entry.classification),
+    )
+
+def decode_gain_loss_entry(fields, strings, portfolio):
+    (date, time, gain_amount, asset, wallet, quantity, proceeds, cost_basis,
+     date_acquired, holding_period_days, classification) = fields
+
+    def string(string_id):
+        return strings[string_id] if string_id >= 0 else None
+
+    return GainLossEntry(
+        string(date), string(time), gain_amount,
+        portfolio.get_asset(strings[asset]) if asset >= 0 else None,
+        portfolio.get_wallet(strings[wallet]) if wallet >= 0 else None,
+        quantity=from_float(quantity), proceeds=from_float(proceeds), cost_basis=from_float(cost_basis),
+        date_acquired=string(date_acquired), holding_period_days=from_float(holding_period_days),
+        classification=string(classification),
+    )
+
+def encode_fee_entry(entry, strings):
+    return FEE_RECORD.pack(
+        strings.id(entry.date), strings.id(entry.time),
+        strings.id(entry.fee_asset.name) if entry.fee_asset is not None else -1,
+        entry.fee_quantity, entry.fee_spot_price,
+        strings.id(entry.wallet.name) if entry.wallet is not None else -1,
+        strings.id(entry.classification), int(entry.capitalized),
+    )
+
+def decode_fee_entry(fields, strings, portfolio):
+    date, time, asset, quantity, spot_price, wallet, classification, capitalized = fields
+    return FeeEntry(
+        strings[date], strings[time], portfolio.get_asset(strings[asset]) if asset >= 0 else None,
+        quantity, spot_price, portfolio.get_wallet(strings[wallet]) if wallet >= 0 else None,
+        strings[classification] if classification >= 0 else None, capitalized=bool(capitalized),
+    )
+
+class TransactionTable:
+    # Read-only, memory-mapped view of a saved transaction table. Records are decoded on access.
+    def __init__(self, path, count, strings, assets, wallets, lot_ids=None, pool_amounts=None):
+        self.strings = strings
+        self.assets = assets
+        self.wallets = wallets
+        self.lot_ids = lot_ids or {}  # Transaction index -> lot ids
+        self.pool_amounts = pool_amounts or {}  # Transaction index -> [[asset name, quantity, spot price], ...]
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < count * RECORD.size:
+            self.file.close()
+            raise ValueError(f"{path} is shorter than its metadata says")
+        self.count = count  # Records after it are from a save that never committed
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("transaction index out of range")
+        return self.decode(RECORD.unpack_from(self.buffer, index * RECORD.size), index)
+
+    def __iter__(self):
+        # Unpacked in place one record at a time, the mapping is never copied
+        for index in range(self.count):
+            yield self.decode(RECORD.unpack_from(self.buffer, index * RECORD.size), index)
+
+    def decode(self, fields, index):
+        (date, time, transaction_type, classification,
+         fee_quantity, fee_asset, fee_spot_price,
+         received_quantity, received_asset, received_spot_price,
+         sent_quantity, sent_asset, sent_spot_price,
+         origin_wallet, destination_wallet) = fields
+
+        def string(string_id):
+            return self.strings[string_id] if string_id >= 0 else None
+
+        def lookup(index, string_id):
+            return index[self.strings[string_id]] if string_id >= 0 else None
+
+        return Transaction(
+            date=string(date), time=string(time), transaction_type=string(transaction_type),
+            classification=string(classification),
+            fee_quantity=from_float(fee_quantity), fee_asset=lookup(self.assets, fee_asset),
+            fee_spot_price=from_float(fee_spot_price),
+            received_quantity=from_float(received_quantity), received_asset=lookup(self.assets, received_asset),
+            received_spot_price=from_float(received_spot_price),
+            sent_quantity=from_float(sent_quantity), sent_asset=lookup(self.assets, sent_asset),
+            sent_spot_price=from_float(sent_spot_price),
+            origin_wallet=lookup(self.wallets, origin_wallet),
+            destination_wallet=lookup(self.wallets, destination_wallet),
+            lot_ids=self.lot_ids.get(index),
+            pool_amounts=pool_amounts_from_list(self.pool_amounts.get(index), self.assets),
+        )
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+class LazyTransactions(MutableSequence):
+    # The ledger's transaction list after a binary load. A slot holds the record index of a transaction
+    # nothing has read yet, or the Transaction once it has been decoded, so a load decodes nothing and a
+    # replay from a late checkpoint only the tail. Inserts and removals move slots like a list's. The
+    # table is closed once no slot refers to it.
+    def __init__(self, table, ledger):
+        self.table = table
+        self.ledger = ledger
+        self.slots = list(range(len(table)))
+        self.undecoded = len(table)
+        if not self.undecoded:
+            table.close()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.slots)))]
+        slot = self.slots[index]
+        if type(slot) is int:
+            slot = self.slots[index] = self.decode(slot)
+        return slot
+
+    def __iter__(self):
+        for i in range(len(self.slots)):
+            yield self[i]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self.release(self.slots[index])
+            self.slots[index] = list(value)
+        else:
+            self.release([self.slots[index]])
+            self.slots[index] = value
+
+    def __delitem__(self, index):
+        self.release(self.slots[index] if isinstance(index, slice) else [self.slots[index]])
+        del self.slots[index]
+
+    def insert(self, index, value):
+        self.slots.insert(index, value)
+
+    def decode(self, record):
+        transaction = self.table[record]
+        # Saved in ledger order, so numbering them by record keeps same-time transactions in place
+        transaction.sequence = record
+        self.ledger.assign_key(transaction)
+        self.release([record])
+        return transaction
+
+    def release(self, slots):
+        self.undecoded -= sum(1 for slot in slots if type(slot) is int)
+        if not self.undecoded:
+            self.table.close()
+
+    def extras(self):
+        # (index, lot ids, pool amounts as saved) of every transaction, records not decoded are read from the table
+        for i, slot in enumerate(self.slots):
+            if type(slot) is int:
+                yield i, self.table.lot_ids.get(slot), self.table.pool_amounts.get(slot)
+            else:
+                yield i, slot.lot_ids, pool_amounts_to_list(slot.pool_amounts)
+
+def transaction_extras(transactions):
+    if isinstance(transactions, LazyTransactions):
+        return transactions.extras()
+    return ((i, t.lot_ids, pool_amounts_to_list(t.pool_amounts)) for i, t in enumerate(transactions))
+
+def read_metadata(filename):
+    with open(filename, encoding="utf-8") as f:
+        return json.load(f)
+
+def intact(path, committed_size):
+    # Crashed saves can leave bytes after the committed ones, never fewer
+    return os.path.exists(path) and os.path.getsize(path) >= committed_size
+
+def write_side_file(filename, path, kind, committed_size, keep_size, chunks):
+    # Writes a side file as the first keep_size bytes of the committed one followed by chunks, returns its
+    # path. Keeping everything committed appends in place, anything less copies the kept part to the other
+    # file of the pair and continues there.
+    if keep_size == committed_size:
+        target = path
+        f = open(path, "r+b" if os.path.exists(path) else "wb")
+        f.truncate(keep_size)
+        f.seek(keep_size)
+    else:
+        target = other_side_path(filename, path, kind)
+        f = open(target, "wb")
+    with f:
+        if target != path and keep_size:
+            with open(path, "rb") as source:
+                remaining = keep_size
+                while remaining:
+                    block = source.read(min(remaining, COPY_BLOCK))
+                    f.write(block)
+                    remaining -= len(block)
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    return target
+
+def save_binary(portfolio, filename):
+    transactions = portfolio.ledger.transactions
+    gain_loss_entries = portfolio.gain_loss_ledger.entries
+    fee_entries = portfolio.fee_ledger.fees
+
+    # The files the current metadata names stay untouched up to what it committed. Only a portfolio saved to
+    # or loaded from this file keeps their contents, anything else is written whole.
+    metadata = read_metadata(filename) if os.path.exists(filename) else {}
+    appending = portfolio.saved_path == filename and bool(metadata)
+    strings = StringTable(metadata["strings"]) if appending else StringTable()
+    files = {}
+
+    def save_table(kind, record, committed_count, unsaved_from, entries, encode):
+        path = side_path(filename, metadata, kind)
+        committed_count = committed_count or 0
+        start = 0
+        if appending and intact(path, committed_count * record.size):
+            start = min(unsaved_from, committed_count)
+        files[kind] = write_side_file(filename, path, kind, committed_count * record.size, start * record.size,
+                                      (encode(entries[i], strings) for i in range(start, len(entries))))
+
+    save_table("tx", RECORD, metadata.get("transaction_count"), portfolio.ledger.unsaved_from,
+               transactions, encode_transaction)
+    save_table("gl", GAIN_LOSS_RECORD, metadata.get("gain_loss_count"), portfolio.gain_loss_ledger.unsaved_from,
+               gain_loss_entries, encode_gain_loss_entry)
+    save_table("fee", FEE_RECORD, metadata.get("fee_count"), portfolio.fee_ledger.unsaved_from,
+               fee_entries, encode_fee_entry)
+
+    # One JSON line per checkpoint, offsets[i] is where checkpoint i starts and offsets[-1] where the file ends
+    committed_offsets = metadata.get("checkpoint_offsets", [0])
+    path = side_path(filename, metadata, "ckpt")
+    start = 0
+    if appending and intact(path, committed_offsets[-1]):
+        start = min(portfolio.saved_checkpoints, len(committed_offsets) - 1)
+    offsets = committed_offsets[:start + 1]
+    lines = []
+    for count, snapshot in portfolio.checkpoints[start:]:
+        lines.append((json.dumps(checkpoint_to_dict(count, snapshot)) + "\n").encode("utf-8"))
+        offsets.append(offsets[-1] + len(lines[-1]))
+    files["ckpt"] = write_side_file(filename, path, "ckpt", committed_offsets[-1], offsets[start], lines)
+
+    data = state_to_dict(portfolio)
+    data["files"] = {kind: os.path.basename(path) for kind, path in files.items()}
+    data["transaction_count"] = len(transactions)
+    data["gain_loss_count"] = len(gain_loss_entries)
+    data["fee_count"] = len(fee_entries)
+    data["checkpoint_offsets"] = offsets
+    data["strings"] = strings.strings
+    # Lot selections and pool amounts are rare and variable length, so they live next to the table, keyed by index
+    data["lot_ids"] = {}
+    data["pool_amounts"] = {}
+    for i, lot_ids, pool_amounts in transaction_extras(transactions):
+        if lot_ids:
+            data["lot_ids"][str(i)] = lot_ids
+        if pool_amounts:
+            data["pool_amounts"][str(i)] = pool_amounts
+    write_file_atomic(filename, data)
+
+    # The other file of each pair is now unreferenced
+    for kind, path in files.items():
+        other = other_side_path(filename, path, kind)
+        if os.path.exists(other):
+            os.remove(other)
+
+def open_transaction_table(filename, portfolio=None):
+    # Lazy access to a saved transaction table without loading the ledger
+    metadata = read_metadata(filename)
+    if portfolio is None:
+        portfolio = portfolio_from_dict(metadata)
+    lot_ids = {int(i): ids for i, ids in metadata.get("lot_ids", {}).items()}
+    pool_amounts = {int(i): amounts for i, amounts in metadata.get("pool_amounts", {}).items()}
+    return TransactionTable(side_path(filename, metadata, "tx"), metadata["transaction_count"], metadata["strings"],
+                            portfolio.asset_index, portfolio.wallet_index, lot_ids, pool_amounts)
+
+def read_table(path, record, count):
+    with open(path, "rb") as f:
+        data = f.read(count * record.size)
+    if len(data) != count * record.size:
+        raise ValueError(f"{path} is shorter than its metadata says")
+    return record.iter_unpack(data)
+
+def load_ledgers(filename, metadata, portfolio):
+    strings = metadata["strings"]
+    portfolio.gain_loss_ledger.set_entries(
+        decode_gain_loss_entry(fields, strings, portfolio)
+        for fields in read_table(side_path(filename, metadata, "gl"), GAIN_LOSS_RECORD, metadata["gain_loss_count"])
+    )
+    portfolio.fee_ledger.set_entries(
+        decode_fee_entry(fields, strings, portfolio)
+        for fields in read_table(side_path(filename, metadata, "fee"), FEE_RECORD, metadata["fee_count"])
+    )
+    offsets = metadata["checkpoint_offsets"]
+    path = side_path(filename, metadata, "ckpt")
+    with open(path, "rb") as f:
+        lines = f.read(offsets[-1]).splitlines()
+    if len(lines) != len(offsets) - 1:
+        raise ValueError(f"{path} does not match its metadata")
+    portfolio.checkpoints = [checkpoint_from_dict(json.loads(line), portfolio) for line in lines]
+
+def mark_saved(portfolio):
+    # Everything the portfolio holds now is in its file
+    portfolio.ledger.unsaved_from = len(portfolio.ledger.transactions)
+    portfolio.gain_loss_ledger.unsaved_from = len(portfolio.gain_loss_ledger.entries)
+    portfolio.fee_ledger.unsaved_from = len(portfolio.fee_ledger.fees)
+    portfolio.saved_checkpoints = len(portfolio.checkpoints)
+
+def load_binary(filename):
+    metadata = read_metadata(filename)
+    portfolio = portfolio_from_dict(metadata)
+    if metadata["version"] >= 5:
+        load_ledgers(filename, metadata, portfolio)
+    mark_saved(portfolio)
+    table = open_transaction_table(filename, portfolio)
+    if metadata["version"] >= 5:
+        # The saved positions and ledgers already reflect the transactions, they are decoded when read
+        ledger = portfolio.ledger
+        ledger.transactions = LazyTransactions(table, ledger)
+        ledger.next_sequence = ledger.unsaved_from = len(table)
+        return portfolio
+    try:
+        attach_transactions(portfolio, table, replay=metadata["version"] < 3)
+    finally:
+        table.close()
+    return portfolio
+
+def save_portfolio(portfolio, filename):
+    if is_json(filename):
+        save_json(portfolio, filename)
+    else:
+        save_binary(portfolio, filename)
+    portfolio.saved_path = filename
+    mark_saved(portfolio)
+    if portfolio.journal is not None and portfolio.journal.snapshot_path == filename:
+        # The snapshot now holds everything the journal recorded
+        portfolio.journal.truncate()
+
+def load_portfolio(filename):
+    portfolio = load_json(filename) if is_json(filename) else load_binary(filename)
+    portfolio.saved_path = filename
+    return portfolio
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# The modules are flat files in the repository root, the synthetic ledger generator lives with the benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import storage
+from events import event_log
+from synthetic import build_portfolio, generate_transactions
+
+@pytest.fixture(autouse=True)
+def quiet_event_log():
+    # Processing messages would flood the test output, rejections are still recorded
+    with event_log.bulk():
+        yield
+    event_log.take_rejections()
+
+def make_ledger(count=600, seed=0, checkpoint_interval=50):
+    # Small synthetic portfolio and its transactions, not yet added. A short checkpoint interval makes
+    # replays start from checkpoints instead of from the beginning.
+    portfolio = build_portfolio(seed=seed)
+    portfolio.checkpoint_interval = checkpoint_interval
+    return portfolio, list(generate_transactions(portfolio, count, seed, per_day=20))
+
+def portfolio_state(portfolio):
+    # Everything a replay or a load rebuilds, as comparable data
+    return {
+        "wallets": {
+            wallet.name: sorted((storage.position_to_dict(position) for position in wallet.positions),
+                                key=lambda position: position["asset"])
+            for wallet in portfolio.wallets
+        },
+        "gain_loss_entries": [storage.gain_loss_entry_to_dict(entry) for entry in portfolio.gain_loss_ledger.entries],
+        "fee_entries": [storage.fee_entry_to_dict(entry) for entry in portfolio.fee_ledger.fees],
+        "transactions": [storage.transaction_to_dict(transaction) for transaction in portfolio.ledger.transactions],
+    }
@@ -0,0 +1,64 @@
+from portfolio import Asset, Portfolio, Transaction, Wallet
+
+def funded_wallet():
+    portfolio = Portfolio("Fees")
+    eth, bnb = Asset("ETH", 100.0), Asset("BNB", 100.0)
+    portfolio.add_asset(eth)
+    portfolio.add_asset(bnb)
+    wallet = Wallet("main")
+    portfolio.add_wallet(wallet)
+    usd = portfolio.get_asset("USD")
+    for asset, quantity, price in ((usd, 1000.0, 1.0), (bnb, 1.0, 10.0)):
+        portfolio.ledger.add_transaction(Transaction(
+            "2024-01-01", "10:00", "Deposit", 0, None, "income",
+            received_quantity=quantity, received_asset=asset, received_spot_price=price, destination_wallet=wallet))
+    return portfolio, wallet, usd, eth, bnb
+
+def buy_eth(portfolio, wallet, usd, eth, fee_quantity, fee_asset, fee_spot_price):
+    portfolio.ledger.add_transaction(Transaction(
+        "2024-01-02", "10:00", "Order", fee_quantity, fee_asset, "trade", fee_spot_price=fee_spot_price,
+        received_quantity=1.0, received_asset=eth, received_spot_price=100.0,
+        sent_quantity=100.0, sent_asset=usd, sent_spot_price=1.0, origin_wallet=wallet))
+
+def test_fee_on_an_acquisition_is_capitalized():
+    portfolio, wallet, usd, eth, _ = funded_wallet()
+    buy_eth(portfolio, wallet, usd, eth, 2.0, usd, 1.0)
+
+    assert wallet.get_position("ETH").cost_basis == 102.0
+    assert wallet.get_position("USD").quantity == 898.0
+    [fee] = portfolio.fee_ledger.fees
+    assert fee.capitalized and fee.fee_total_value == 2.0
+    # Already in the cost basis, so not counted again as an expense
+    assert portfolio.fee_ledger.total_fees() == 0
+    assert not portfolio.gain_loss_ledger.entries
+
+def test_fee_on_usd_received_and_on_a_withdrawal_is_expensed():
+    portfolio, wallet, usd, eth, _ = funded_wallet()
+    buy_eth(portfolio, wallet, usd, eth, 0, None, None)
+    # Sell the ETH for USD with the fee taken out of the USD received
+    portfolio.ledger.add_transaction(Transaction(
+        "2024-01-03", "10:00", "Order", 3.0, usd, "trade", fee_spot_price=1.0,
+        received_quantity=150.0, received_asset=usd, received_spot_price=1.0,
+        sent_quantity=1.0, sent_asset=eth, sent_spot_price=150.0, origin_wallet=wallet))
+    portfolio.ledger.add_transaction(Transaction(
+        "2024-01-04", "10:00", "Withdraw", 5.0, usd, "transfer", fee_spot_price=1.0,
+        sent_quantity=100.0, sent_asset=usd, sent_spot_price=1.0, origin_wallet=wallet))
+
+    assert wallet.get_position("USD").quantity == 900.0 + 147.0 - 105.0
+    assert [fee.capitalized for fee in portfolio.fee_ledger.fees] == [False, False]
+    assert portfolio.fee_ledger.total_fees() == 8.0
+    # The gain on the ETH is against its cost basis alone, the fee is not netted into it
+    [entry] = portfolio.gain_loss_ledger.entries
+    assert entry.gain_amount == 50.0
+
+def test_paying_a_fee_realizes_its_gain():
+    portfolio, wallet, usd, eth, bnb = funded_wallet()
+    # 1 BNB bought at 10 pays a fee worth 100
+    buy_eth(portfolio, wallet, usd, eth, 1.0, bnb, 100.0)
+
+    [entry] = portfolio.gain_loss_ledger.entries
+    assert (entry.asset.name, entry.proceeds, entry.cost_basis, entry.gain_amount) == ("BNB", 100.0, 10.0, 90.0)
+    assert wallet.get_position("BNB") is None
+    # The fee's value, not the BNB's cost, is capitalized into the ETH
+    assert wallet.get_position("ETH").cost_basis == 200.0
+    assert portfolio.fee_ledger.total_fees() == 0
@@ -0,0 +1,28 @@
+from portfolio import Asset, Portfolio, Transaction, Wallet
+from prices import HistoricalPriceStore
+
+def test_value_at_a_date_prices_the_end_of_day_positions(tmp_path):
+    history = tmp_path / "prices.csv"
+    history.write_text("asset,timestamp,open,high,low,close\n"
+                       "BTC,2024-01-01 00:00,100,100,100,100\n"
+                       "BTC,2024-01-05 00:00,200,200,200,200\n"
+                       "BTC,2024-01-05 18:00,300,300,300,300\n"
+                       "BTC,2024-01-06 00:00,400,400,400,400\n", encoding="utf-8")
+    provider = HistoricalPriceStore(str(history))
+
+    portfolio = Portfolio("History")
+    btc = Asset("BTC", 1000.0)
+    portfolio.add_asset(btc)
+    wallet = Wallet("main")
+    portfolio.add_wallet(wallet)
+    # Intraday trades on the 5th: 1 BTC in the morning, 2 more in the evening
+    for time, quantity in (("09:00", 1.0), ("20:00", 2.0)):
+        portfolio.ledger.add_transaction(Transaction(
+            "2024-01-05", time, "Deposit", 0, None, "income",
+            received_quantity=quantity, received_asset=btc, received_spot_price=250.0, destination_wallet=wallet))
+
+    # The date holds all 3 BTC, priced at the day's last price rather than at its first
+    assert portfolio.value_at("2024-01-05", provider) == 3 * 300.0
+    # An explicit time is both the position and the price moment
+    assert portfolio.value_at("2024-01-05 12:00", provider) == 1 * 200.0
+    assert portfolio.value_at("2024-01-04", provider) == 0
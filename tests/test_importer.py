@@ -0,0 +1,95 @@
+import json
+
+from events import event_log
+from importer import ColumnMapping, import_transactions
+from portfolio import Asset, Portfolio, Wallet
+
+# An exchange export with its own column names and type labels
+EXPORT_COLUMNS = {
+    "datetime": "Date (UTC)",
+    "type": "Kind",
+    "wallet": "Account",
+    "received_quantity": "Bought",
+    "received_asset": "Bought Coin",
+    "received_spot_price": "Bought Price",
+    "sent_quantity": "Sold",
+    "sent_asset": "Sold Coin",
+    "fee_quantity": "Fee",
+    "fee_asset": "Fee Coin",
+    "fee_spot_price": "Fee Price",
+}
+EXPORT_TYPES = {"Top-up": "Deposit", "Swap": "Order"}
+
+HEADER = "Date (UTC),Kind,Account,Bought,Bought Coin,Bought Price,Sold,Sold Coin,Fee,Fee Coin,Fee Price\n"
+
+def write_export(path, lines):
+    path.write_text(HEADER + "".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+def test_custom_columns_are_mapped(tmp_path):
+    path = write_export(tmp_path / "export.csv", [
+        "2024-03-01T09:30:00,Top-up,spot,1000,USD,,,,,,",
+        "2024-03-02 14:00:00+02:00,Swap,spot,0.5,ETH,1800,900,USD,1.5,USD,1",
+    ])
+    portfolio = Portfolio("Import")
+    mapping = ColumnMapping(EXPORT_COLUMNS, EXPORT_TYPES)
+    assert import_transactions(portfolio, path, mapping) == 2
+
+    deposit, order = portfolio.ledger.transactions
+    assert (deposit.date, deposit.time, deposit.transaction_type) == ("2024-03-01", "09:30:00", "Deposit")
+    assert (order.date, order.time, order.transaction_type) == ("2024-03-02", "14:00:00+02:00", "Order")
+    # 14:00 at +02:00 is 12:00 UTC, a day and two and a half hours after the deposit
+    assert order.timestamp == deposit.timestamp + 86400 + 2 * 3600 + 30 * 60
+    assert (order.received_asset.name, order.received_quantity, order.received_spot_price) == ("ETH", 0.5, 1800.0)
+    assert (order.sent_asset.name, order.sent_quantity, order.fee_quantity) == ("USD", 900.0, 1.5)
+    # Missing assets and wallets are created, the new asset priced from the row
+    assert portfolio.get_asset("ETH").market_value == 1800.0
+    wallet = portfolio.get_wallet("spot")
+    assert wallet.get_position("ETH").cost_basis == 901.5
+    assert wallet.get_position("USD").quantity == 1000 - 900 - 1.5
+
+def test_bad_rows_are_rejected_and_recorded(tmp_path):
+    path = write_export(tmp_path / "export.csv", [
+        "2024-03-01 09:30,Top-up,spot,1000,USD,,,,,,",
+        "2024-03-01 10:00,Airdrop,spot,5,ETH,1800,,,,,",     # Unknown type
+        "2024-03-01 10:30,Swap,spot,0.5,ETH,1800,,,,,",      # Order without a sent asset
+        "2024-03-01 11:00,Top-up,spot,lots,USD,,,,,,",       # Quantity isn't a number
+        "01/03/2024 11:30,Top-up,spot,10,USD,,,,,,",          # Malformed date
+        "2024-03-01 12:00,Top-up,,10,USD,,,,,,",              # No wallet
+        "2024-03-01 12:30,Top-up,spot,10,USD,,,,1,,",         # Fee without a fee asset
+        "2024-03-01 13:00,Top-up,spot,10,USD,,,,,,",
+    ])
+    portfolio = Portfolio("Import")
+    event_log.take_rejections()
+    assert import_transactions(portfolio, path, ColumnMapping(EXPORT_COLUMNS, EXPORT_TYPES)) == 2
+
+    rejections = event_log.take_rejections()
+    assert [rejection["code"] for rejection in rejections] == ["invalid_row"] * 6
+    assert [rejection["row"] for rejection in rejections] == [2, 3, 4, 5, 6, 7]
+    errors = [rejection["error"] for rejection in rejections]
+    assert errors[0] == "unknown transaction type 'Airdrop'"
+    assert errors[1] == "Order without a sent asset"
+    assert "invalid date" in errors[3]
+    assert errors[4:] == ["missing wallet", "fee without a fee asset"]
+    # The good rows still went in
+    assert portfolio.get_wallet("spot").get_position("USD").quantity == 1010
+
+def test_unknown_names_rejected_without_create_missing(tmp_path):
+    path = tmp_path / "export.jsonl"
+    path.write_text("\n".join(json.dumps(row) for row in [
+        {"date": "2024-03-01", "time": "09:30", "type": "deposit", "wallet": "main",
+         "received_quantity": 2, "received_asset": "BTC", "received_spot_price": 60000},
+        {"date": "2024-03-01", "time": "10:00", "type": "deposit", "wallet": "cold",
+         "received_quantity": 1, "received_asset": "BTC", "received_spot_price": 60000},
+        {"date": "2024-03-01", "time": "10:30", "type": "deposit", "wallet": "main",
+         "received_quantity": 1, "received_asset": "DOGE", "received_spot_price": 0.1},
+    ]) + "\n", encoding="utf-8")
+    portfolio = Portfolio("Import")
+    portfolio.add_asset(Asset("BTC", 60000.0))
+    portfolio.add_wallet(Wallet("main"))
+    event_log.take_rejections()
+    assert import_transactions(portfolio, str(path), create_missing=False) == 1
+
+    assert [rejection["error"] for rejection in event_log.take_rejections()] == \
+           ["unknown wallet 'cold'", "unknown asset 'DOGE'"]
+    assert portfolio.get_asset("DOGE") is None and portfolio.get_wallet("cold") is None
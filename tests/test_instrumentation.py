@@ -0,0 +1,18 @@
+import instrumentation
+from conftest import make_ledger
+
+def test_replay_counts_from_the_restored_checkpoint():
+    portfolio, transactions = make_ledger(count=600, checkpoint_interval=50)
+    late = transactions.pop(475)
+    portfolio.ledger.add_transactions(transactions)
+
+    instrumentation.registry.reset()
+    instrumentation.enable()
+    try:
+        # Lands at index 475, the replay restarts at the checkpoint taken after 450 transactions
+        portfolio.ledger.add_transaction(late)
+    finally:
+        instrumentation.disable()
+    assert instrumentation.replays.values == {(): 1}
+    assert instrumentation.replayed_transactions.values == {(): 600 - 450}
+    assert instrumentation.transactions.values and sum(instrumentation.transactions.values.values()) == 600 - 450
@@ -0,0 +1,43 @@
+import pytest
+
+import journal
+import storage
+from conftest import make_ledger, portfolio_state
+
+def test_recover_ignores_torn_last_line(tmp_path):
+    portfolio, transactions = make_ledger(count=200)
+    path = str(tmp_path / "portfolio.vpf")
+    storage.save_portfolio(portfolio, path)
+    log = journal.attach_journal(portfolio, path)
+    portfolio.ledger.add_transactions(transactions)
+    log.close()
+
+    # A crash in the middle of a write leaves part of a record behind
+    with open(journal.journal_path(path), "ab") as f:
+        f.write(b'{"seq": 999, "event": "add_wal')
+
+    recovered = journal.recover(path)
+    assert portfolio_state(recovered) == portfolio_state(portfolio)
+    assert recovered.journal_sequence == portfolio.journal_sequence
+
+def test_recover_after_interrupted_save(tmp_path, monkeypatch):
+    portfolio, transactions = make_ledger(count=400)
+    path = str(tmp_path / "portfolio.vpf")
+    portfolio.ledger.add_transactions(transactions[:300])
+    storage.save_portfolio(portfolio, path)
+    log = journal.attach_journal(portfolio, path)
+    portfolio.ledger.remove_transaction(transactions[50])
+    portfolio.ledger.add_transactions(transactions[300:])
+
+    # The side files are written, the process dies before the metadata file is replaced
+    def crash(filename, data):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(storage, "write_file_atomic", crash)
+    with pytest.raises(KeyboardInterrupt):
+        storage.save_portfolio(portfolio, path)
+    monkeypatch.undo()
+    log.close()
+
+    recovered = journal.recover(path)
+    assert portfolio_state(recovered) == portfolio_state(portfolio)
@@ -0,0 +1,85 @@
+import pytest
+
+import valuation
+from portfolio import Asset, LiquidityPosition, Pool, Portfolio, Transaction, Wallet
+from valuation import Valuation
+
+def pool_portfolio():
+    portfolio = Portfolio("Pools")
+    eth = Asset("ETH", 2000.0)
+    usd = portfolio.get_asset("USD")
+    portfolio.add_asset(eth)
+    # 100 ETH and 200000 USD against 1000 shares, one share is worth 400
+    pool = Pool("ETH-USD", [eth, usd], [100, 200000], 1000)
+    portfolio.add_pool(pool)
+    wallet = Wallet("main")
+    portfolio.add_wallet(wallet)
+    for asset, quantity, price in ((eth, 1.0, 1500.0), (usd, 2000.0, 1.0)):
+        portfolio.ledger.add_transaction(Transaction(
+            "2024-01-01", "10:00", "Deposit", 0, None, "income",
+            received_quantity=quantity, received_asset=asset, received_spot_price=price, destination_wallet=wallet))
+    return portfolio, wallet, pool, eth, usd
+
+def add_liquidity(portfolio, wallet, pool, eth, usd):
+    portfolio.ledger.add_transaction(Transaction(
+        "2024-01-02", "10:00", "AddLiquidity", 0, None, "liquidity",
+        received_quantity=10.0, received_asset=pool, origin_wallet=wallet,
+        pool_amounts=[(eth, 1.0, 2000.0), (usd, 2000.0, 1.0)]))
+
+@pytest.fixture(params=["numpy", "python"])
+def backend(request, monkeypatch):
+    if request.param == "numpy" and valuation.np is None:
+        pytest.skip("numpy is not installed")
+    if request.param == "python":
+        monkeypatch.setattr(valuation, "np", None)
+    return request.param
+
+def test_add_liquidity_disposes_the_tokens():
+    portfolio, wallet, pool, eth, usd = pool_portfolio()
+    add_liquidity(portfolio, wallet, pool, eth, usd)
+
+    # The tokens put in are sold at their spot prices, only the ETH had a gain
+    [entry] = portfolio.gain_loss_ledger.entries
+    assert (entry.asset.name, entry.gain_amount) == ("ETH", 500.0)
+    assert wallet.get_position("ETH") is None and wallet.get_position("USD") is None
+    # The shares are priced at the tokens' value when no price is given
+    position = wallet.get_position("ETH-USD")
+    assert isinstance(position, LiquidityPosition)
+    assert (position.quantity, position.cost_basis) == (10.0, 4000.0)
+    assert position.share_of_supply == 0.01
+    assert position.underlying() == {"ETH": 1.0, "USD": 2000.0}
+
+def test_pool_valuation(backend):
+    portfolio, wallet, pool, eth, usd = pool_portfolio()
+    add_liquidity(portfolio, wallet, pool, eth, usd)
+
+    portfolio.revalue_pools()
+    assert pool.market_value == 400.0
+    # A price move in an underlying asset moves the value per share
+    portfolio.set_market_value(eth, 2500.0)
+    portfolio.revalue_pools()
+    assert pool.market_value == (100 * 2500.0 + 200000) / 1000
+
+    result = Valuation(portfolio)
+    assert result.by_pool() == {"ETH-USD": (10.0, 0.01, 4500.0)}
+    assert result.underlying() == {"ETH": 1.0, "USD": 2000.0}
+    assert result.total_unrealized == 500.0
+
+    # New reserves and supply are a price change for the shares
+    portfolio.set_pool_state(pool, [100, 250000], 1250)
+    assert pool.market_value == 400.0
+
+def test_remove_liquidity_returns_the_tokens():
+    portfolio, wallet, pool, eth, usd = pool_portfolio()
+    add_liquidity(portfolio, wallet, pool, eth, usd)
+    portfolio.ledger.add_transaction(Transaction(
+        "2024-01-03", "10:00", "RemoveLiquidity", 0, None, "liquidity",
+        sent_quantity=10.0, sent_asset=pool, origin_wallet=wallet,
+        pool_amounts=[(eth, 1.0, 2500.0), (usd, 2000.0, 1.0)]))
+
+    # The shares are sold at the value of the tokens taken out, each token is a new lot at its price
+    entries = portfolio.gain_loss_ledger.entries
+    assert [(entry.asset.name, entry.gain_amount) for entry in entries] == [("ETH", 500.0), ("ETH-USD", 500.0)]
+    assert wallet.get_position("ETH-USD") is None
+    assert [(lot.quantity, lot.cost_basis) for lot in wallet.get_position("ETH").lots] == [(1.0, 2500.0)]
+    assert wallet.get_position("USD").quantity == 2000.0
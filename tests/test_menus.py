@@ -0,0 +1,26 @@
+import portfolio as portfolio_module
+from portfolio import Portfolio, Wallet
+
+def answer(monkeypatch, *answers):
+    replies = iter(answers)
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(replies))
+
+def test_malformed_date_is_asked_again(monkeypatch, capsys):
+    portfolio = Portfolio("Menu")
+    portfolio.add_wallet(Wallet("main"))
+    # Date, time, then the same again; fee, classification, quantity, asset (USD) and wallet
+    answer(monkeypatch, "2024/01/05", "10:00", "2024-01-05", "25:00", "2024-01-05", "10:00",
+           "0", "income", "100", "1", "1")
+    portfolio_module.add_deposit_transaction(portfolio)
+
+    output = capsys.readouterr().out
+    assert "invalid date '2024/01/05'" in output
+    assert "invalid time '25:00'" in output
+    [transaction] = portfolio.ledger.transactions
+    assert (transaction.date, transaction.time) == ("2024-01-05", "10:00")
+
+def test_malformed_query_date_is_reported(monkeypatch, capsys):
+    portfolio = Portfolio("Menu")
+    answer(monkeypatch, "05/01/2024")
+    portfolio_module.view_positions_at_date(portfolio)
+    assert "invalid date" in capsys.readouterr().out
@@ -0,0 +1,93 @@
+import asyncio
+
+from portfolio import Asset, Portfolio
+from price_feed import HttpPriceProvider, LocalPriceServer, refresh_prices
+from prices import StaticPriceProvider
+
+PRICES = {f"COIN{i:02d}": 10.0 + i for i in range(10)}
+
+class FlakyPriceServer(LocalPriceServer):
+    # Answers the first `failures` requests with `status` before serving prices
+    def __init__(self, provider, status, failures):
+        super().__init__(provider)
+        self.status = status
+        self.failures = failures
+        self.targets = []
+
+    def answer(self, target):
+        self.targets.append(target)
+        if self.failures:
+            self.failures -= 1
+            return self.status, {"error": "try again"}
+        return super().answer(target)
+
+def fetch(server, names, **options):
+    # Starts the server, asks the provider for the names and returns (prices, server)
+    async def run():
+        async with server:
+            provider = HttpPriceProvider(server.url, **options)
+            try:
+                return await provider.get_prices(names), provider.pool.opened
+            finally:
+                await provider.close()
+    return asyncio.run(run())
+
+def test_batches_share_kept_alive_connections():
+    server = FlakyPriceServer(StaticPriceProvider(PRICES), 200, 0)
+    prices, opened = fetch(server, list(PRICES), batch_size=3, max_connections=2, rate_limit=1000)
+    assert prices == PRICES
+    # 10 assets in batches of 3 is 4 requests over at most 2 connections
+    assert server.requests == 4
+    assert sorted(len(target.split("assets=")[1].split(",")) for target in server.targets) == [1, 3, 3, 3]
+    # Fewer connections than requests, the pool kept them open between batches
+    assert opened == server.connections
+    assert opened <= 2 < server.requests
+
+def test_unknown_assets_come_back_unpriced():
+    server = LocalPriceServer(StaticPriceProvider(PRICES))
+    prices, _ = fetch(server, ["COIN01", "NOPE"])
+    assert prices == {"COIN01": 11.0, "NOPE": None}
+
+def test_server_errors_and_rate_limits_are_retried():
+    for status in (503, 429):
+        server = FlakyPriceServer(StaticPriceProvider(PRICES), status, 2)
+        prices, _ = fetch(server, ["COIN01", "COIN02"], retries=2, rate_limit=1000)
+        assert prices == {"COIN01": 11.0, "COIN02": 12.0}
+        assert server.requests == 3
+
+def test_retries_give_up_and_leave_the_batch_unpriced():
+    server = FlakyPriceServer(StaticPriceProvider(PRICES), 500, 10)
+    prices, _ = fetch(server, ["COIN01"], retries=1, rate_limit=1000)
+    assert prices == {"COIN01": None}
+    assert server.requests == 2
+
+def test_client_errors_are_not_retried():
+    server = FlakyPriceServer(StaticPriceProvider(PRICES), 404, 10)
+    prices, _ = fetch(server, ["COIN01"], retries=3, rate_limit=1000)
+    assert prices == {"COIN01": None}
+    assert server.requests == 1
+
+def test_timeout_leaves_assets_unpriced():
+    server = LocalPriceServer(StaticPriceProvider(PRICES), latency=0.5)
+    prices, _ = fetch(server, ["COIN01", "COIN02"], timeout=0.1, retries=0)
+    assert prices == {"COIN01": None, "COIN02": None}
+
+def test_refresh_prices_updates_market_values():
+    portfolio = Portfolio("Feed")
+    for name in ("COIN01", "COIN02", "GONE"):
+        portfolio.add_asset(Asset(name, 1.0))
+
+    async def run():
+        async with LocalPriceServer(StaticPriceProvider(PRICES)) as server:
+            provider = HttpPriceProvider(server.url)
+            try:
+                return await refresh_prices(portfolio, provider)
+            finally:
+                await provider.close()
+
+    updated, missing = asyncio.run(run())
+    assert sorted(updated) == ["COIN01", "COIN02"]
+    assert missing == ["GONE"]
+    assert portfolio.get_asset("COIN02").market_value == 12.0
+    assert portfolio.get_asset("GONE").market_value == 1.0
+    assert portfolio.get_asset("USD").market_value == 1.0
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+import parallel
+from conftest import make_ledger, portfolio_state
+from portfolio import Asset, Position
+
+def full_replay_state(portfolio):
+    portfolio.update_wallet_positions()
+    return portfolio_state(portfolio)
+
+def test_incremental_inserts_match_full_replay():
+    portfolio, transactions = make_ledger()
+    # Out of order, so most inserts replay from a checkpoint in the middle of the ledger
+    random.Random(1).shuffle(transactions)
+    for transaction in transactions:
+        portfolio.ledger.add_transaction(transaction)
+    assert portfolio_state(portfolio) == full_replay_state(portfolio)
+
+def test_incremental_removals_match_full_replay():
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions)
+    for transaction in random.Random(2).sample(transactions, 40):
+        portfolio.ledger.remove_transaction(transaction)
+    assert portfolio_state(portfolio) == full_replay_state(portfolio)
+
+def test_hifo_order_survives_copies():
+    # Two lots at the same unit cost. The partial disposal moves lot 1's cost_basis / quantity by an ulp,
+    # the copy a checkpoint restore makes must still pick lot 1 next.
+    position = Position(Asset("BTC", 1.0), 10, "2024-01-01", 1.0, method="HIFO")
+    position.add_lot(10, 1.0, "2024-01-02")
+    position.dispose(0.1)
+    assert position.lots.peek().lot_id == 1
+    assert position.copy().lots.peek().lot_id == 1
+
+@pytest.mark.parametrize("seed", range(15))
+def test_hifo_incremental_inserts_match_full_replay(seed):
+    portfolio, transactions = make_ledger(count=300, seed=seed)
+    portfolio.set_cost_basis_method("HIFO")
+    random.Random(seed).shuffle(transactions)
+    for transaction in transactions:
+        portfolio.ledger.add_transaction(transaction)
+    assert portfolio_state(portfolio) == full_replay_state(portfolio)
+
+def test_batch_matches_full_replay():
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions[:300])
+    portfolio.ledger.add_transactions(transactions[300:])
+    with portfolio.ledger.deferred_replay():
+        for transaction in transactions[100:150]:
+            portfolio.ledger.remove_transaction(transaction)
+    assert portfolio_state(portfolio) == full_replay_state(portfolio)
+
+def test_parallel_matches_full_replay(monkeypatch):
+    monkeypatch.setattr(parallel, "MIN_PARALLEL_TRANSACTIONS", 0)
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions)
+    expected = full_replay_state(portfolio)
+    parallel.replay_in_parallel(portfolio, max_workers=2)
+    assert portfolio_state(portfolio) == expected
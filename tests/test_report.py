@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from conftest import make_ledger
+from report import build_report
+
+def group_of(entry, group_by):
+    # Group values of a single entry, worked out from the entry itself rather than the rollup cells
+    day = datetime.fromtimestamp(entry.timestamp, timezone.utc).strftime("%Y-%m-%d")
+    fields = {
+        "date": day, "month": day[:7], "year": day[:4],
+        "wallet": entry.wallet.name if entry.wallet is not None else None,
+        "asset": entry.asset.name if entry.asset is not None else None,
+        "classification": entry.classification,
+    }
+    return tuple(fields[field] for field in group_by)
+
+def brute_force(portfolio, group_by, start=None, end=None, asset=None, wallet=None, classification=None):
+    # Every entry of both ledgers checked against the filters one by one
+    low = None if start is None else datetime.fromisoformat(start).replace(tzinfo=timezone.utc).timestamp()
+    high = None if end is None else datetime.fromisoformat(end).replace(tzinfo=timezone.utc).timestamp()
+    if high is not None and " " not in end:
+        high += 86399  # A bare end date covers that whole day
+    rows = {}
+
+    def add(entry, column, value):
+        if (low is not None and entry.timestamp < low) or (high is not None and entry.timestamp > high) \
+                or (asset is not None and entry.asset.name != asset) \
+                or (wallet is not None and entry.wallet.name != wallet) \
+                or (classification is not None and entry.classification != classification):
+            return
+        row = rows.setdefault(group_of(entry, group_by), {"gain_loss": 0, "fees": 0, "gain_loss_entries": 0,
+                                                          "fee_entries": 0})
+        row[column] += value
+        row[column + "_entries" if column == "gain_loss" else "fee_entries"] += 1
+
+    for entry in portfolio.gain_loss_ledger.entries:
+        add(entry, "gain_loss", entry.gain_amount)
+    for entry in portfolio.fee_ledger.fees:
+        add(entry, "fees", 0 if entry.capitalized else entry.fee_total_value)
+    return rows
+
+@pytest.fixture(scope="module")
+def ledger():
+    portfolio, transactions = make_ledger(count=800, seed=4)
+    # Every other transaction lands in the past, so the rollups go through truncates and rebuilds
+    portfolio.ledger.add_transactions(transactions[::2])
+    portfolio.ledger.add_transactions(transactions[1::2])
+    return portfolio
+
+@pytest.mark.parametrize("group_by", [(), ("date",), ("month", "wallet"), ("asset", "classification"),
+                                      ("year", "wallet", "asset")])
+@pytest.mark.parametrize("filters", [
+    {},
+    # Bounds cutting through days read those days from the entries, the rest from the rollups
+    {"start": "2015-01-03 07:30:00", "end": "2015-01-19 16:45:00"},
+    {"start": "2015-01-05 12:00:00", "end": "2015-01-05 18:00:00"},
+    {"asset": "COIN003", "start": "2015-01-10"},
+    {"wallet": "wallet01", "classification": "Trade", "end": "2015-01-31"},
+])
+def test_grouped_report_matches_brute_force(ledger, group_by, filters):
+    expected = brute_force(ledger, group_by, **filters)
+    rows = build_report(ledger, group_by, **filters)
+
+    assert len(rows) == len(expected)
+    for row in rows:
+        want = expected[tuple(row[field] for field in group_by)]
+        assert row["gain_loss"] == pytest.approx(want["gain_loss"], abs=1e-6)
+        assert row["fees"] == pytest.approx(want["fees"], abs=1e-6)
+        assert row["net"] == pytest.approx(want["gain_loss"] - want["fees"], abs=1e-6)
+        assert (row["gain_loss_entries"], row["fee_entries"]) == (want["gain_loss_entries"], want["fee_entries"])
@@ -0,0 +1,88 @@
+import pytest
+
+import storage
+from conftest import make_ledger, portfolio_state
+
+@pytest.mark.parametrize("filename", ["portfolio.json", "portfolio.vpf"])
+def test_round_trip(tmp_path, filename):
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions)
+    path = str(tmp_path / filename)
+    storage.save_portfolio(portfolio, path)
+    loaded = storage.load_portfolio(path)
+    assert portfolio_state(loaded) == portfolio_state(portfolio)
+    assert len(loaded.checkpoints) == len(portfolio.checkpoints)
+
+@pytest.mark.parametrize("filename", ["portfolio.json", "portfolio.vpf"])
+def test_append_save_after_removal(tmp_path, filename):
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions[:500])
+    path = str(tmp_path / filename)
+    storage.save_portfolio(portfolio, path)
+
+    # A removal in the middle drops the saved tail of every table, the new transactions go after it
+    portfolio.ledger.remove_transaction(transactions[250])
+    portfolio.ledger.add_transactions(transactions[500:])
+    storage.save_portfolio(portfolio, path)
+
+    loaded = storage.load_portfolio(path)
+    assert portfolio_state(loaded) == portfolio_state(portfolio)
+    assert [count for count, _ in loaded.checkpoints] == [count for count, _ in portfolio.checkpoints]
+    loaded.update_wallet_positions()
+    assert portfolio_state(loaded) == portfolio_state(portfolio)
+
+class Crash(Exception):
+    pass
+
+def save_crashing_before_metadata(portfolio, path, monkeypatch):
+    # The side files are written, the process dies before the metadata file is replaced
+    def crash(filename, data):
+        raise Crash()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(storage, "write_file_atomic", crash)
+        with pytest.raises(Crash):
+            storage.save_portfolio(portfolio, path)
+
+@pytest.mark.parametrize("remove_in_middle", [False, True])
+def test_crashed_save_keeps_last_snapshot(tmp_path, monkeypatch, remove_in_middle):
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions[:500])
+    path = str(tmp_path / "portfolio.vpf")
+    storage.save_portfolio(portfolio, path)
+    saved = portfolio_state(portfolio)
+
+    if remove_in_middle:
+        portfolio.ledger.remove_transaction(transactions[100])
+    portfolio.ledger.add_transactions(transactions[500:])
+    save_crashing_before_metadata(portfolio, path, monkeypatch)
+    assert portfolio_state(storage.load_portfolio(path)) == saved
+
+    # The next save goes through over whatever the crashed one left behind
+    storage.save_portfolio(portfolio, path)
+    assert portfolio_state(storage.load_portfolio(path)) == portfolio_state(portfolio)
+    # Only the metadata and the four files it names are left
+    assert len(list(tmp_path.iterdir())) == 5
+
+def test_load_decodes_transactions_on_demand(tmp_path):
+    portfolio, transactions = make_ledger()
+    portfolio.ledger.add_transactions(transactions[:500])
+    path = str(tmp_path / "portfolio.vpf")
+    storage.save_portfolio(portfolio, path)
+
+    loaded = storage.load_portfolio(path)
+    lazy = loaded.ledger.transactions
+    assert lazy.undecoded == 500
+    # A past query reads what its bisect touches and the replay from the checkpoint before it
+    moment = transactions[474]
+    loaded.state_at(f"{moment.date} {moment.time}")
+    assert 0 < 500 - lazy.undecoded <= 50
+    # Saving after an append writes only the new records, the loaded ones stay undecoded
+    loaded.ledger.add_transactions(transactions[500:])
+    storage.save_portfolio(loaded, path)
+    assert lazy.undecoded > 400
+
+    portfolio.ledger.add_transactions(transactions[500:])
+    assert portfolio_state(loaded) == portfolio_state(portfolio)
+    assert lazy.undecoded == 0 and lazy.table.file.closed
+    assert portfolio_state(storage.load_portfolio(path)) == portfolio_state(portfolio)
@@ -0,0 +1,64 @@
+from events import event_log
+from portfolio import Asset, Portfolio, Transaction, Wallet
+
+def two_wallets():
+    portfolio = Portfolio("Transfers")
+    btc = Asset("BTC", 300.0)
+    portfolio.add_asset(btc)
+    a, b = Wallet("a"), Wallet("b")
+    portfolio.add_wallet(a)
+    portfolio.add_wallet(b)
+    # Two lots in wallet a at different prices
+    for day, price in (("2024-01-01", 100.0), ("2024-01-02", 200.0)):
+        portfolio.ledger.add_transaction(Transaction(
+            day, "10:00", "Deposit", 0, None, "income",
+            received_quantity=1.0, received_asset=btc, received_spot_price=price, destination_wallet=a))
+    return portfolio, btc, a, b
+
+def transfer(portfolio, btc, quantity, origin, destination, day="2024-01-03"):
+    portfolio.ledger.add_transaction(Transaction(
+        day, "10:00", "Internal", 0, None, "transfer",
+        sent_quantity=quantity, sent_asset=btc, sent_spot_price=300.0,
+        origin_wallet=origin, destination_wallet=destination))
+
+def lots(wallet, name="BTC"):
+    position = wallet.get_position(name)
+    return [(lot.quantity, lot.cost_basis, lot.date_acquired) for lot in position.lots] if position else []
+
+def test_transfer_keeps_lots_and_cost_basis():
+    portfolio, btc, a, b = two_wallets()
+    transfer(portfolio, btc, 1.5, a, b)
+
+    # FIFO moves the first lot and half of the second, each with its own cost basis and acquisition date
+    assert lots(b) == [(1.0, 100.0, "2024-01-01 10:00"), (0.5, 100.0, "2024-01-02 10:00")]
+    assert lots(a) == [(0.5, 100.0, "2024-01-02 10:00")]
+    assert a.get_position("BTC").cost_basis + b.get_position("BTC").cost_basis == 300.0
+    # Moving between the portfolio's own wallets realizes nothing
+    assert not portfolio.gain_loss_ledger.entries
+
+    # A later sale from b realizes against the carried basis and holding period
+    portfolio.ledger.add_transaction(Transaction(
+        "2024-01-04", "10:00", "Order", 0, None, "trade",
+        received_quantity=450.0, received_asset=portfolio.get_asset("USD"), received_spot_price=1.0,
+        sent_quantity=1.5, sent_asset=btc, sent_spot_price=300.0, origin_wallet=b))
+    entries = portfolio.gain_loss_ledger.entries
+    assert [(entry.wallet.name, entry.cost_basis, entry.holding_period_days) for entry in entries] == \
+           [("b", 100.0, 3), ("b", 100.0, 2)]
+    assert sum(entry.gain_amount for entry in entries) == 250.0
+
+def test_whole_position_moves():
+    portfolio, btc, a, b = two_wallets()
+    transfer(portfolio, btc, 2.0, a, b)
+
+    assert a.get_position("BTC") is None
+    assert lots(b) == [(1.0, 100.0, "2024-01-01 10:00"), (1.0, 200.0, "2024-01-02 10:00")]
+    assert not portfolio.gain_loss_ledger.entries
+
+def test_rejected_transfer_changes_nothing():
+    portfolio, btc, a, b = two_wallets()
+    event_log.take_rejections()
+    transfer(portfolio, btc, 5.0, a, b)
+
+    assert lots(a) == [(1.0, 100.0, "2024-01-01 10:00"), (1.0, 200.0, "2024-01-02 10:00")]
+    assert b.get_position("BTC") is None
+    assert [rejection["code"] for rejection in event_log.take_rejections()] == ["insufficient_quantity"]
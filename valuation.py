@@ -0,0 +1,206 @@
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, the pure Python path below gives the same numbers
+    np = None
+
+class PoolValuation:
+    # Every reserve of every pool packed into flat columns (pool, underlying asset, reserve), so one pass
+    # values all pools from their underlying prices. revalue() stores each pool's value per LP share as
+    # its market_value, which LP positions then read like any other price.
+    def __init__(self, pools):
+        self.pools = list(pools)
+        self.assets = []
+        asset_ids = {}
+
+        pool_column = []
+        asset_column = []
+        reserves = []
+        for pool_id, pool in enumerate(self.pools):
+            for asset, reserve in zip(pool.assets, pool.reserves):
+                asset_id = asset_ids.get(asset.name)
+                if asset_id is None:
+                    asset_id = asset_ids[asset.name] = len(self.assets)
+                    self.assets.append(asset)
+                pool_column.append(pool_id)
+                asset_column.append(asset_id)
+                reserves.append(reserve)
+        supplies = [pool.total_supply for pool in self.pools]
+
+        if np is not None:
+            self.pool_ids = np.array(pool_column, dtype=np.int64)
+            self.asset_ids = np.array(asset_column, dtype=np.int64)
+            self.reserves = np.array(reserves, dtype=np.float64)
+            self.supplies = np.array(supplies, dtype=np.float64)
+        else:
+            self.pool_ids = pool_column
+            self.asset_ids = asset_column
+            self.reserves = reserves
+            self.supplies = supplies
+
+    def __len__(self):
+        return len(self.pools)
+
+    def revalue(self):
+        # Pool value and value per share from the current market value of every underlying asset
+        prices = [asset.market_value for asset in self.assets]
+        if np is not None:
+            self._revalue_vectorized(prices)
+        else:
+            self._revalue_python(prices)
+        for pool, share_value in zip(self.pools, self.share_values):
+            pool.market_value = share_value
+
+    def _revalue_vectorized(self, prices):
+        reserve_values = self.reserves * np.array(prices, dtype=np.float64)[self.asset_ids]
+        pool_values = np.bincount(self.pool_ids, weights=reserve_values, minlength=len(self.pools))
+        share_values = np.zeros(len(self.pools))
+        np.divide(pool_values, self.supplies, out=share_values, where=self.supplies > 0)
+        self.pool_values = pool_values.tolist()
+        self.share_values = share_values.tolist()
+
+    def _revalue_python(self, prices):
+        self.pool_values = [0.0] * len(self.pools)
+        for pool_id, asset_id, reserve in zip(self.pool_ids, self.asset_ids, self.reserves):
+            self.pool_values[pool_id] += reserve * prices[asset_id]
+        self.share_values = [value / supply if supply > 0 else 0.0
+                             for value, supply in zip(self.pool_values, self.supplies)]
+
+    def underlying(self, shares):
+        # Asset name -> quantity held through the pools, given the LP shares held of each pool
+        held = [shares.get(pool.name, 0.0) for pool in self.pools]
+        if np is not None:
+            fractions = np.zeros(len(self.pools))
+            np.divide(np.array(held, dtype=np.float64), self.supplies, out=fractions, where=self.supplies > 0)
+            quantities = np.bincount(self.asset_ids, weights=self.reserves * fractions[self.pool_ids],
+                                     minlength=len(self.assets)).tolist()
+        else:
+            fractions = [h / supply if supply > 0 else 0.0 for h, supply in zip(held, self.supplies)]
+            quantities = [0.0] * len(self.assets)
+            for pool_id, asset_id, reserve in zip(self.pool_ids, self.asset_ids, self.reserves):
+                quantities[asset_id] += reserve * fractions[pool_id]
+        return {asset.name: quantity for asset, quantity in zip(self.assets, quantities)}
+
+class Valuation:
+    # Packs every position of every wallet into flat columns once, then values all of them in a
+    # single batched pass. After a price tick only revalue() needs to run, not the packing.
+    def __init__(self, portfolio):
+        self.pools = PoolValuation(portfolio.pools)
+        self.asset_names = []
+        self.assets = []
+        self.wallet_names = [wallet.name for wallet in portfolio.wallets]
+        asset_ids = {}
+
+        asset_column = []
+        wallet_column = []
+        quantities = []
+        cost_bases = []
+        for wallet_id, wallet in enumerate(portfolio.wallets):
+            for position in wallet.positions:
+                asset_id = asset_ids.get(position.asset.name)
+                if asset_id is None:
+                    asset_id = asset_ids[position.asset.name] = len(self.assets)
+                    self.assets.append(position.asset)
+                    self.asset_names.append(position.asset.name)
+                asset_column.append(asset_id)
+                wallet_column.append(wallet_id)
+                quantities.append(position.quantity)
+                cost_bases.append(position.cost_basis)
+
+        if np is not None:
+            self.asset_ids = np.array(asset_column, dtype=np.int64)
+            self.wallet_ids = np.array(wallet_column, dtype=np.int64)
+            self.quantities = np.array(quantities, dtype=np.float64)
+            self.cost_bases = np.array(cost_bases, dtype=np.float64)
+        else:
+            self.asset_ids = asset_column
+            self.wallet_ids = wallet_column
+            self.quantities = quantities
+            self.cost_bases = cost_bases
+        self.revalue()
+
+    def __len__(self):
+        return len(self.quantities)
+
+    def revalue(self):
+        # Reads the current market value of every asset and recomputes all aggregates, LP shares priced
+        # from their pools first
+        self.pools.revalue()
+        prices = [asset.market_value for asset in self.assets]
+        if np is not None:
+            self._revalue_vectorized(prices)
+        else:
+            self._revalue_python(prices)
+
+    def _revalue_vectorized(self, prices):
+        n_assets = len(self.assets)
+        n_wallets = len(self.wallet_names)
+        self.spot_prices = np.array(prices, dtype=np.float64)[self.asset_ids]
+        self.market_values = self.quantities * self.spot_prices
+        self.unrealized = self.market_values - self.cost_bases
+
+        self.total_market_value = float(self.market_values.sum())
+        self.total_cost_basis = float(self.cost_bases.sum())
+        self.total_unrealized = float(self.unrealized.sum())
+
+        def by(ids, weights, length):
+            return np.bincount(ids, weights=weights, minlength=length).tolist()
+
+        self.asset_quantities = by(self.asset_ids, self.quantities, n_assets)
+        self.asset_market_values = by(self.asset_ids, self.market_values, n_assets)
+        self.asset_cost_bases = by(self.asset_ids, self.cost_bases, n_assets)
+        self.wallet_market_values = by(self.wallet_ids, self.market_values, n_wallets)
+        self.wallet_cost_bases = by(self.wallet_ids, self.cost_bases, n_wallets)
+
+    def _revalue_python(self, prices):
+        n_assets = len(self.assets)
+        n_wallets = len(self.wallet_names)
+        self.spot_prices = [prices[asset_id] for asset_id in self.asset_ids]
+        self.market_values = [quantity * price for quantity, price in zip(self.quantities, self.spot_prices)]
+        self.unrealized = [value - cost for value, cost in zip(self.market_values, self.cost_bases)]
+
+        self.total_market_value = sum(self.market_values)
+        self.total_cost_basis = sum(self.cost_bases)
+        self.total_unrealized = sum(self.unrealized)
+
+        self.asset_quantities = [0.0] * n_assets
+        self.asset_market_values = [0.0] * n_assets
+        self.asset_cost_bases = [0.0] * n_assets
+        self.wallet_market_values = [0.0] * n_wallets
+        self.wallet_cost_bases = [0.0] * n_wallets
+        for i, (asset_id, wallet_id) in enumerate(zip(self.asset_ids, self.wallet_ids)):
+            self.asset_quantities[asset_id] += self.quantities[i]
+            self.asset_market_values[asset_id] += self.market_values[i]
+            self.asset_cost_bases[asset_id] += self.cost_bases[i]
+            self.wallet_market_values[wallet_id] += self.market_values[i]
+            self.wallet_cost_bases[wallet_id] += self.cost_bases[i]
+
+    def by_asset(self):
+        # Asset name -> (quantity, market value, cost basis, unrealized gain/loss)
+        return {
+            name: (self.asset_quantities[i], self.asset_market_values[i], self.asset_cost_bases[i],
+                   self.asset_market_values[i] - self.asset_cost_bases[i])
+            for i, name in enumerate(self.asset_names)
+        }
+
+    def by_wallet(self):
+        # Wallet name -> (market value, cost basis, unrealized gain/loss)
+        return {
+            name: (self.wallet_market_values[i], self.wallet_cost_bases[i],
+                   self.wallet_market_values[i] - self.wallet_cost_bases[i])
+            for i, name in enumerate(self.wallet_names)
+        }
+
+    def by_pool(self):
+        # Pool name -> (LP shares held, share of the pool's supply, market value) for the pools held
+        ids = {name: i for i, name in enumerate(self.asset_names)}
+        result = {}
+        for pool in self.pools.pools:
+            i = ids.get(pool.name)
+            if i is not None:
+                shares = self.asset_quantities[i]
+                result[pool.name] = (shares, pool.share_of_supply(shares), self.asset_market_values[i])
+        return result
+
+    def underlying(self):
+        # Asset name -> quantity held through LP shares
+        return self.pools.underlying(dict(zip(self.asset_names, self.asset_quantities)))